@@ -0,0 +1,478 @@
+"""Offline load test of the chat hot path against stub model servers.
+
+Starts a local stub that emulates KoboldCPP (``/api/v1/generate``,
+``/api/extra/generate/stream``, ``/api/extra/tokencount``) and AUTOMATIC1111
+(``/sdapi/v1/txt2img``) with configurable latency, token rate and error
+injection, points every backend URL at it and then drives, at a fixed
+concurrency:
+
+* ``orch`` – :meth:`orchestrator.Orchestrator.handle` directly,
+* ``web``  – ``POST /chat`` on the aiohttp web UI,
+* ``bot``  – the Discord bot's ``on_message`` handler with fake messages.
+
+For each target it reports throughput, p50/p95/p99 latency, the error count
+and the process's peak memory. No network access or model is needed.
+
+Usage: ``python bench.py [--targets orch,web,bot] [--requests 200]
+[--concurrency 16] [--latency 0.05] [--token-rate 200] [--error-rate 0.01]``
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import socket
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List
+
+import aiohttp
+from aiohttp import web
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - Windows
+    resource = None  # type: ignore[assignment]
+
+TARGETS = ("orch", "web", "bot")
+
+MESSAGES = [
+    "hello there, how are you today?",
+    "what is the best ship for early game?",
+    "how do I beat wave 30 in the galaxy instance?",
+    "which commander should I use for defense?",
+    "tell me about the Heavenly Temple",
+    "can you explain how fleet supply works?",
+    "draw a battleship orbiting a blue planet",
+    "what should I research first?",
+    "thanks, that helped a lot",
+    "how do I get more helium3?",
+    "is it worth upgrading my frigates?",
+    "what did we talk about yesterday?",
+]
+
+# 1x1 transparent PNG.
+_PNG = base64.b64encode(
+    bytes.fromhex(
+        "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+        "1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+    )
+).decode()
+
+_MESSAGE_RE = re.compile(r'Message:\s*"?(.*?)"?\s*$', re.M)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted ``values``."""
+
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+def _max_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StubServer:
+    """KoboldCPP/A1111 look-alike answering each prompt type plausibly.
+
+    Every request waits ``latency`` seconds (± ``jitter``) plus the time to
+    emit its tokens at ``token_rate`` tokens per second (and, with
+    ``prompt_rate``, to process the prompt), and fails with HTTP 503 with
+    probability ``error_rate``.
+    """
+
+    def __init__(
+        self,
+        latency: float,
+        token_rate: float,
+        error_rate: float,
+        reply_tokens: int,
+        image_latency: float,
+        prompt_rate: float = 0.0,
+        jitter: float = 0.2,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.image_latency = image_latency
+        self.prompt_rate = prompt_rate
+        self.jitter = jitter
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._runner: web.AppRunner | None = None
+
+    def _delay(self, base: float) -> float:
+        return max(0.0, base * (1 + self._rng.uniform(-self.jitter, self.jitter)))
+
+    def _fail(self, kind: str) -> bool:
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self._rng.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def _prompt_seconds(self, prompt: str) -> float:
+        return len(prompt) / 4 / self.prompt_rate if self.prompt_rate > 0 else 0.0
+
+    def _reply(self, prompt: str, max_length: int) -> str:
+        if prompt.startswith("Classify each numbered"):
+            texts = re.findall(r"^\d+\. (.*)$", prompt, re.M)
+            return json.dumps([self._intent(json.loads(t)) for t in texts])
+        if prompt.startswith("For each numbered pair"):
+            n = len(re.findall(r"^\d+\. Message:", prompt, re.M))
+            return "\n".join(f"{i}: YES" for i in range(1, n + 1))
+        if prompt.startswith("Answer YES"):
+            return "YES"
+        if prompt.startswith("Return ONLY compact JSON"):
+            m = _MESSAGE_RE.search(prompt)
+            return json.dumps(self._intent(m.group(1) if m else ""))
+        if prompt.startswith("Plan the reply"):
+            return json.dumps({"goal": "answer the user", "steps": ["answer"], "tone_hint": "warm"})
+        if prompt.startswith("Return a <=10 word tone hint"):
+            return "warm and focused"
+        words = min(max_length, self.reply_tokens)
+        return " ".join(f"word{i}" for i in range(words)) + "."
+
+    @staticmethod
+    def _intent(message: str) -> Dict[str, Any]:
+        image = message.lower().startswith("draw")
+        return {
+            "intent": "image" if image else "question",
+            "confidence": 0.9,
+            "flags": {"needs_image": image, "needs_admin": False, "risky": False},
+        }
+
+    async def generate(self, request: web.Request) -> web.Response:
+        js = await request.json()
+        prompt = js.get("prompt", "")
+        text = self._reply(prompt, int(js.get("max_length", 80)))
+        tokens = len(text.split())
+        await asyncio.sleep(
+            self._delay(self.latency) + self._prompt_seconds(prompt) + tokens / self.token_rate
+        )
+        if self._fail("generate"):
+            return web.Response(status=503, text="injected error")
+        return web.json_response({"results": [{"text": text}]})
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        js = await request.json()
+        prompt = js.get("prompt", "")
+        await asyncio.sleep(self._delay(self.latency) + self._prompt_seconds(prompt))
+        if self._fail("stream"):
+            return web.Response(status=503, text="injected error")
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for word in self._reply(prompt, int(js.get("max_length", 80))).split():
+            await asyncio.sleep(1 / self.token_rate)
+            data = json.dumps({"token": word + " "})
+            await resp.write(f"event: message\ndata: {data}\n\n".encode())
+        await resp.write_eof()
+        return resp
+
+    async def model(self, request: web.Request) -> web.Response:
+        return web.json_response({"result": "stub/bench"})
+
+    async def tokencount(self, request: web.Request) -> web.Response:
+        js = await request.json()
+        return web.json_response({"value": len(js.get("prompt", "")) // 4})
+
+    async def txt2img(self, request: web.Request) -> web.Response:
+        await request.read()
+        await asyncio.sleep(self._delay(self.image_latency))
+        if self._fail("txt2img"):
+            return web.Response(status=503, text="injected error")
+        return web.json_response({"images": [_PNG]})
+
+    async def progress(self, request: web.Request) -> web.Response:
+        return web.json_response({"progress": 0.5, "eta_relative": self.image_latency / 2})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/api/v1/generate", self.generate)
+        app.router.add_post("/api/extra/generate/stream", self.stream)
+        app.router.add_post("/api/extra/tokencount", self.tokencount)
+        app.router.add_get("/api/v1/model", self.model)
+        app.router.add_post("/sdapi/v1/txt2img", self.txt2img)
+        app.router.add_get("/sdapi/v1/progress", self.progress)
+        return app
+
+    async def start(self, port: int) -> str:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _configure(url: str, workdir: str) -> None:
+    """Point every backend at the stub and keep all state out of the repo.
+
+    Must run before the bot modules are imported, as they read their
+    configuration at import time.
+    """
+
+    for name in ("KOBOLD_URL", "INTENT_URL", "THOUGHTS_URL", "SD_URL"):
+        os.environ[name] = url
+    os.environ["KOBOLD_ASSIST_URL"] = ""
+    os.environ["TRANSLATE_BACKENDS"] = ""
+    os.environ["INTENT_CACHE_FILE"] = ""
+    os.environ["FAST_INTENT_LOG"] = ""
+    os.environ["SUMMARIZER"] = "0"
+    os.environ["USER_DB_PATH"] = os.path.join(workdir, "bench_users.db")
+    os.environ["IMAGE_CACHE_DIR"] = os.path.join(workdir, "images")
+
+
+class _FakeChannel:
+    def __init__(self) -> None:
+        self.sent: List[str] = []
+
+    async def typing(self) -> None:
+        return None
+
+    async def send(self, content: str | None = None, **kwargs: Any) -> SimpleNamespace:
+        self.sent.append(content or "")
+
+        async def edit(content: str = "", **kw: Any) -> None:
+            self.sent.append(content)
+
+        return SimpleNamespace(content=content, edit=edit)
+
+
+def _fake_message(state: Any, user: int, content: str) -> SimpleNamespace:
+    author = SimpleNamespace(id=user, bot=False, name=f"bench{user}")
+    return SimpleNamespace(
+        _state=state,
+        id=random.getrandbits(48),
+        author=author,
+        content=content,
+        channel=_FakeChannel(),
+        guild=None,
+        mentions=[],
+    )
+
+
+def _failed_reply(channel: _FakeChannel) -> bool:
+    return any(s.startswith(("Error:", "Image error:", "I'm swamped")) for s in channel.sent)
+
+
+async def _drive(
+    call: Callable[[int, str], Awaitable[bool]],
+    requests: int,
+    concurrency: int,
+    users: int,
+    unique: bool,
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    jobs: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(requests):
+        jobs.put_nowait(i)
+
+    async def worker() -> None:
+        nonlocal errors
+        while True:
+            try:
+                i = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            text = MESSAGES[i % len(MESSAGES)]
+            if unique:
+                text = f"{text} (#{i})"
+            start = time.perf_counter()
+            try:
+                ok = await call(i % users, text)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "rps": requests / elapsed if elapsed else 0.0,
+        "p50_ms": 1000 * _percentile(latencies, 50),
+        "p95_ms": 1000 * _percentile(latencies, 95),
+        "p99_ms": 1000 * _percentile(latencies, 99),
+        "max_rss_mb": _max_rss_mb(),
+        "traced_peak_mb": tracemalloc.get_traced_memory()[1] / 2**20 if tracemalloc.is_tracing() else 0.0,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    stub = StubServer(
+        args.latency,
+        args.token_rate,
+        args.error_rate,
+        args.reply_tokens,
+        args.image_latency,
+        args.prompt_rate,
+        seed=args.seed,
+    )
+    url = await stub.start(_free_port())
+    workdir = tempfile.mkdtemp(prefix="requiem-bench-")
+    _configure(url, workdir)
+
+    import core
+    from degrade import DEGRADED_REQUESTS, LEVELS
+    from images import ImageQueue
+    from metrics import STAGE_SECONDS
+    from orchestrator import Orchestrator
+
+    results: Dict[str, Any] = {"targets": {}}
+    session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+    runner: web.AppRunner | None = None
+    try:
+        calls: Dict[str, Callable[[int, str], Awaitable[bool]]] = {}
+        if "orch" in args.targets:
+            orch = Orchestrator(
+                core.SYSTEM_PROMPT, core.GLOBAL_MEMORY, session, recall=core.USER_RECALL
+            )
+
+            async def orch_call(user: int, text: str) -> bool:
+                entry = await asyncio.to_thread(core.get_user_entry, f"orch{user}")
+                kb = core.lookup_go2(text)
+                result = await orch.handle(
+                    f"orch{user}", entry["history"], text, kb, entry.get("summary", "")
+                )
+                return bool(result.final)
+
+            calls["orch"] = orch_call
+
+        if "web" in args.targets:
+            import web_ui
+
+            runner = web.AppRunner(web_ui.create_app(), access_log=None)
+            await runner.setup()
+            port = _free_port()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            chat_url = f"http://127.0.0.1:{port}/chat"
+
+            async def web_call(user: int, text: str) -> bool:
+                async with session.post(chat_url, json={"message": text, "user": f"web{user}"}) as r:
+                    await r.read()
+                    return r.status == 200
+
+            calls["web"] = web_call
+
+        if "bot" in args.targets:
+            import bot as bot_mod
+
+            # on_message runs bot.process_commands, which needs a logged-in user.
+            bot_mod.bot._connection.user = SimpleNamespace(id=0)
+            bot_mod.ORCH = Orchestrator(
+                core.SYSTEM_PROMPT, core.GLOBAL_MEMORY, session, recall=core.USER_RECALL
+            )
+            bot_mod.IMAGES = ImageQueue(session)
+
+            async def bot_call(user: int, text: str) -> bool:
+                message = _fake_message(bot_mod.bot._connection, 10_000 + user, text)
+                await bot_mod.on_message(message)
+                return bool(message.channel.sent) and not _failed_reply(message.channel)
+
+            calls["bot"] = bot_call
+
+        for name in args.targets:
+            # Warm up connections and lazily built state outside the measurement.
+            await calls[name](0, MESSAGES[0])
+            results["targets"][name] = await _drive(
+                calls[name], args.requests, args.concurrency, args.users, args.unique
+            )
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await session.close()
+        await stub.stop()
+
+    results["stub"] = {"calls": stub.calls, "injected_errors": stub.errors}
+    results["levels"] = {level: int(DEGRADED_REQUESTS.value(level=level)) for level in LEVELS}
+    results["stages"] = {
+        labels["stage"]: {
+            "count": STAGE_SECONDS.count(**labels),
+            "mean_ms": 1000 * STAGE_SECONDS.mean(**labels),
+            "p95_ms": 1000 * STAGE_SECONDS.quantile(0.95, **labels),
+        }
+        for labels in STAGE_SECONDS.labelsets()
+    }
+    return results
+
+
+def _report(results: Dict[str, Any]) -> None:
+    print(f"{'target':<6} {'reqs':>6} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MB':>8} {'peak MB':>8}")
+    for name, r in results["targets"].items():
+        peak = f"{r['traced_peak_mb']:>8.1f}" if r["traced_peak_mb"] else f"{'-':>8}"
+        print(
+            f"{name:<6} {r['requests']:>6} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.0f} "
+            f"{r['p95_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['max_rss_mb']:>8.1f} {peak}"
+        )
+    print()
+    print(f"{'stage':<12} {'count':>6} {'mean ms':>8} {'p95 ms':>8}")
+    for stage, s in sorted(results["stages"].items()):
+        print(f"{stage:<12} {s['count']:>6} {s['mean_ms']:>8.1f} {s['p95_ms']:>8.1f}")
+    print(f"\nserved per degradation level: {results['levels']}")
+    stub = results["stub"]
+    print(f"\nstub calls: {stub['calls']}, injected errors: {stub['injected_errors']}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--targets", default=",".join(TARGETS), help="comma-separated subset of orch,web,bot")
+    ap.add_argument("--requests", type=int, default=200, help="requests per target")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--users", type=int, default=8, help="distinct simulated users")
+    ap.add_argument("--unique", action="store_true", help="make every message distinct (defeats caches)")
+    ap.add_argument("--latency", type=float, default=0.05, help="base seconds per model request")
+    ap.add_argument("--token-rate", type=float, default=200.0, help="generated tokens per second")
+    ap.add_argument("--prompt-rate", type=float, default=0.0, help="prompt tokens per second (0 = free)")
+    ap.add_argument("--reply-tokens", type=int, default=60, help="tokens in a core reply")
+    ap.add_argument("--image-latency", type=float, default=0.5)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests failing with 503")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--trace-memory", action="store_true", help="also report the tracemalloc peak (slower)")
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args()
+    args.targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        ap.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    if args.trace_memory:
+        tracemalloc.start()
+    results = asyncio.run(run(args))
+    _report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Compare how much of the core prompt KoboldCPP can reuse per prompt layout.
+
+Replays a synthetic conversation through ``Orchestrator._core_prompt`` with each
+``PROMPT_LAYOUT`` and reports, per layout, how much of every prompt is a
+byte-identical prefix of the previous one (what KoboldCPP can keep in its KV
+cache). With ``--url`` each prompt is also sent to a running KoboldCPP server
+with ``max_length=1`` and the prompt-processing time reported by
+``/api/extra/perf`` is summed.
+
+Usage: ``python bench_prompt.py [--turns 40] [--url http://127.0.0.1:5001]``
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+from typing import Dict, List
+
+import aiohttp
+
+import core
+from orchestrator import Intent, Orchestrator
+
+
+def _common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _conversation(turns: int) -> List[tuple[str, str]]:
+    return [
+        (
+            f"Question {i}: how should I fit my fleet against wave {i}?",
+            f"Answer {i}: bring frigates for scouting and a dreadnought for wave {i}.",
+        )
+        for i in range(turns)
+    ]
+
+
+async def _prompt_seconds(
+    sess: aiohttp.ClientSession, url: str, prompt: str
+) -> float:
+    payload = {"prompt": prompt, "max_length": 1, "max_context_length": 8192}
+    async with sess.post(f"{url}/api/v1/generate", json=payload) as r:
+        r.raise_for_status()
+        await r.read()
+    async with sess.get(f"{url}/api/extra/perf") as r:
+        r.raise_for_status()
+        js = await r.json()
+    return float(js.get("last_process", 0.0))
+
+
+async def run(turns: int, url: str | None) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    async with aiohttp.ClientSession() as sess:
+        for layout in ("legacy", "stable"):
+            orch = Orchestrator(core.SYSTEM_PROMPT, core.GLOBAL_MEMORY, sess, layout=layout)
+            history: List[Dict[str, str]] = []
+            prev = ""
+            total = reused = 0
+            seconds = 0.0
+            for i, (user, reply) in enumerate(_conversation(turns)):
+                intent = Intent("question", 0.6 + (i % 4) / 10, {"needs_image": False})
+                plan = {"goal": f"answer question {i}", "tone_hint": "helpful"}
+                kb = core.lookup_go2(user)
+                prompt = await orch._core_prompt(history, user, intent, plan, "calm", kb, "")
+                total += len(prompt)
+                reused += _common_prefix(prev, prompt)
+                if url:
+                    seconds += await _prompt_seconds(sess, url, prompt)
+                prev = prompt
+                history += [
+                    {"role": "user", "content": user},
+                    {"role": "assistant", "content": reply},
+                ]
+            results[layout] = {
+                "prompt_chars": total,
+                "reused_chars": reused,
+                "reused_pct": 100.0 * reused / total if total else 0.0,
+                "process_s": seconds,
+            }
+    return results
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--turns", type=int, default=40)
+    ap.add_argument("--url", default=os.getenv("BENCH_KOBOLD_URL"))
+    args = ap.parse_args()
+    results = asyncio.run(run(args.turns, args.url))
+    for layout, r in results.items():
+        fresh = (r["prompt_chars"] - r["reused_chars"]) / args.turns
+        line = (
+            f"{layout:>7}: {r['reused_pct']:5.1f}% of prompt chars reusable, "
+            f"{fresh:.0f} chars re-processed per turn"
+        )
+        if args.url:
+            line += f", {r['process_s']:.2f}s prompt processing"
+        print(line)
+    if args.url and results["legacy"]["process_s"]:
+        saved = results["legacy"]["process_s"] - results["stable"]["process_s"]
+        print(f"saved {saved:.2f}s ({100 * saved / results['legacy']['process_s']:.0f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 """Discord interface for the Requiem AI."""
 from __future__ import annotations
 
+# Imported first so the startup timings cover the other imports.
+from startup import STARTUP, warm_up  # isort: skip
+
 import asyncio
 import os
+import time
+from typing import Any, Coroutine
 
 import aiohttp
 import discord
@@ -10,23 +15,31 @@ from discord.ext import commands
 
 import core
 from core import (
-    MAX_WORKERS,
     MEM_EXPORT_PATH,
-    MEMORY_FILE,
-    USER_DATA,
+    STREAM_EDIT_INTERVAL,
+    STREAM_REPLIES,
     SYSTEM_PROMPT,
-    detect_language,
+    forget_user,
     get_user_entry,
     lookup_go2,
-    reload_global_memory,
-    save_user_data,
     set_emotion,
-    translate_text,
-    txt2img,
+    set_pref,
     update_memory,
 )
+from degrade import LEVELS
+from images import ImageJob, ImageQueue
+from launch_kobold import wait_ready
+from memindex import MEM_INDEX
+from metrics import METRICS, RETRIES, STAGE_SECONDS
 from orchestrator import Orchestrator
+from reloader import RELOAD, RELOADER
+from replicas import POOLS
+from reply_cache import FRESH_PREF
+from scheduler import SCHEDULER, Overloaded
+from summarizer import SUMMARIZER, Summarizer
+from translation import TRANSLATOR
 
+STARTUP.mark("imports")
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 
@@ -34,45 +47,86 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-GENERATION_SEMAPHORE = asyncio.Semaphore(MAX_WORKERS)
 _SESSION: aiohttp.ClientSession | None = None
 ORCH: Orchestrator | None = None
+_SUMMARIZER: Summarizer | None = None
+_SUMMARIZER_TASK: asyncio.Task | None = None
+IMAGES: ImageQueue | None = None
+_BACKGROUND: set[asyncio.Task] = set()
+# Seconds between progress edits while an image renders.
+IMAGE_STATUS_INTERVAL = 3.0
+
+
+def _memory_reloaded(text: str) -> None:
+    if ORCH is not None:
+        ORCH.set_memory(text)
+
+
+RELOADER.subscribe("memory", _memory_reloaded)
 
 
 @bot.event
 async def on_ready() -> None:
-    global _SESSION, ORCH
-    if _SESSION is None or _SESSION.closed:
-        _SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
-    ORCH = Orchestrator(SYSTEM_PROMPT, core.GLOBAL_MEMORY, _SESSION)
+    global _SESSION, ORCH, _SUMMARIZER, _SUMMARIZER_TASK, IMAGES
+    STARTUP.mark_once("login")
+    if ORCH is None:
+        # Messages get "Model not ready" until the supervisor reports ready.
+        await wait_ready()
+        STARTUP.mark_once("models")
+    _SESSION = core.http_session()
+    # on_ready runs again after every reconnect; keep the orchestrator (and
+    # its caches) unless the session it was built with has been closed.
+    if ORCH is None or ORCH.core.sess is not _SESSION:
+        ORCH = Orchestrator(SYSTEM_PROMPT, core.GLOBAL_MEMORY, _SESSION, recall=core.USER_RECALL)
+    if IMAGES is None or IMAGES.sess is not _SESSION:
+        IMAGES = ImageQueue(_SESSION)
+        METRICS.register_cache("image", IMAGES)
+    if SUMMARIZER:
+        if _SUMMARIZER is None:
+            _SUMMARIZER = Summarizer(core.USER_STORE, ORCH)
+            _SUMMARIZER_TASK = _SUMMARIZER.start()
+        _SUMMARIZER.orch = ORCH
+    if RELOAD:
+        RELOADER.start()
     print(f"Logged in as {bot.user} (ID {bot.user.id})")
+    if "ready" not in STARTUP.phases:
+        STARTUP.mark("ready")
+        _spawn(warm_up())
+
+
+def _spawn(coro: Coroutine[Any, Any, Any]) -> None:
+    task = asyncio.ensure_future(coro)
+    _BACKGROUND.add(task)
+    task.add_done_callback(_BACKGROUND.discard)
 
 
 @bot.command(name="helpme")
 async def helpme(ctx: commands.Context) -> None:
     await ctx.reply(
-        "Commands: !forget, !reload, !emotion <mood>, !img <prompt>, !go2 <text>, !memoryfile, !memoryhere, !anchors, !memfind <text>\n"
+        "Commands: !forget, !reload, !stats, !emotion <mood>, !fresh on|off, !img <prompt>, !go2 <text>, !memoryfile, !memoryhere, !anchors, !memfind <text>\n"
         "Talk to me by mentioning me or just typing—I'll answer here."
     )
 
 
 @bot.command(name="forget")
 async def forget(ctx: commands.Context) -> None:
-    USER_DATA.pop(str(ctx.author.id), None)
-    save_user_data()
+    forget_user(ctx.author.id)
     await ctx.reply("Your memory is cleared.")
 
 
 @bot.command(name="reload")
 @commands.has_permissions(administrator=True)
 async def reload_cmd(ctx: commands.Context) -> None:
-    if MEMORY_FILE.exists():
-        reload_global_memory()
-        if ORCH:
-            ORCH.gmem = core.GLOBAL_MEMORY
-        await ctx.reply("Shared memory reloaded.")
-    else:
-        await ctx.reply("memory.md not found.")
+    done = await asyncio.to_thread(RELOADER.check, True)
+    lines = []
+    for w in done:
+        if w.error:
+            lines.append(f"{w.path.name}: failed, kept the previous version ({w.error[:200]})")
+        elif not w.path.exists():
+            lines.append(f"{w.path.name}: not found")
+        else:
+            lines.append(f"{w.path.name}: reloaded in {w.seconds * 1000:.0f} ms")
+    await ctx.reply("\n".join(lines))
 
 
 @reload_cmd.error
@@ -80,6 +134,55 @@ async def reload_err(ctx: commands.Context, exc: Exception) -> None:
     await ctx.reply("You lack permission to reload memory.")
 
 
+def _stats_text() -> str:
+    lines = ["**Stage latency** (count · mean · p95)"]
+    for labels in sorted(STAGE_SECONDS.labelsets(), key=lambda l: l["stage"]):
+        lines.append(
+            f"`{labels['stage']:<12}` {STAGE_SECONDS.count(**labels):>6} · "
+            f"{STAGE_SECONDS.mean(**labels):.2f}s · {STAGE_SECONDS.quantile(0.95, **labels):.2f}s"
+        )
+    lines.append(f"Core retries: {RETRIES.value(stage='core'):.0f}")
+    if ORCH is not None and ORCH.ladder is not None:
+        lines.append(
+            f"Degradation: **{LEVELS[ORCH.ladder.current]}** (pressure {ORCH.ladder.pressure():.2f})"
+        )
+    reloaded = [w for w in RELOADER.files.values() if w.loaded_at]
+    if reloaded:
+        lines.append(
+            "Last reloads: "
+            + ", ".join(f"{w.path.name} {w.seconds * 1000:.0f} ms" for w in reloaded)
+        )
+    lines.append(STARTUP.report())
+    lines.append("**Caches** (hit rate · size)")
+    for name, st in METRICS.cache_stats().items():
+        lines.append(f"`{name:<12}` {st['hit_rate']:.0%} · {st['size']}/{st['maxsize']}")
+    if any(len(pool.replicas) > 1 for pool in POOLS.values()):
+        lines.append("**Replicas** (breaker · outstanding · errors/requests)")
+        for role, pool in POOLS.items():
+            for st in pool.stats():
+                lines.append(
+                    f"`{role:<8}` {st['url']} {st['state']} · {st['outstanding']} · "
+                    f"{st['errors']}/{st['requests']}"
+                )
+    lines.append("**Backends** (active/capacity · queued · rejected)")
+    for name, st in SCHEDULER.stats().items():
+        lines.append(
+            f"`{name:<12}` {st['active']}/{st['capacity']} · {st['queued']} · {st['rejected']}"
+        )
+    return "\n".join(lines)
+
+
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats_cmd(ctx: commands.Context) -> None:
+    await ctx.reply(_stats_text()[:1900])
+
+
+@stats_cmd.error
+async def stats_err(ctx: commands.Context, exc: Exception) -> None:
+    await ctx.reply("You lack permission to view stats.")
+
+
 @bot.command(name="emotion")
 async def emotion(ctx: commands.Context, *, mood: str | None = None) -> None:
     if mood:
@@ -90,20 +193,57 @@ async def emotion(ctx: commands.Context, *, mood: str | None = None) -> None:
         await ctx.reply(f"Current emotion: **{current}**")
 
 
+@bot.command(name="fresh")
+async def fresh(ctx: commands.Context, setting: str = "") -> None:
+    setting = setting.strip().lower()
+    if setting in ("on", "off"):
+        set_pref(ctx.author.id, FRESH_PREF, "1" if setting == "on" else None)
+    on = get_user_entry(ctx.author.id)["prefs"].get(FRESH_PREF) == "1"
+    await ctx.reply(
+        "Fresh replies are **on**: every answer is generated anew."
+        if on
+        else "Fresh replies are **off**: repeated questions may get a cached answer."
+    )
+
+
+async def _await_image(job: ImageJob, status: discord.Message | None = None) -> ImageJob:
+    """Wait for ``job``, showing its progress in ``status`` if given."""
+
+    while not job.finished.is_set():
+        try:
+            await asyncio.wait_for(job.finished.wait(), IMAGE_STATUS_INTERVAL)
+        except asyncio.TimeoutError:
+            if status is not None:
+                await status.edit(content=f"Rendering… {job.progress:.0%}")
+    return job
+
+
+def _image_file(job: ImageJob) -> discord.File:
+    return discord.File(str(IMAGES.store.path(job.digest)), filename="image.png")
+
+
+async def _send_image(channel: discord.abc.Messageable, job: ImageJob) -> None:
+    await _await_image(job)
+    if job.status == "done":
+        await channel.send(file=_image_file(job))
+    else:
+        await channel.send(f"Image error: {job.error}")
+
+
 @bot.command(name="img")
 async def img_cmd(ctx: commands.Context, *, prompt: str = "") -> None:
     if not prompt:
         return await ctx.reply("Usage: `!img <prompt>`")
-    await ctx.channel.typing()
-    try:
-        async with GENERATION_SEMAPHORE:
-            png = await asyncio.to_thread(txt2img, prompt)
-    except Exception as e:  # pragma: no cover - network errors
-        return await ctx.reply(f"Image error: {e}")
-    await ctx.reply(
-        content=f"**Prompt:** {prompt}",
-        file=discord.File(fp=bytes(png), filename="image.png"),
-    )
+    if IMAGES is None:
+        return await ctx.reply("Model not ready")
+    job = IMAGES.submit(prompt, ctx.author.id)
+    status = None if job.finished.is_set() else await ctx.reply("Rendering…")
+    await _await_image(job, status)
+    if job.status != "done":
+        return await ctx.reply(f"Image error: {job.error}")
+    await ctx.reply(content=f"**Prompt:** {prompt}", file=_image_file(job))
+    if status is not None:
+        await status.delete()
 
 
 @bot.command(name="go2")
@@ -139,42 +279,63 @@ async def memoryhere_cmd(ctx: commands.Context) -> None:
     )
 
 
-def _extract_anchors(md: str, max_items: int = 12) -> str:
-    lines = [ln.strip() for ln in md.splitlines()]
-    hits = [ln for ln in lines if "Anchor" in ln]
-    seen: set[str] = set()
-    out: list[str] = []
-    for h in hits:
-        if h not in seen:
-            out.append(h)
-            seen.add(h)
-    return "\n".join(f"• {x}" for x in out[:max_items]) or "(no anchors found)"
-
-
 @bot.command(name="anchors")
 async def anchors_cmd(ctx: commands.Context) -> None:
-    if not MEM_EXPORT_PATH.exists():
+    if not MEM_INDEX.exists():
         return await ctx.reply("(no memory export found)")
-    text = MEM_EXPORT_PATH.read_text(encoding="utf-8")
-    await ctx.reply(f"**Anchors (top)**\n{_extract_anchors(text)}")
+    anchors = await asyncio.to_thread(MEM_INDEX.anchors, 12)
+    text = "\n".join(f"• {x}" for x in anchors) or "(no anchors found)"
+    await ctx.reply(f"**Anchors (top)**\n{text}"[:1900])
 
 
 @bot.command(name="memfind")
 async def memfind_cmd(ctx: commands.Context, *, q: str = "") -> None:
     if not q:
         return await ctx.reply("Usage: `!memfind <text>`")
-    if not MEM_EXPORT_PATH.exists():
+    if not MEM_INDEX.exists():
         return await ctx.reply("(no memory export found)")
-    text = MEM_EXPORT_PATH.read_text(encoding="utf-8")
-    matches: list[str] = []
-    for i, ln in enumerate(text.splitlines(), 1):
-        if q.lower() in ln.lower():
-            matches.append(f"`L{i:>4}` {ln[:180]}")
-            if len(matches) >= 10:
-                break
-    if not matches:
+    hits = await asyncio.to_thread(MEM_INDEX.search, q, 10)
+    if not hits:
         return await ctx.reply(f"No hits for **{q}**")
-    await ctx.reply(f"**Search:** {q}\n" + "\n".join(matches))
+    matches = [f"`L{i:>4}` {ln[:180]}" for i, ln in hits]
+    await ctx.reply((f"**Search:** {q}\n" + "\n".join(matches))[:1900])
+
+
+class _StreamedReply:
+    """Progressively edit a single Discord message while tokens arrive.
+
+    Edits are throttled to ``interval`` seconds so a fast model does not run
+    into Discord's per-channel edit rate limit.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, interval: float) -> None:
+        self.channel = channel
+        self.interval = interval
+        self.text = ""
+        self._msg: discord.Message | None = None
+        self._shown = ""
+        self._last = 0.0
+
+    async def push(self, token: str) -> None:
+        self.text += token
+        if time.monotonic() - self._last >= self.interval:
+            await self._show(self.text.strip()[:1900])
+
+    async def _show(self, content: str) -> None:
+        self._last = time.monotonic()
+        if not content or content == self._shown:
+            return
+        if self._msg is None:
+            self._msg = await self.channel.send(content)
+        else:
+            await self._msg.edit(content=content)
+        self._shown = content
+
+    async def finish(self, reply: str) -> None:
+        chunks = [reply[i : i + 1900] for i in range(0, len(reply), 1900)] or [reply]
+        await self._show(chunks[0])
+        for chunk in chunks[1:]:
+            await self.channel.send(chunk)
 
 
 @bot.event
@@ -189,33 +350,50 @@ async def on_message(message: discord.Message) -> None:
         return await message.channel.send("Model not ready")
     await message.channel.typing()
     entry = get_user_entry(message.author.id)
-    lang = detect_language(content)
-    content_en = translate_text(content, lang, "en")
+    lang = await TRANSLATOR.detect(content)
+    content_en = await TRANSLATOR.translate(content, lang, "en")
     kb = lookup_go2(content_en)
-    async with GENERATION_SEMAPHORE:
-        try:
+    # Tokens are English; only stream when no translation happens afterwards.
+    streamed: _StreamedReply | None = None
+    if STREAM_REPLIES and lang == "en":
+        streamed = _StreamedReply(message.channel, STREAM_EDIT_INTERVAL)
+    use_cache = entry["prefs"].get(FRESH_PREF) != "1"
+    try:
+        if streamed is not None:
+            result = await ORCH.handle_stream(
+                message.author.id,
+                entry["history"],
+                content_en,
+                kb,
+                entry.get("summary", ""),
+                on_token=streamed.push,
+                use_cache=use_cache,
+            )
+        else:
             result = await ORCH.handle(
                 message.author.id,
                 entry["history"],
                 content_en,
                 kb,
                 entry.get("summary", ""),
+                use_cache=use_cache,
             )
-        except Exception as exc:  # pragma: no cover - network errors
-            return await message.channel.send(f"Error: {exc}")
+    except Overloaded:
+        return await message.channel.send("I'm swamped right now, please try again in a moment.")
+    except Exception as exc:  # pragma: no cover - network errors
+        return await message.channel.send(f"Error: {exc}")
     reply_en = result.final
-    reply = translate_text(reply_en, "en", lang)
+    reply = await TRANSLATOR.translate(reply_en, "en", lang)
     update_memory(message.author.id, content_en, reply_en)
-    for chunk in (reply[i : i + 1900] for i in range(0, len(reply), 1900)):
-        await message.channel.send(chunk)
-    if result.intent.flags.get("needs_image"):
-        async with GENERATION_SEMAPHORE:
-            try:
-                png = await asyncio.to_thread(txt2img, content)
-            except Exception as exc:  # pragma: no cover - network errors
-                await message.channel.send(f"Image error: {exc}")
-            else:
-                await message.channel.send(file=discord.File(fp=bytes(png), filename="image.png"))
+    if streamed is not None:
+        await streamed.finish(reply)
+    else:
+        for chunk in (reply[i : i + 1900] for i in range(0, len(reply), 1900)):
+            await message.channel.send(chunk)
+    STARTUP.mark_once("first_reply")
+    if result.intent.flags.get("needs_image") and IMAGES is not None:
+        # Posted when the render finishes; the next message need not wait.
+        _spawn(_send_image(message.channel, IMAGES.submit(content, message.author.id)))
 
 
 if __name__ == "__main__":
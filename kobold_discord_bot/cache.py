@@ -0,0 +1,143 @@
+"""Bounded in-process caches with optional on-disk persistence."""
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable
+
+# The cache that owns each save file: the newest one created for it. Replaced
+# caches (e.g. of an orchestrator built again) stop writing, so they cannot
+# overwrite newer entries at exit.
+_OWNERS: Dict[Path, "TTLCache"] = {}
+
+
+def _save_all() -> None:
+    for cache in list(_OWNERS.values()):
+        cache.save()
+
+
+atexit.register(_save_all)
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after ``ttl`` seconds.
+
+    Expiry uses wall-clock time so that entries persisted to ``path`` keep
+    their remaining lifetime across restarts. Persisted keys and values must
+    be JSON serializable; keys are stored as strings. Only the newest cache
+    created for a ``path`` saves to it (periodically and at exit).
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 60.0,
+        path: Path | None = None,
+        save_interval: float = 30.0,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.time()
+        if self.path is not None:
+            self.load()
+            _OWNERS[self.path.resolve()] = self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is not None and hit[0] <= now:
+                del self._data[key]
+                self.expirations += 1
+                self._dirty = True
+                hit = None
+            if hit is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return hit[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+        if self.path is not None and time.time() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            hit = self._data.pop(key, None)
+            if hit is not None:
+                self._dirty = True
+        return default if hit is None else hit[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._dirty = True
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def load(self) -> None:
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            rows = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for key, expires, value in rows[-self.maxsize :]:
+                if expires > now:
+                    self._data[key] = (expires, value)
+
+    def save(self) -> None:
+        """Write unexpired entries to ``path`` if anything changed."""
+
+        if self.path is None or not self._dirty:
+            return
+        if _OWNERS.get(self.path.resolve()) is not self:
+            return
+        now = time.time()
+        with self._lock:
+            rows = [[k, exp, v] for k, (exp, v) in self._data.items() if exp > now]
+            self._dirty = False
+            self._saved_at = now
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps(rows, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+__all__ = ["TTLCache"]
@@ -0,0 +1,152 @@
+"""Token-budgeted selection of what goes into the core prompt."""
+from __future__ import annotations
+
+import hashlib
+import math
+from typing import Dict, List, Tuple
+
+import aiohttp
+
+from cache import TTLCache
+from core import client_timeout
+
+# ChatML wrapper around each block: "<|im_start|>role\n" ... "\n<|im_end|>\n".
+BLOCK_OVERHEAD = 5
+
+
+def approx_tokens(text: str) -> int:
+    """Cheap local token estimate (~3.5 UTF-8 bytes per token).
+
+    Counting bytes rather than characters keeps the estimate on the safe side
+    for non-Latin scripts, where a character is often a whole token.
+    """
+
+    return math.ceil(len(text.encode("utf-8")) / 3.5) if text else 0
+
+
+def trim_tokens(text: str, limit: int) -> str:
+    """The longest run of whole leading lines of ``text`` within ``limit`` tokens.
+
+    Uses :func:`approx_tokens`; a single line longer than ``limit`` is cut.
+    """
+
+    if approx_tokens(text) <= limit:
+        return text
+    kept: List[str] = []
+    used = 0
+    for line in text.splitlines(keepends=True):
+        n = approx_tokens(line)
+        if used + n > limit:
+            if not kept:
+                return line.encode("utf-8")[: int(limit * 3.5)].decode("utf-8", "ignore")
+            break
+        kept.append(line)
+        used += n
+    return "".join(kept).rstrip()
+
+
+class TokenCounter:
+    """Count tokens, caching the result per distinct text.
+
+    With ``base`` set, counts come from KoboldCPP's
+    ``/api/extra/tokencount`` endpoint and fall back to
+    :func:`approx_tokens` if the server cannot be reached.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession | None = None,
+        base: str | None = None,
+        maxsize: int = 8192,
+    ) -> None:
+        self.sess = session
+        self.base = base
+        self._cache = TTLCache(maxsize, ttl=24 * 3600)
+
+    async def _remote(self, text: str) -> int:
+        async with self.sess.post(
+            f"{self.base}/api/extra/tokencount", json={"prompt": text}, timeout=client_timeout(5)
+        ) as r:
+            r.raise_for_status()
+            js = await r.json()
+        return int(js["value"])
+
+    async def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        n = self._cache.get(key)
+        if n is None:
+            n = approx_tokens(text)
+            if self.base and self.sess is not None:
+                try:
+                    n = await self._remote(text)
+                except Exception:
+                    pass
+            self._cache.set(key, n)
+        return n
+
+
+class ContextBuilder:
+    """Fill a token budget by priority: fixed parts, summary, KB, newest turns."""
+
+    def __init__(self, counter: TokenCounter, budget: int) -> None:
+        self.counter = counter
+        self.budget = budget
+
+    async def fit(
+        self,
+        fixed: List[str],
+        summary: str,
+        kb: str,
+        history: List[Dict[str, str]],
+        reserve: int = 0,
+        min_turns: int = 0,
+    ) -> Tuple[str, str, int]:
+        """Return the summary and KB text that fit, and the first history index.
+
+        ``fixed`` (system prompt, shared memory, per-turn instructions, the
+        user message) and the newest ``min_turns`` turns are always included.
+        The summary is kept whole or dropped; KB facts are added line by line
+        in ranked order; then older turns are added newest first until the
+        budget runs out. ``reserve`` tokens are held back for the caller.
+        """
+
+        used = reserve
+        for text in fixed:
+            used += await self.counter.count(text) + BLOCK_OVERHEAD
+        start = max(len(history) - min_turns, 0)
+        for turn in history[start:]:
+            used += await self.counter.count(turn.get("content", "")) + BLOCK_OVERHEAD
+
+        if summary:
+            n = await self.counter.count(summary) + BLOCK_OVERHEAD
+            if used + n <= self.budget:
+                used += n
+            else:
+                summary = ""
+
+        facts: List[str] = []
+        for line in kb.splitlines() if kb else []:
+            n = await self.counter.count(line) + 1
+            if used + n > self.budget:
+                break
+            used += n
+            facts.append(line)
+
+        for i in range(start - 1, -1, -1):
+            n = await self.counter.count(history[i].get("content", "")) + BLOCK_OVERHEAD
+            if used + n > self.budget:
+                break
+            used += n
+            start = i
+        return summary, "\n".join(facts), start
+
+
+__all__ = [
+    "BLOCK_OVERHEAD",
+    "ContextBuilder",
+    "TokenCounter",
+    "approx_tokens",
+    "trim_tokens",
+]
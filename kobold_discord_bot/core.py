@@ -1,31 +1,46 @@
 """Shared utilities for Requiem AI bots and web UI."""
 from __future__ import annotations
 
+import asyncio
 import base64
 import json
 import os
-import re
 import threading
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, TypeVar
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from langdetect import detect, LangDetectException
-from deep_translator import GoogleTranslator
+from kb_index import KBIndex
+from metrics import timed
+from recall import RECALL, RecallIndex
+from storage import UserStore
+
+if TYPE_CHECKING:
+    import aiohttp
+
+T = TypeVar("T")
 
 # ---------------------------------------------------------------------------
 # Configuration
 # ---------------------------------------------------------------------------
 
-KOBOLD_URL = os.getenv("KOBOLD_URL", "http://localhost:5001").rstrip("/")
+def endpoint_list(value: str) -> List[str]:
+    """Split a comma-separated list of base URLs (see replicas.py)."""
+
+    return [u.strip().rstrip("/") for u in value.split(",") if u.strip()]
+
+
+# Model roles may list several replicas; the orchestrator balances across them.
+KOBOLD_URLS = endpoint_list(os.getenv("KOBOLD_URL", "http://127.0.0.1:5001"))
+INTENT_URLS = endpoint_list(os.getenv("INTENT_URL", "http://127.0.0.1:5002"))
+THOUGHTS_URLS = endpoint_list(os.getenv("THOUGHTS_URL", "http://127.0.0.1:5003"))
+KOBOLD_URL = KOBOLD_URLS[0]
 ASSIST_URL = os.getenv("KOBOLD_ASSIST_URL", "").rstrip("/")
 SD_URL = os.getenv("SD_URL", "http://localhost:7860").rstrip("/")
 
 BASE_DIR = Path(__file__).parent
 MEMORY_FILE = BASE_DIR / "memory.md"
 USER_MEMORY_FILE = BASE_DIR / "user_memory.json"
+USER_DB_PATH = Path(os.getenv("USER_DB_PATH", str(BASE_DIR / "user_memory.db")))
 MEM_EXPORT_PATH = Path(
     os.getenv("MEM_EXPORT_PATH", str(BASE_DIR / "Requiem_Memory_Export.md"))
 )
@@ -39,18 +54,25 @@ SYSTEM_PROMPT = (
 STOP_SEQ = ["<|im_end|>", "<|im_start|>user"]
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
 HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "60"))
-
-_LOCK = threading.Lock()
-_SEMAPHORE = threading.Semaphore(MAX_WORKERS)
-
-_SESSION = requests.Session()
-_ADAPTER = HTTPAdapter(
-    pool_connections=MAX_WORKERS,
-    pool_maxsize=MAX_WORKERS,
-    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504]),
-)
-_SESSION.mount("http://", _ADAPTER)
-_SESSION.mount("https://", _ADAPTER)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))
+
+# One aiohttp connection pool serves the orchestrator, the image queue and the
+# helpers below. Keep-alive connections are kept per host, up to HTTP_PER_HOST
+# (the scheduler decides how many of them are in use at once).
+HTTP_SESSION_TIMEOUT = float(os.getenv("HTTP_SESSION_TIMEOUT", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", str(max(16, 4 * MAX_WORKERS))))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "1"))
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+# langdetect and deep_translator are imported on first use so that starting
+# the bot stays fast (see startup.py). aiohttp is imported inside the helpers
+# below too, but only for scripts that use core alone: the bot, the web UI
+# and the modules they load import it at the top anyway.
+_HTTP: "aiohttp.ClientSession | None" = None
 
 # ---------------------------------------------------------------------------
 # Persistent storage helpers
@@ -77,52 +99,140 @@ def _load_go2_data() -> Dict[str, Any]:
     )
 
 
-GO2_DATA = _load_go2_data()
+# Loaded on first lookup (or by the startup warm-up), and swapped by reloader.py.
+GO2_DATA: Dict[str, Any] | None = None
+GO2_INDEX: KBIndex | None = None
+_GO2_LOCK = threading.Lock()
 
-if USER_MEMORY_FILE.exists():
-    USER_DATA: Dict[str, Any] = json.loads(USER_MEMORY_FILE.read_text(encoding="utf-8"))
-else:
-    USER_DATA = {}
 
+def go2_index() -> KBIndex:
+    global GO2_DATA, GO2_INDEX
+    index = GO2_INDEX
+    if index is None:
+        with _GO2_LOCK:
+            if GO2_INDEX is None:
+                data = _load_go2_data()
+                GO2_DATA, GO2_INDEX = data, KBIndex(data)
+            index = GO2_INDEX
+    return index
 
-def save_user_data() -> None:
-    with _LOCK:
-        USER_MEMORY_FILE.write_text(
-            json.dumps(USER_DATA, ensure_ascii=False, indent=2), encoding="utf-8"
-        )
+USER_STORE = UserStore(USER_DB_PATH, max_turns=200)
+USER_STORE.migrate_json(USER_MEMORY_FILE)
+# Older exchanges brought back into the prompt by relevance (see recall.py).
+USER_RECALL = RecallIndex(USER_STORE) if RECALL else None
 
 
 def get_user_entry(user_id: Any) -> Dict[str, Any]:
-    """Return user data, migrating legacy formats if needed."""
+    """Return a snapshot of the user's history, emotion, summary and prefs."""
+
+    with timed("store_read"):
+        return USER_STORE.get(str(user_id))
 
-    uid = str(user_id)
-    with _LOCK:
-        entry = USER_DATA.setdefault(uid, {"history": [], "emotion": "neutral", "summary": ""})
-    if isinstance(entry, list):
-        entry = {"history": entry, "emotion": "neutral", "summary": ""}
-        with _LOCK:
-            USER_DATA[uid] = entry
-    entry.setdefault("history", [])
-    entry.setdefault("emotion", "neutral")
-    entry.setdefault("summary", "")
-    return entry
+
+def forget_user(user_id: Any) -> None:
+    USER_STORE.delete(str(user_id))
+    if USER_RECALL is not None:
+        USER_RECALL.drop(str(user_id))
 
 
 def set_emotion(user_id: Any, emotion: str) -> None:
-    entry = get_user_entry(user_id)
-    with _LOCK:
-        entry["emotion"] = emotion
-    save_user_data()
+    with timed("store_write"):
+        USER_STORE.set_emotion(str(user_id), emotion)
+
+
+def set_pref(user_id: Any, key: str, value: str | None) -> None:
+    with timed("store_write"):
+        USER_STORE.set_pref(str(user_id), key, value)
 
 
 def update_memory(user_id: Any, user_msg: str, ai_msg: str) -> None:
-    entry = get_user_entry(user_id)
-    with _LOCK:
-        entry["history"].append({"role": "user", "content": user_msg})
-        entry["history"].append({"role": "assistant", "content": ai_msg})
-        if len(entry["history"]) > 200:
-            entry["history"] = entry["history"][-200:]
-    save_user_data()
+    uid = str(user_id)
+    with timed("store_write"):
+        ex_id = USER_STORE.append_exchange(uid, user_msg, ai_msg)
+    if USER_RECALL is not None:
+        USER_RECALL.add(uid, ex_id, user_msg, ai_msg)
+
+
+# ---------------------------------------------------------------------------
+# HTTP
+# ---------------------------------------------------------------------------
+
+def client_timeout(total: float | None = HTTP_TIMEOUT, **kwargs: float) -> "aiohttp.ClientTimeout":
+    """A request timeout with the shared connect limit (``HTTP_CONNECT_TIMEOUT``)."""
+
+    import aiohttp
+
+    kwargs.setdefault("connect", HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientTimeout(total=total, **kwargs)
+
+
+def client_session() -> "aiohttp.ClientSession":
+    """A new aiohttp session with the shared pool limits and timeouts."""
+
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=0, limit_per_host=HTTP_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE
+    )
+    return aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout(HTTP_SESSION_TIMEOUT)
+    )
+
+
+def http_session() -> "aiohttp.ClientSession":
+    """The process-wide session, created on first use in the running loop.
+
+    The bot and the web UI hand this to the orchestrator and image queue, so
+    everything shares one connection pool.
+    """
+
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = client_session()
+    return _HTTP
+
+
+async def apost_json(
+    url: str,
+    payload: Dict[str, Any],
+    timeout: float = HTTP_TIMEOUT,
+    session: "aiohttp.ClientSession | None" = None,
+) -> Dict[str, Any]:
+    """POST ``payload`` and return the JSON answer.
+
+    Connection failures and ``RETRY_STATUSES`` are retried up to
+    ``HTTP_RETRIES`` times, waiting ``HTTP_BACKOFF`` seconds and doubling.
+    Timeouts are not retried: the server may still be working on the request.
+    """
+
+    import aiohttp
+
+    sess = session or http_session()
+    attempt = 0
+    while True:
+        retry = attempt < HTTP_RETRIES
+        try:
+            async with sess.post(url, json=payload, timeout=client_timeout(timeout)) as r:
+                if not (retry and r.status in RETRY_STATUSES):
+                    r.raise_for_status()
+                    return await r.json(content_type=None)
+        except aiohttp.ServerTimeoutError:
+            raise
+        except aiohttp.ClientConnectionError:
+            if not retry:
+                raise
+        await asyncio.sleep(HTTP_BACKOFF * 2**attempt)
+        attempt += 1
+
+
+def _blocking(fn: Callable[..., Awaitable[T]], *args: Any) -> T:
+    """Run ``fn(*args, session=...)`` to completion from synchronous code."""
+
+    async def main() -> T:
+        async with client_session() as session:
+            return await fn(*args, session=session)
+
+    return asyncio.run(main())
 
 
 # ---------------------------------------------------------------------------
@@ -130,27 +240,19 @@ def update_memory(user_id: Any, user_msg: str, ai_msg: str) -> None:
 # ---------------------------------------------------------------------------
 
 def lookup_go2(message: str, max_items: int = 3) -> str:
-    """Return Galaxy Online 2 facts relevant to ``message``."""
+    """Return the Galaxy Online 2 facts most relevant to ``message``."""
 
-    if not GO2_DATA:
-        return ""
-    words = set(re.findall(r"\w+", message.lower()))
-    if not words:
-        return ""
-    hits: List[str] = []
-    for cat, items in GO2_DATA.items():
-        if not isinstance(items, dict):
-            continue
-        for name, info in items.items():
-            text = f"{name} {info}".lower()
-            if any(w in text for w in words):
-                hits.append(f"{name.title()} ({cat}): {info}")
-                if len(hits) >= max_items:
-                    return "\n".join(hits)
-    return "\n".join(hits)
+    with timed("lookup_go2"):
+        return "\n".join(go2_index().search(message, k=max_items))
 
 
-def assist_hint(user_message: str) -> str:
+def _generated_text(js: Dict[str, Any]) -> str:
+    return (js.get("results", [{}])[0].get("text") or "").strip()
+
+
+async def aassist_hint(
+    user_message: str, session: "aiohttp.ClientSession | None" = None
+) -> str:
     if not ASSIST_URL:
         return ""
     payload = {
@@ -164,16 +266,13 @@ def assist_hint(user_message: str) -> str:
         "top_p": 0.9,
         "stop_sequence": ["\n"],
     }
-    with _SEMAPHORE:
-        resp = _SESSION.post(
-            f"{ASSIST_URL}/api/v1/generate", json=payload, timeout=HTTP_TIMEOUT
-        )
-    resp.raise_for_status()
-    js = resp.json()
-    return (js.get("results", [{}])[0].get("text") or "").strip()
+    js = await apost_json(f"{ASSIST_URL}/api/v1/generate", payload, session=session)
+    return _generated_text(js)
 
 
-def generate_response(prompt: str) -> str:
+async def agenerate_response(
+    prompt: str, session: "aiohttp.ClientSession | None" = None
+) -> str:
     payload = {
         "prompt": prompt,
         "max_context_length": 2048,
@@ -182,16 +281,18 @@ def generate_response(prompt: str) -> str:
         "top_p": 0.9,
         "stop_sequence": ["\nUser:"],
     }
-    with _SEMAPHORE:
-        resp = _SESSION.post(
-            f"{KOBOLD_URL}/api/v1/generate", json=payload, timeout=HTTP_TIMEOUT
-        )
-    resp.raise_for_status()
-    js = resp.json()
-    return (js.get("results", [{}])[0].get("text") or "").strip()
-
-
-def txt2img(prompt: str, steps: int = 22, w: int = 640, h: int = 640, cfg: float = 7.0) -> bytes:
+    js = await apost_json(f"{KOBOLD_URL}/api/v1/generate", payload, session=session)
+    return _generated_text(js)
+
+
+async def atxt2img(
+    prompt: str,
+    steps: int = 22,
+    w: int = 640,
+    h: int = 640,
+    cfg: float = 7.0,
+    session: "aiohttp.ClientSession | None" = None,
+) -> bytes:
     payload = {
         "prompt": prompt,
         "steps": steps,
@@ -200,13 +301,22 @@ def txt2img(prompt: str, steps: int = 22, w: int = 640, h: int = 640, cfg: float
         "cfg_scale": cfg,
         "sampler_name": "Euler a",
     }
-    with _SEMAPHORE:
-        resp = _SESSION.post(
-            f"{SD_URL}/sdapi/v1/txt2img", json=payload, timeout=HTTP_TIMEOUT
-        )
-    resp.raise_for_status()
-    b64 = resp.json()["images"][0]
-    return base64.b64decode(b64)
+    js = await apost_json(f"{SD_URL}/sdapi/v1/txt2img", payload, session=session)
+    return base64.b64decode(js["images"][0])
+
+
+# Blocking versions for scripts; inside the bot or web UI await the ones above.
+
+def assist_hint(user_message: str) -> str:
+    return _blocking(aassist_hint, user_message)
+
+
+def generate_response(prompt: str) -> str:
+    return _blocking(agenerate_response, prompt)
+
+
+def txt2img(prompt: str, steps: int = 22, w: int = 640, h: int = 640, cfg: float = 7.0) -> bytes:
+    return _blocking(atxt2img, prompt, steps, w, h, cfg)
 
 
 # ---------------------------------------------------------------------------
@@ -214,6 +324,9 @@ def txt2img(prompt: str, steps: int = 22, w: int = 640, h: int = 640, cfg: float
 # ---------------------------------------------------------------------------
 
 def detect_language(text: str) -> str:
+    # The first call also loads langdetect's language profiles (slow).
+    from langdetect import LangDetectException, detect
+
     try:
         return detect(text)
     except LangDetectException:  # pragma: no cover - nondeterministic
@@ -224,6 +337,8 @@ def translate_text(text: str, src: str, dest: str) -> str:
     if src == dest:
         return text
     try:
+        from deep_translator import GoogleTranslator
+
         return GoogleTranslator(source=src, target=dest).translate(text)
     except Exception:
         return text
@@ -233,16 +348,28 @@ __all__ = [
     "MAX_WORKERS",
     "MEM_EXPORT_PATH",
     "MEMORY_FILE",
-    "USER_DATA",
+    "USER_RECALL",
+    "USER_STORE",
+    "STREAM_EDIT_INTERVAL",
+    "STREAM_REPLIES",
     "SYSTEM_PROMPT",
+    "aassist_hint",
+    "agenerate_response",
+    "apost_json",
     "assist_hint",
+    "atxt2img",
+    "client_session",
+    "client_timeout",
     "detect_language",
+    "forget_user",
     "generate_response",
     "get_user_entry",
+    "go2_index",
+    "http_session",
     "lookup_go2",
     "reload_global_memory",
-    "save_user_data",
     "set_emotion",
+    "set_pref",
     "translate_text",
     "txt2img",
     "update_memory",
@@ -0,0 +1,118 @@
+"""Load-aware degradation of the optional orchestration stages.
+
+Under a spike every message still paying for plan, emotion and a coherence
+retry only makes the queues grow. :class:`DegradationLadder` turns queue
+depth and core-model latency into a level, and the orchestrator skips stages
+accordingly:
+
+==========  ====================================================
+level       skipped
+==========  ====================================================
+full        nothing
+no_retry    coherence check and core regeneration
+no_emotion  the above, and the emotion call (plan tone is used)
+no_plan     the above, and the planner (:data:`DEFAULT_PLAN`)
+==========  ====================================================
+
+The level rises as soon as pressure crosses a threshold and falls one step
+at a time, only after it has been held for ``DEGRADE_HOLD`` seconds and
+pressure is well below the threshold, so it does not flap. The ladder is
+off unless ``DEGRADE=1``.
+"""
+from __future__ import annotations
+
+import os
+import time
+from typing import Callable, Sequence, Tuple
+
+from metrics import METRICS
+from scheduler import Scheduler
+
+# Opt-in: when on, replies may silently skip stages (including the coherence
+# check) for every user while the backends are slow.
+DEGRADE = os.getenv("DEGRADE", "0") == "1"
+# Waiting requests per backend slot at which each level starts.
+DEGRADE_QUEUE: Tuple[float, ...] = tuple(
+    float(x) for x in os.getenv("DEGRADE_QUEUE", "1,2,4").split(",") if x.strip()
+)
+# Core-model latency (seconds, smoothed) that counts as one queue unit of
+# pressure; 0 disables the latency signal.
+DEGRADE_LATENCY = float(os.getenv("DEGRADE_LATENCY", "30"))
+DEGRADE_HOLD = float(os.getenv("DEGRADE_HOLD", "15"))
+# Step down only once pressure is below this fraction of the level's threshold.
+RECOVER_RATIO = 0.5
+
+LEVELS = ("full", "no_retry", "no_emotion", "no_plan")
+FULL, NO_RETRY, NO_EMOTION, NO_PLAN = range(len(LEVELS))
+
+DEGRADED_REQUESTS = METRICS.counter(
+    "requiem_degrade_requests_total", "Requests served per degradation level"
+)
+DEGRADE_CHANGES = METRICS.counter(
+    "requiem_degrade_changes_total", "Degradation level changes, by new level"
+)
+
+
+class DegradationLadder:
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        latency: Callable[[], float],
+        thresholds: Sequence[float] = DEGRADE_QUEUE,
+        latency_target: float = DEGRADE_LATENCY,
+        hold: float = DEGRADE_HOLD,
+        backends: Sequence[str] = ("intent", "thoughts", "core"),
+    ) -> None:
+        self.scheduler = scheduler
+        self.latency = latency
+        self.thresholds = tuple(sorted(thresholds))[: len(LEVELS) - 1]
+        self.latency_target = latency_target
+        self.hold = hold
+        self.backends = backends
+        self.current = FULL
+        self._changed = time.monotonic()
+
+    def pressure(self) -> float:
+        """Worst of queued requests per slot and smoothed core latency / target."""
+
+        queues = self.scheduler.queues
+        p = max(
+            (queues[b].queued / queues[b].capacity for b in self.backends if b in queues),
+            default=0.0,
+        )
+        if self.latency_target > 0:
+            p = max(p, self.latency() / self.latency_target)
+        return p
+
+    def level(self) -> int:
+        """Re-evaluate and return the level to serve the next request at."""
+
+        p = self.pressure()
+        target = sum(1 for t in self.thresholds if p >= t)
+        now = time.monotonic()
+        if target > self.current:
+            self._set(target, now)
+        elif (
+            target < self.current
+            and now - self._changed >= self.hold
+            and p < self.thresholds[self.current - 1] * RECOVER_RATIO
+        ):
+            self._set(self.current - 1, now)
+        return self.current
+
+    def _set(self, level: int, now: float) -> None:
+        self.current = level
+        self._changed = now
+        DEGRADE_CHANGES.inc(level=LEVELS[level])
+
+
+__all__ = [
+    "DEGRADE",
+    "DEGRADED_REQUESTS",
+    "FULL",
+    "LEVELS",
+    "NO_EMOTION",
+    "NO_PLAN",
+    "NO_RETRY",
+    "DegradationLadder",
+]
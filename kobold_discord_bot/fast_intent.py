@@ -0,0 +1,378 @@
+"""Local intent classifier that answers obvious messages without the intent model.
+
+Two layers run in-process before :meth:`orchestrator.Orchestrator.classify`
+calls the intent model:
+
+* regex rules for unambiguous social and image requests ("hi", "thanks",
+  "draw me a cat"), and
+* a multinomial naive Bayes model trained on the intent model's own past
+  answers, loaded from ``FAST_INTENT_MODEL``.
+
+Collecting training data is opt-in: with ``FAST_INTENT_LOG`` set,
+:meth:`FastIntent.record` appends each message the intent model classified
+(in plain text) to that file, along with rule hits (marked ``"source":
+"rule"`` and never used for training). A ``FAST_INTENT_AUDIT`` share of rule
+hits is sent to the intent model anyway, so ``eval`` can measure how often
+the rules agree with it. The file is which is rotated to ``<log>.1`` once it passes
+``FAST_INTENT_LOG_MAX_BYTES``. Nothing is fitted at import; train a model
+offline and the next start picks it up.
+
+A local answer is used only when its confidence reaches
+``FAST_INTENT_THRESHOLD``; anything else, and every intent whose flags matter
+(admin, moderation, config, memory), still goes to the model.
+
+Usage: ``python fast_intent.py train`` fits the model from the log(s) and saves
+it to ``FAST_INTENT_MODEL``; ``python fast_intent.py eval`` reports, per
+threshold, the share of logged messages answered locally and how often the
+local answer agreed with the model (cross-validated).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+from core import BASE_DIR
+from kb_index import tokenize
+from metrics import METRICS
+
+FAST_INTENT = os.getenv("FAST_INTENT", "1") != "0"
+FAST_INTENT_THRESHOLD = float(os.getenv("FAST_INTENT_THRESHOLD", "0.95"))
+FAST_INTENT_LOG = os.getenv("FAST_INTENT_LOG", "")
+FAST_INTENT_LOG_MAX_BYTES = int(os.getenv("FAST_INTENT_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+# Where ``train``/``eval`` look when FAST_INTENT_LOG is not set.
+DEFAULT_LOG = BASE_DIR / "intent_log.jsonl"
+FAST_INTENT_MODEL = os.getenv("FAST_INTENT_MODEL", str(BASE_DIR / "intent_model.json"))
+# The model is only trusted once it has seen this many logged examples.
+FAST_INTENT_MIN_SAMPLES = int(os.getenv("FAST_INTENT_MIN_SAMPLES", "200"))
+# Logged model answers below this confidence are not used for training.
+TRAIN_MIN_CONFIDENCE = 0.7
+# Share of rule hits still sent to the intent model (only while logging), so
+# the log holds model labels to check the rules against.
+FAST_INTENT_AUDIT = float(os.getenv("FAST_INTENT_AUDIT", "0.05"))
+
+# Intents the local model may return; the rest carry flags only the LLM sets.
+LOCAL_INTENTS = frozenset({"greeting", "question", "instruction", "image", "other"})
+
+RULE_CONFIDENCE = 0.97
+
+_SOCIAL = (
+    r"(hi|hii+|hello|hey+|heya|hiya|yo|howdy|greetings|sup|gm|gn|"
+    r"good (morning|afternoon|evening|night)|"
+    r"thanks|thank you|thank u|thx|ty|tysm|cheers|appreciate it|"
+    r"bye|goodbye|see (you|ya)|later|cya)"
+)
+RULES: List[Tuple[str, re.Pattern[str]]] = [
+    (
+        "greeting",
+        re.compile(
+            rf"^\s*{_SOCIAL}( (there|again|so much|a lot|all|everyone|guys|requiem))*"
+            r"[\s!.,~:)(<3^_-]*$",
+            re.I,
+        ),
+    ),
+    (
+        "image",
+        re.compile(
+            r"^\s*(please |pls |can you |could you )?"
+            # Bare verbs need something to draw: "draw me a cat", not
+            # "draw up a plan", "paint the town red" or "draw conclusions".
+            r"((draw|paint|sketch|illustrate) (me |us )?(an? |the |some |my )"
+            r"(?!(town|line|conclusions?|blank)\b)\w+|"
+            r"(generate|make|create|render|show) (me )?(an? |some )?"
+            r"(image|picture|pic|drawing|painting|portrait|wallpaper|render)s?)\b",
+            re.I,
+        ),
+    ),
+]
+
+FAST_INTENT_TOTAL = METRICS.counter(
+    "requiem_fast_intent_total", "Intent classifications by source (rule, model, llm)"
+)
+
+
+def _as_intent(intent: str, confidence: float) -> Dict[str, Any]:
+    return {
+        "intent": intent,
+        "confidence": round(confidence, 3),
+        "flags": {"needs_image": intent == "image", "needs_admin": False, "risky": False},
+    }
+
+
+def features(text: str) -> List[str]:
+    """Word tokens plus a few shape features the intent depends on."""
+
+    words = tokenize(text)
+    out = words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+    if words:
+        out.append(f"^{words[0]}")
+    if text.rstrip().endswith("?"):
+        out.append("<q>")
+    out.append(f"<len{min(len(words), 20) // 5}>")
+    return out
+
+
+class NaiveBayes:
+    """Multinomial naive Bayes with add-``alpha`` smoothing."""
+
+    def __init__(self, alpha: float = 0.5) -> None:
+        self.alpha = alpha
+        self.docs: Dict[str, int] = {}
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.totals: Dict[str, int] = {}
+        self.vocab: set[str] = set()
+
+    def __len__(self) -> int:
+        return sum(self.docs.values())
+
+    def fit(self, samples: Iterable[Tuple[str, str]]) -> "NaiveBayes":
+        docs: Counter[str] = Counter()
+        counts: Dict[str, Counter[str]] = defaultdict(Counter)
+        for text, label in samples:
+            docs[label] += 1
+            counts[label].update(features(text))
+        self.docs = dict(docs)
+        self.counts = {label: dict(c) for label, c in counts.items()}
+        self.totals = {label: sum(c.values()) for label, c in counts.items()}
+        self.vocab = {f for c in counts.values() for f in c}
+        return self
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        if not self.docs:
+            return {}
+        feats = [f for f in features(text) if f in self.vocab]
+        n = len(self)
+        v = len(self.vocab)
+        scores = {}
+        for label, docs in self.docs.items():
+            counts = self.counts[label]
+            denom = self.totals[label] + self.alpha * v
+            score = math.log(docs / n)
+            for f in feats:
+                score += math.log((counts.get(f, 0) + self.alpha) / denom)
+            scores[label] = score
+        top = max(scores.values())
+        exp = {label: math.exp(s - top) for label, s in scores.items()}
+        z = sum(exp.values())
+        return {label: e / z for label, e in exp.items()}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"alpha": self.alpha, "docs": self.docs, "counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "NaiveBayes":
+        model = cls(data.get("alpha", 0.5))
+        model.docs = {k: int(v) for k, v in data["docs"].items()}
+        model.counts = {k: dict(v) for k, v in data["counts"].items()}
+        model.totals = {k: sum(v.values()) for k, v in model.counts.items()}
+        model.vocab = {f for c in model.counts.values() for f in c}
+        return model
+
+
+def load_log(path: str | Path, min_confidence: float = TRAIN_MIN_CONFIDENCE) -> List[Tuple[str, str]]:
+    """Return ``(text, intent)`` pairs from a classification log and its rotated copy."""
+
+    samples: List[Tuple[str, str]] = []
+    for name in (f"{path}.1", str(path)):
+        try:
+            with open(name, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if rec.get("source", "llm") != "llm":
+                        continue
+                    if float(rec.get("confidence", 0)) >= min_confidence and rec.get("text"):
+                        samples.append((rec["text"], str(rec.get("intent", "other"))))
+        except FileNotFoundError:
+            pass
+    return samples
+
+
+class FastIntent:
+    """Rules first, then the naive Bayes model, then give up (``None``)."""
+
+    def __init__(
+        self,
+        model: NaiveBayes | None = None,
+        threshold: float = FAST_INTENT_THRESHOLD,
+        log_path: str | Path | None = None,
+    ) -> None:
+        self.model = model if model is not None and len(model) >= FAST_INTENT_MIN_SAMPLES else None
+        self.threshold = threshold
+        self.log_path = Path(log_path) if log_path else None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FastIntent":
+        """Rules plus the pre-trained ``FAST_INTENT_MODEL``, if there is one."""
+
+        model = None
+        if Path(FAST_INTENT_MODEL).exists():
+            with open(FAST_INTENT_MODEL, encoding="utf-8") as f:
+                model = NaiveBayes.from_dict(json.load(f))
+        return cls(model, FAST_INTENT_THRESHOLD, FAST_INTENT_LOG or None)
+
+    @staticmethod
+    def rule(text: str) -> Dict[str, Any] | None:
+        for intent, pattern in RULES:
+            if pattern.search(text):
+                return _as_intent(intent, RULE_CONFIDENCE)
+        return None
+
+    def predict(self, text: str) -> Dict[str, Any] | None:
+        """Return intent JSON if confident enough, else ``None``."""
+
+        js = self.rule(text)
+        if js is not None:
+            if self.log_path is not None and random.random() < FAST_INTENT_AUDIT:
+                # Let the intent model answer; its label is logged by record().
+                FAST_INTENT_TOTAL.inc(source="audit")
+                return None
+            FAST_INTENT_TOTAL.inc(source="rule")
+            self.record(text, js, source="rule")
+            return js
+        if self.model is not None:
+            proba = self.model.predict_proba(text)
+            intent, p = max(proba.items(), key=lambda kv: kv[1])
+            if p >= self.threshold and intent in LOCAL_INTENTS:
+                FAST_INTENT_TOTAL.inc(source="model")
+                return _as_intent(intent, p)
+        FAST_INTENT_TOTAL.inc(source="llm")
+        return None
+
+    def record(self, text: str, js: Dict[str, Any], source: str = "llm") -> None:
+        """Append a classification to the log (if enabled).
+
+        Only the intent model's answers (``source="llm"``) are used for
+        training; rule hits are logged so their volume shows up too.
+        """
+
+        if self.log_path is None:
+            return
+        rec = {
+            "text": text,
+            "intent": js.get("intent"),
+            "confidence": js.get("confidence"),
+            "source": source,
+        }
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            try:
+                if (
+                    self.log_path.exists()
+                    and self.log_path.stat().st_size >= FAST_INTENT_LOG_MAX_BYTES
+                ):
+                    os.replace(self.log_path, f"{self.log_path}.1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                self.log_path = None
+
+
+def evaluate(
+    samples: List[Tuple[str, str]], thresholds: Iterable[float], folds: int = 5, seed: int = 0
+) -> List[Dict[str, float]]:
+    """Cross-validated coverage and precision of the local answers per threshold.
+
+    Precision is agreement with the logged intent-model label, for the
+    messages that would have been answered locally.
+    """
+
+    samples = list(samples)
+    random.Random(seed).shuffle(samples)
+    thresholds = sorted(thresholds)
+    answered = {t: 0 for t in thresholds}
+    correct = {t: 0 for t in thresholds}
+    for k in range(folds):
+        test = samples[k::folds]
+        train = [s for i, s in enumerate(samples) if i % folds != k]
+        model = NaiveBayes().fit(train)
+        for text, label in test:
+            js = FastIntent.rule(text)
+            if js is not None:
+                intent, p = js["intent"], 1.0
+            else:
+                proba = model.predict_proba(text)
+                intent, p = max(proba.items(), key=lambda kv: kv[1]) if proba else ("", 0.0)
+                if intent not in LOCAL_INTENTS:
+                    continue
+            for t in thresholds:
+                if p >= t:
+                    answered[t] += 1
+                    correct[t] += intent == label
+    n = len(samples) or 1
+    return [
+        {
+            "threshold": t,
+            "coverage": answered[t] / n,
+            "precision": correct[t] / answered[t] if answered[t] else 0.0,
+        }
+        for t in thresholds
+    ]
+
+
+def rule_agreement(samples: Iterable[Tuple[str, str]]) -> Dict[str, Tuple[int, int]]:
+    """Per rule intent: ``(hits, hits the intent model agreed with)``.
+
+    Logged model labels exist for rule hits only through ``FAST_INTENT_AUDIT``.
+    """
+
+    out: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    for text, label in samples:
+        js = FastIntent.rule(text)
+        if js is not None:
+            out[js["intent"]][0] += 1
+            out[js["intent"]][1] += js["intent"] == label
+    return {k: (v[0], v[1]) for k, v in out.items()}
+
+
+CLASSIFIER = FastIntent.from_env() if FAST_INTENT else None
+
+__all__ = [
+    "CLASSIFIER",
+    "FAST_INTENT",
+    "FastIntent",
+    "NaiveBayes",
+    "evaluate",
+    "load_log",
+    "rule_agreement",
+]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("command", choices=("train", "eval"))
+    ap.add_argument("--log", default=FAST_INTENT_LOG or str(DEFAULT_LOG))
+    ap.add_argument("--out", default=FAST_INTENT_MODEL)
+    ap.add_argument("--folds", type=int, default=5)
+    args = ap.parse_args()
+    samples = load_log(args.log)
+    if not samples:
+        raise SystemExit(f"no usable classifications in {args.log}")
+    if args.command == "train":
+        model = NaiveBayes().fit(samples)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(model.to_dict(), f)
+        print(f"trained on {len(samples)} examples ({dict(Counter(l for _, l in samples))}) -> {args.out}")
+        return
+    print(f"{len(samples)} examples, {args.folds}-fold cross-validation")
+    print(f"{'threshold':>9} {'coverage':>9} {'precision':>9}")
+    for row in evaluate(samples, (0.5, 0.7, 0.8, 0.9, 0.95, 0.98, 0.99), args.folds):
+        mark = " <" if row["threshold"] == FAST_INTENT_THRESHOLD else ""
+        print(f"{row['threshold']:>9.2f} {row['coverage']:>9.1%} {row['precision']:>9.1%}{mark}")
+    for intent, (hits, agreed) in sorted(rule_agreement(samples).items()):
+        print(f"rule {intent}: {hits} audited hits, {agreed / hits:.1%} agree with the model")
+
+
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,247 @@
+"""Asynchronous Stable Diffusion jobs with a content-addressed result cache.
+
+:meth:`ImageQueue.submit` returns an :class:`ImageJob` at once; the render
+runs in the background under the scheduler's ``sd`` slots, so chat never
+waits behind it, and its progress is polled from AUTOMATIC1111. Identical
+requests (prompt, steps, size, cfg) share one job while it runs and are
+answered from the cache afterwards. Finished PNGs are stored once under
+``IMAGE_CACHE_DIR`` by the SHA-256 of their bytes, which also serves as the
+image's URL and ETag in the web UI.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Hashable
+
+import aiohttp
+
+from cache import TTLCache
+from core import BASE_DIR, SD_URL, apost_json, client_timeout
+from metrics import timed
+from scheduler import SCHEDULER, Scheduler
+
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", str(BASE_DIR / "image_cache")))
+IMAGE_CACHE_MAX = int(os.getenv("IMAGE_CACHE_MAX", "500"))
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", str(30 * 86400)))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "300"))
+IMAGE_PROGRESS_INTERVAL = float(os.getenv("IMAGE_PROGRESS_INTERVAL", "1.0"))
+# Finished jobs are kept this long for polling.
+MAX_JOBS = 256
+
+# Same defaults as core.atxt2img.
+DEFAULT_PARAMS: Dict[str, Any] = {
+    "steps": 22,
+    "width": 640,
+    "height": 640,
+    "cfg_scale": 7.0,
+    "sampler_name": "Euler a",
+}
+
+
+@dataclass
+class ImageJob:
+    id: str
+    key: str
+    prompt: str
+    params: Dict[str, Any]
+    status: str = "queued"  # queued | running | done | error
+    progress: float = 0.0
+    digest: str = ""
+    error: str = ""
+    cached: bool = False
+    created: float = field(default_factory=time.time)
+    finished: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def url(self) -> str:
+        return f"/img/{self.digest}.png" if self.digest else ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "id": self.id,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "cached": self.cached,
+        }
+        if self.digest:
+            out["url"] = self.url
+        if self.error:
+            out["error"] = self.error
+        return out
+
+
+def request_key(prompt: str, params: Dict[str, Any]) -> str:
+    data = json.dumps({"prompt": prompt.strip(), **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ImageStore:
+    """PNG files named by their SHA-256, plus a request-key index.
+
+    At most ``max_files`` images are kept; the least recently written are
+    removed first.
+    """
+
+    def __init__(self, root: Path, max_files: int = IMAGE_CACHE_MAX, ttl: float = IMAGE_CACHE_TTL) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_files = max_files
+        # Image files deleted by _prune.
+        self.evictions = 0
+        self.index = TTLCache(max(max_files, 1) * 2, ttl, self.root / "index.json")
+
+    def path(self, digest: str) -> Path:
+        return self.root / f"{digest}.png"
+
+    def lookup(self, key: str) -> str | None:
+        digest = self.index.get(key)
+        if digest is not None and not self.path(digest).exists():
+            self.index.pop(key)
+            return None
+        return digest
+
+    def put(self, key: str, png: bytes) -> str:
+        digest = hashlib.sha256(png).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(png)
+            os.replace(tmp, path)
+            self._prune()
+        self.index.set(key, digest)
+        return digest
+
+    def _prune(self) -> None:
+        files = sorted(self.root.glob("*.png"), key=lambda p: p.stat().st_mtime)
+        for old in files[: max(len(files) - self.max_files, 0)]:
+            try:
+                old.unlink()
+            except FileNotFoundError:
+                # Already removed by the other process.
+                continue
+            self.evictions += 1
+
+
+class ImageQueue:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        store: ImageStore | None = None,
+        scheduler: Scheduler = SCHEDULER,
+        base: str = SD_URL,
+    ) -> None:
+        self.sess = session
+        self.store = store if store is not None else ImageStore(IMAGE_CACHE_DIR)
+        self.scheduler = scheduler
+        self.base = base
+        self.jobs: OrderedDict[str, ImageJob] = OrderedDict()
+        self._running: Dict[str, ImageJob] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.deduped = 0
+
+    def submit(self, prompt: str, user: Hashable = None, **params: Any) -> ImageJob:
+        """Start (or join) a render of ``prompt`` and return its job."""
+
+        params = {**DEFAULT_PARAMS, **params}
+        key = request_key(prompt, params)
+        running = self._running.get(key)
+        if running is not None:
+            self.deduped += 1
+            return running
+        job = ImageJob(secrets.token_hex(8), key, prompt, params)
+        self._remember(job)
+        digest = self.store.lookup(key)
+        if digest is not None:
+            self.hits += 1
+            job.status, job.progress, job.digest, job.cached = "done", 1.0, digest, True
+            job.finished.set()
+            return job
+        self.misses += 1
+        self._running[key] = job
+        task = asyncio.ensure_future(self._run(job, user))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, job_id: str) -> ImageJob | None:
+        return self.jobs.get(job_id)
+
+    async def wait(self, job: ImageJob, timeout: float | None = IMAGE_TIMEOUT) -> ImageJob:
+        await asyncio.wait_for(job.finished.wait(), timeout)
+        return job
+
+    def _remember(self, job: ImageJob) -> None:
+        self.jobs[job.id] = job
+        while len(self.jobs) > MAX_JOBS:
+            self.jobs.popitem(last=False)
+
+    async def _run(self, job: ImageJob, user: Hashable) -> None:
+        try:
+            async with self.scheduler.slot("sd", user):
+                job.status = "running"
+                poller = asyncio.ensure_future(self._poll_progress(job))
+                try:
+                    with timed("image"):
+                        png = await self._txt2img(job)
+                finally:
+                    poller.cancel()
+            job.digest = await asyncio.to_thread(self.store.put, job.key, png)
+            job.status, job.progress = "done", 1.0
+        except Exception as exc:
+            job.status, job.error = "error", str(exc) or type(exc).__name__
+        finally:
+            self._running.pop(job.key, None)
+            job.finished.set()
+
+    async def _txt2img(self, job: ImageJob) -> bytes:
+        payload = {"prompt": job.prompt, **job.params}
+        js = await apost_json(
+            f"{self.base}/sdapi/v1/txt2img", payload, IMAGE_TIMEOUT, session=self.sess
+        )
+        return base64.b64decode(js["images"][0])
+
+    async def _poll_progress(self, job: ImageJob) -> None:
+        # A1111 reports the progress of whatever it is rendering; with one
+        # ``sd`` slot (the default) that is this job.
+        while True:
+            await asyncio.sleep(IMAGE_PROGRESS_INTERVAL)
+            try:
+                async with self.sess.get(
+                    f"{self.base}/sdapi/v1/progress",
+                    params={"skip_current_image": "true"},
+                    timeout=client_timeout(5),
+                ) as r:
+                    if r.status != 200:
+                        continue
+                    js = await r.json()
+                job.progress = max(job.progress, min(float(js.get("progress") or 0.0), 0.99))
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                continue
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.store.index),
+            "maxsize": self.store.max_files,
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduped": self.deduped,
+            "evictions": self.store.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+__all__ = ["DEFAULT_PARAMS", "ImageJob", "ImageQueue", "ImageStore", "request_key"]
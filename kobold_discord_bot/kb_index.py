@@ -0,0 +1,119 @@
+"""Ranked retrieval over the Galaxy Online 2 knowledge base.
+
+The index is built once when ``go2_data.json`` is loaded. Lookups score only
+the entries that share a term with the query (BM25), so their cost depends on
+the query rather than on the size of the knowledge base.
+"""
+from __future__ import annotations
+
+import heapq
+import math
+import os
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Tuple
+
+_WORD_RE = re.compile(r"\w+")
+
+# BM25 parameters; the usual defaults work well for short fact entries.
+K1 = 1.2
+B = 0.75
+# Query terms without an exact match are expanded to at most this many
+# indexed terms that start with them ("dread" -> "dreadnought").
+MAX_PREFIX_EXPANSION = 8
+# Facts scoring below this are not returned, so small talk that only shares a
+# stray word with the knowledge base is not answered as if it were grounded.
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE", "0.5"))
+
+# Function words and chat filler ignored in queries, in the form
+# :func:`tokenize` returns them ("this" -> "thi"). They are not removed by
+# :func:`tokenize` itself because the intent classifier and recall rely on
+# them ("how", "what", "you").
+STOP_WORDS = frozenset(
+    """
+    a about after again all also am an and any are as at be because been
+    but by can could did do doe for from get got had has have he her here
+    hey hi him his how i if in into is it its just know let like me more
+    most my no not now of off ok okay on once only or other our out over
+    please really so some tell than thank that the their them then there
+    these they thi those to too up us very want was we well were what when
+    where which who why will with would yeah yes you your
+    """.split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case word tokens with a naive plural fold ("ships" -> "ship")."""
+
+    out = []
+    for word in _WORD_RE.findall(text.lower()):
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        out.append(word)
+    return out
+
+
+class KBIndex:
+    """Inverted index with BM25 scoring over ``{category: {name: info}}``."""
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.facts: List[str] = []
+        lengths: List[int] = []
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for cat, items in data.items():
+            if not isinstance(items, dict):
+                continue
+            for name, info in items.items():
+                doc = len(self.facts)
+                self.facts.append(f"{name.title()} ({cat}): {info}")
+                # The entry name counts twice so that naming an item directly
+                # outranks entries that only mention it in passing.
+                terms = tokenize(name) * 2 + tokenize(str(info)) + tokenize(cat)
+                lengths.append(len(terms))
+                for term, tf in Counter(terms).items():
+                    postings[term].append((doc, tf))
+        n = len(self.facts)
+        avgdl = (sum(lengths) / n) if n else 1.0
+        self._norm = [K1 * (1 - B + B * dl / avgdl) for dl in lengths]
+        self._idf = {
+            term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for term, p in postings.items()
+        }
+        self._postings = dict(postings)
+        self._vocab = sorted(self._postings)
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def _expand(self, term: str) -> List[str]:
+        if term in self._postings:
+            return [term]
+        if len(term) < 3:
+            return []
+        out = []
+        i = bisect_left(self._vocab, term)
+        while i < len(self._vocab) and self._vocab[i].startswith(term):
+            out.append(self._vocab[i])
+            if len(out) >= MAX_PREFIX_EXPANSION:
+                break
+            i += 1
+        return out
+
+    def search(self, query: str, k: int = 3, min_score: float = KB_MIN_SCORE) -> List[str]:
+        """Return up to ``k`` facts scoring at least ``min_score``, best first.
+
+        Stop-words in ``query`` are ignored.
+        """
+
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)) - STOP_WORDS:
+            for t in self._expand(term):
+                idf = self._idf[t]
+                for doc, tf in self._postings[t]:
+                    scores[doc] += idf * tf * (K1 + 1) / (tf + self._norm[doc])
+        best = heapq.nlargest(k, scores.items(), key=lambda kv: (kv[1], -kv[0]))
+        return [self.facts[doc] for doc, score in best if score >= min_score]
+
+
+__all__ = ["KB_MIN_SCORE", "KBIndex", "STOP_WORDS", "tokenize"]
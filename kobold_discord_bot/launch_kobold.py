@@ -1,59 +1,344 @@
-"""Helper to launch KoboldCPP engines for Requiem.
+"""Launch and supervise the KoboldCPP engines for Requiem.
 
+Each configured role is started once:
 
-This script spawns the primary KoboldCPP model along with optional
-smaller models used for intent classification and planning. All models
-are launched on CUDA via the `koboldcpp` command.
+- ``core`` – ``MAIN_MODEL`` on ``KOBOLD_PORT`` (always);
+- ``intent`` – ``INTENT_MODEL`` on ``INTENT_PORT`` (if set);
+- ``thoughts`` – ``THOUGHTS_MODEL`` on ``THOUGHTS_PORT`` (if set);
+- ``assist`` – ``ASSIST_MODEL`` on ``ASSIST_PORT`` (if set), the helper
+  behind ``KOBOLD_ASSIST_URL``.
 
-This script spawns one primary KoboldCPP process and, optionally, a
-secondary process used for emotional hinting. It expects the `koboldcpp`
-command to be available in the environment.
+The supervisor polls each server's ``/api/v1/model`` until it answers, then
+sends ``WARMUP_ROUNDS`` short generations so the CUDA kernels are loaded and
+the core model's KV cache already holds the system prompt. A process that
+exits is restarted after a backoff that doubles on every crash in a row
+(``RESTART_BACKOFF`` up to ``RESTART_BACKOFF_MAX`` seconds). SIGINT and
+SIGTERM stop every engine, first politely and then by force after
+``STOP_TIMEOUT`` seconds.
 
+Progress is written to ``SUPERVISOR_STATE`` (JSON, refreshed every few
+seconds). The bot and the web UI call :func:`wait_ready` at startup, which
+waits for ``"status": "ready"`` while a supervisor is running and returns at
+once when none is.
 """
 
 from __future__ import annotations
 
+import asyncio
+import json
 import os
-import subprocess
+import shlex
+import signal
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List
 
+import aiohttp
 
-def launch(model: str, port: int) -> subprocess.Popen:
-    cmd = [
-        "koboldcpp",
-        "--model",
-        model,
-        "--port",
-        str(port),
-        "--usecublas",
+BASE_DIR = Path(__file__).parent
+SUPERVISOR_STATE = Path(os.getenv("SUPERVISOR_STATE", str(BASE_DIR / "supervisor_state.json")))
+KOBOLD_CMD = shlex.split(os.getenv("KOBOLD_CMD", "koboldcpp"))
+KOBOLD_ARGS = shlex.split(os.getenv("KOBOLD_ARGS", "--usecublas"))
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "900"))
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "2"))
+RESTART_BACKOFF = float(os.getenv("RESTART_BACKOFF", "2"))
+RESTART_BACKOFF_MAX = float(os.getenv("RESTART_BACKOFF_MAX", "120"))
+STOP_TIMEOUT = float(os.getenv("STOP_TIMEOUT", "20"))
+# How long the bot and web UI wait for the models (see wait_ready).
+MODELS_READY_TIMEOUT = float(os.getenv("MODELS_READY_TIMEOUT", "900"))
+# A process that stayed up this long is considered healthy again, so its
+# next crash starts over at the shortest backoff.
+STABLE_SECONDS = 300.0
+HEARTBEAT = 5.0
+POLL_INTERVAL = 1.0
+
+
+@dataclass
+class Role:
+    name: str
+    model: str
+    port: int
+    status: str = "stopped"  # stopped | starting | warming | ready | backoff
+    pid: int = 0
+    restarts: int = 0
+    load_seconds: float = 0.0
+    warmup_seconds: float = 0.0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "model": self.model,
+            "port": self.port,
+            "status": self.status,
+            "pid": self.pid,
+            "restarts": self.restarts,
+            "load_seconds": round(self.load_seconds, 1),
+            "warmup_seconds": round(self.warmup_seconds, 2),
+        }
+
+
+def roles_from_env() -> List[Role]:
+    roles = [
+        Role(
+            "core",
+            os.getenv("MAIN_MODEL", "Qwen2.5-14B-Instruct-Q5_K_M.gguf"),
+            int(os.getenv("KOBOLD_PORT", "5001")),
+        )
     ]
-    return subprocess.Popen(cmd)
+    for name, model_var, port_var, port in (
+        ("intent", "INTENT_MODEL", "INTENT_PORT", "5002"),
+        ("thoughts", "THOUGHTS_MODEL", "THOUGHTS_PORT", "5003"),
+        ("assist", "ASSIST_MODEL", "ASSIST_PORT", "5002"),
+    ):
+        model = os.getenv(model_var)
+        if model:
+            roles.append(Role(name, model, int(os.getenv(port_var, port))))
+    ports: Dict[int, str] = {}
+    for role in roles:
+        if role.port in ports:
+            raise SystemExit(
+                f"{role.name} and {ports[role.port]} are both set to port {role.port}; "
+                f"set {role.name.upper()}_PORT to a free port"
+            )
+        ports[role.port] = role.name
+    return roles
 
 
-def main() -> None:
-    model = os.getenv("MAIN_MODEL", "Qwen2.5-14B-Instruct-Q5_K_M.gguf")
-    port = int(os.getenv("KOBOLD_PORT", "5001"))
+def _warmup_prompt(role: Role) -> str:
+    if role.name != "core":
+        return "Return ONLY compact JSON.\nMessage:\"hello\"\nJSON:"
+    # Same first block as the orchestrator's core prompt, so KoboldCPP keeps
+    # it cached for the first real request.
+    from core import MEMORY_FILE, SYSTEM_PROMPT
+
+    head = SYSTEM_PROMPT
+    memory = MEMORY_FILE.read_text(encoding="utf-8") if MEMORY_FILE.exists() else ""
+    if memory:
+        head += "\n\n# Shared Memory\n" + memory.strip()
+    return (
+        f"<|im_start|>system\n{head.strip()}\n<|im_end|>\n"
+        "<|im_start|>user\nhello\n<|im_end|>\n<|im_start|>assistant\n"
+    )
+
+
+class Supervisor:
+    def __init__(self, roles: List[Role], state_path: Path = SUPERVISOR_STATE) -> None:
+        self.roles = roles
+        self.state_path = state_path
+        self._procs: Dict[str, asyncio.subprocess.Process] = {}
+        self._stopping = asyncio.Event()
+        self._sess: aiohttp.ClientSession | None = None
+        # Why the supervisor gave up, e.g. KOBOLD_CMD cannot be run.
+        self.failed = ""
+
+    @property
+    def status(self) -> str:
+        if self._stopping.is_set():
+            return "stopped"
+        if all(r.status == "ready" for r in self.roles):
+            return "ready"
+        return "starting"
+
+    def write_state(self) -> None:
+        state = {
+            "pid": os.getpid(),
+            "status": self.status,
+            "error": self.failed,
+            "updated": time.time(),
+            "roles": {r.name: r.to_dict() for r in self.roles},
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.state_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.state_path)
+
+    def _set(self, role: Role, status: str) -> None:
+        before = self.status
+        role.status = status
+        self.write_state()
+        if self.status != before:
+            print(f"[supervisor] all models {self.status}")
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):  # Windows
+                pass
+        self._sess = aiohttp.ClientSession()
+        self.write_state()
+        keepers = [asyncio.ensure_future(self._keep(r)) for r in self.roles]
+        try:
+            while not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), HEARTBEAT)
+                except asyncio.TimeoutError:
+                    self.write_state()
+        finally:
+            self._stopping.set()
+            await self._shutdown()
+            for task in keepers:
+                task.cancel()
+            await asyncio.gather(*keepers, return_exceptions=True)
+            await self._sess.close()
+            self.write_state()
+            print("[supervisor] stopped")
+
+    async def _keep(self, role: Role) -> None:
+        """Run one role until shutdown, restarting it when it dies."""
 
-    intent_model = os.getenv("INTENT_MODEL")
-    intent_port = int(os.getenv("INTENT_PORT", "5002"))
-    planner_model = os.getenv("THOUGHTS_MODEL")
-    planner_port = int(os.getenv("THOUGHTS_PORT", "5003"))
+        crashes = 0
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            try:
+                proc = await self._launch(role)
+            except OSError as exc:
+                # A missing or broken KOBOLD_CMD fails the same way every
+                # time, so stop instead of leaving the bot waiting on "starting".
+                self.failed = f"{role.name}: cannot run {' '.join(KOBOLD_CMD)}: {exc}"
+                print(f"[supervisor] {self.failed}")
+                self._stopping.set()
+                return
+            if await self._wait_ready(role, proc) and await self._warm_up(role, proc):
+                self._set(role, "ready")
+            code = await proc.wait()
+            if self._stopping.is_set():
+                return
+            crashes = 1 if time.monotonic() - started >= STABLE_SECONDS else crashes + 1
+            delay = min(RESTART_BACKOFF * 2 ** (crashes - 1), RESTART_BACKOFF_MAX)
+            role.restarts += 1
+            print(f"[supervisor] {role.name} exited with {code}; restarting in {delay:.1f}s")
+            self._set(role, "backoff")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
-    procs = [launch(model, port)]
-    if intent_model:
-        procs.append(launch(intent_model, intent_port))
-    if planner_model:
-        procs.append(launch(planner_model, planner_port))
-    assist_model = os.getenv("ASSIST_MODEL")
-    assist_port = int(os.getenv("ASSIST_PORT", "5002"))
+    async def _launch(self, role: Role) -> asyncio.subprocess.Process:
+        cmd = [*KOBOLD_CMD, "--model", role.model, "--port", str(role.port), *KOBOLD_ARGS]
+        proc = await asyncio.create_subprocess_exec(*cmd)
+        self._procs[role.name] = proc
+        role.pid = proc.pid
+        print(f"[supervisor] {role.name}: started {role.model} on :{role.port} (pid {proc.pid})")
+        self._set(role, "starting")
+        return proc
 
-    procs = [launch(model, port)]
-    if assist_model:
-        procs.append(launch(assist_model, assist_port))
+    async def _wait_ready(self, role: Role, proc: asyncio.subprocess.Process) -> bool:
+        """Poll ``/api/v1/model`` until it answers; kill the process on timeout."""
 
-    for p in procs:
-        p.wait()
+        start = time.monotonic()
+        while proc.returncode is None and not self._stopping.is_set():
+            try:
+                async with self._sess.get(
+                    f"{role.url}/api/v1/model", timeout=aiohttp.ClientTimeout(total=5)
+                ) as r:
+                    if r.status == 200:
+                        role.load_seconds = time.monotonic() - start
+                        print(f"[supervisor] {role.name}: loaded in {role.load_seconds:.1f}s")
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if time.monotonic() - start > READY_TIMEOUT:
+                print(f"[supervisor] {role.name}: not ready after {READY_TIMEOUT:.0f}s, killing it")
+                proc.kill()
+                return False
+            await asyncio.sleep(POLL_INTERVAL)
+        return False
+
+    async def _warm_up(self, role: Role, proc: asyncio.subprocess.Process) -> bool:
+        """Prime the server; ``False`` if it died while doing so."""
+
+        self._set(role, "warming")
+        payload = {"prompt": _warmup_prompt(role), "max_length": 8, "temperature": 0.2}
+        start = time.monotonic()
+        for _ in range(WARMUP_ROUNDS):
+            try:
+                async with self._sess.post(
+                    f"{role.url}/api/v1/generate",
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=300),
+                ) as r:
+                    await r.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                print(f"[supervisor] {role.name}: warm-up failed: {exc!r}")
+                try:
+                    await asyncio.wait_for(proc.wait(), POLL_INTERVAL)
+                    return False
+                except asyncio.TimeoutError:
+                    break  # still running; let real traffic decide
+        role.warmup_seconds = time.monotonic() - start
+        print(f"[supervisor] {role.name}: warmed up in {role.warmup_seconds:.1f}s")
+        return True
+
+    async def _shutdown(self) -> None:
+        procs = [p for p in self._procs.values() if p.returncode is None]
+        for p in procs:
+            p.terminate()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(p.wait() for p in procs)), STOP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            for p in procs:
+                if p.returncode is None:
+                    p.kill()
+            await asyncio.gather(*(p.wait() for p in procs))
+        for role in self.roles:
+            role.status, role.pid = "stopped", 0
+
+
+def read_state(path: Path = SUPERVISOR_STATE) -> Dict[str, Any] | None:
+    """The running supervisor's state, or ``None`` if no supervisor is running."""
+
+    try:
+        state = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if state.get("status") == "stopped" or time.time() - state.get("updated", 0) > 6 * HEARTBEAT:
+        return None
+    return state
+
+
+async def wait_ready(timeout: float = MODELS_READY_TIMEOUT, path: Path = SUPERVISOR_STATE) -> bool:
+    """Wait until the supervisor reports every model ready.
+
+    Returns ``True`` once they are, and ``False`` straight away if no
+    supervisor is running (models started some other way) or when
+    ``timeout`` runs out.
+    """
+
+    deadline = time.monotonic() + timeout
+    announced = False
+    while True:
+        state = read_state(path)
+        if state is None:
+            return False
+        if state["status"] == "ready":
+            return True
+        if time.monotonic() >= deadline:
+            print("Models still not ready; starting anyway")
+            return False
+        if not announced:
+            print("Waiting for the model servers to load...")
+            announced = True
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def main() -> None:
+    supervisor = Supervisor(roles_from_env())
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:  # pragma: no cover - Windows has no signal handlers
+        pass
+    if supervisor.failed:
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
     main()
-
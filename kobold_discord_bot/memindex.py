@@ -0,0 +1,160 @@
+"""Cached line index over the memory export for ``!memfind`` and ``!anchors``.
+
+The index stores line offsets, the anchor lines and a token -> line postings
+map. It is rebuilt only when the file's mtime or size changes, so repeated
+commands never re-read or re-split the export. Files larger than
+``MEMINDEX_MMAP_BYTES`` are memory-mapped instead of being read into memory,
+and only the lines that are shown get decoded.
+
+Searches rank lines by BM25 over the query terms (see :mod:`kb_index`).
+Lines that contain the whole query verbatim come first, as the old substring
+search showed them. If no term matches, the search falls back to a substring
+scan.
+"""
+from __future__ import annotations
+
+import heapq
+import math
+import mmap
+import os
+import threading
+from array import array
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from core import MEM_EXPORT_PATH
+from kb_index import B, K1, tokenize
+
+MEMINDEX_MMAP_BYTES = int(os.getenv("MEMINDEX_MMAP_BYTES", str(8 * 1024 * 1024)))
+
+
+class _Snapshot:
+    """One immutable build of the index; replaced as a whole on rebuild."""
+
+    def __init__(self, buf: bytes | mmap.mmap = b"") -> None:
+        self.buf = buf
+        self.offsets = array("Q", [0])
+        self.anchors: List[int] = []
+        self.postings: Dict[str, array] = {}
+        self.lengths = array("I")
+        self.avgdl = 1.0
+        postings: Dict[str, array] = defaultdict(lambda: array("I"))
+        seen: set[str] = set()
+        pos = 0
+        size = len(buf)
+        lineno = 0
+        while pos < size:
+            end = buf.find(b"\n", pos)
+            if end < 0:
+                end = size
+            line = buf[pos:end].decode("utf-8", "replace")
+            terms = tokenize(line)
+            self.lengths.append(len(terms))
+            for term in Counter(terms):
+                postings[term].append(lineno)
+            stripped = line.strip()
+            if "Anchor" in stripped and stripped not in seen:
+                seen.add(stripped)
+                self.anchors.append(lineno)
+            pos = end + 1
+            self.offsets.append(pos)
+            lineno += 1
+        self.postings = dict(postings)
+        if lineno:
+            self.avgdl = sum(self.lengths) / lineno
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, lineno: int) -> str:
+        start, end = self.offsets[lineno], self.offsets[lineno + 1]
+        return self.buf[start:end].decode("utf-8", "replace").rstrip("\r\n")
+
+
+class MemoryIndex:
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.builds = 0
+        self._sig: Tuple[int, int] | None = None
+        self._snap = _Snapshot()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._snap)
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def refresh(self) -> _Snapshot:
+        """Rebuild if the file's mtime or size changed; return the current build."""
+
+        try:
+            st = self.path.stat()
+            sig = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            sig = None
+        if sig != self._sig:
+            with self._lock:
+                if sig != self._sig:
+                    self._snap = self._build(sig)
+                    self._sig = sig
+        return self._snap
+
+    def _build(self, sig: Tuple[int, int] | None) -> _Snapshot:
+        if sig is None:
+            return _Snapshot()
+        with open(self.path, "rb") as f:
+            if sig[1] >= MEMINDEX_MMAP_BYTES:
+                # Closed when the snapshot holding it is garbage collected.
+                buf: bytes | mmap.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        self.builds += 1
+        return _Snapshot(buf)
+
+    def anchors(self, max_items: int = 12) -> List[str]:
+        snap = self.refresh()
+        return [snap.line(i).strip() for i in snap.anchors[:max_items]]
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[int, str]]:
+        """Best ``k`` matching lines as ``(line number, text)``, 1-based."""
+
+        snap = self.refresh()
+        n = len(snap)
+        needle = query.strip().lower()
+        if not n or not needle:
+            return []
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            lines = snap.postings.get(term)
+            if not lines:
+                continue
+            idf = math.log(1 + (n - len(lines) + 0.5) / (len(lines) + 0.5))
+            for i in lines:
+                # Postings hold each line once, so tf is taken as 1.
+                norm = K1 * (1 - B + B * snap.lengths[i] / snap.avgdl)
+                scores[i] += idf * (K1 + 1) / (1 + norm)
+        if not scores:
+            return self._scan(snap, needle, k)
+        for i in scores:
+            if needle in snap.line(i).lower():
+                scores[i] += 1000.0
+        best = heapq.nlargest(k, scores.items(), key=lambda kv: (kv[1], -kv[0]))
+        return [(i + 1, snap.line(i)) for i, _ in best]
+
+    @staticmethod
+    def _scan(snap: _Snapshot, needle: str, k: int) -> List[Tuple[int, str]]:
+        out = []
+        for i in range(len(snap)):
+            text = snap.line(i)
+            if needle in text.lower():
+                out.append((i + 1, text))
+                if len(out) >= k:
+                    break
+        return out
+
+
+MEM_INDEX = MemoryIndex(MEM_EXPORT_PATH)
+
+__all__ = ["MEM_INDEX", "MemoryIndex"]
@@ -0,0 +1,242 @@
+"""In-process latency/throughput metrics with a Prometheus text exporter.
+
+Everything is kept in memory per process; the web UI serves it on
+``/metrics`` and the bot summarizes it with ``!stats``.
+"""
+from __future__ import annotations
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in key
+    )
+    return "{" + body + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(_key(labels), 0.0)
+
+    def samples(self) -> Iterator[Tuple[str, LabelKey, float]]:
+        for key, value in list(self._values.items()):
+            yield self.name, key, value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[LabelKey, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def labelsets(self) -> List[Dict[str, str]]:
+        return [dict(key) for key in list(self._values)]
+
+    def count(self, **labels: Any) -> int:
+        entry = self._values.get(_key(labels))
+        return entry[2] if entry else 0
+
+    def mean(self, **labels: Any) -> float:
+        entry = self._values.get(_key(labels))
+        return entry[1] / entry[2] if entry and entry[2] else 0.0
+
+    def quantile(self, q: float, **labels: Any) -> float:
+        """Estimate a quantile by interpolating inside the matching bucket."""
+
+        entry = self._values.get(_key(labels))
+        if not entry or not entry[2]:
+            return 0.0
+        rank = q * entry[2]
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(entry[0]):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = self.buckets[i] if i < len(self.buckets) else lower
+        return self.buckets[-1]
+
+    def samples(self) -> Iterator[Tuple[str, LabelKey, float]]:
+        for key, (counts, total, n) in list(self._values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, n
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Counter | Histogram] = {}
+        self._caches: Dict[str, Any] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, Dict[str, Any], float]]]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))  # type: ignore[return-value]
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))  # type: ignore[return-value]
+
+    def register_cache(self, name: str, cache: Any) -> None:
+        """Export ``cache.stats()`` (see :class:`cache.TTLCache`) under ``name``."""
+
+        self._caches[name] = cache
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+    def register_collector(
+        self, fn: Callable[[], List[Tuple[str, str, str, Dict[str, Any], float]]]
+    ) -> None:
+        """Add a callback returning ``(name, type, help, labels, value)`` samples."""
+
+        self._collectors.append(fn)
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text exposition format."""
+
+        out: List[str] = []
+        for metric in self._metrics.values():
+            out.append(f"# HELP {metric.name} {metric.help}")
+            out.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                out.append(f"{name}{_fmt_labels(key)} {value:g}")
+
+        families: Dict[str, Tuple[str, str, List[str]]] = {}
+
+        def add(name: str, kind: str, help: str, labels: Dict[str, Any], value: float) -> None:
+            fam = families.setdefault(name, (kind, help, []))
+            fam[2].append(f"{name}{_fmt_labels(_key(labels))} {value:g}")
+
+        for cache_name, stats in self.cache_stats().items():
+            labels = {"cache": cache_name}
+            add("requiem_cache_hits_total", "counter", "Cache hits", labels, stats["hits"])
+            add("requiem_cache_misses_total", "counter", "Cache misses", labels, stats["misses"])
+            add("requiem_cache_evictions_total", "counter", "Entries evicted for size", labels, stats["evictions"])
+            add("requiem_cache_entries", "gauge", "Entries currently cached", labels, stats["size"])
+        for collect in self._collectors:
+            for sample in collect():
+                add(*sample)
+        for name, (kind, help, lines) in families.items():
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+METRICS = Registry()
+
+STAGE_SECONDS = METRICS.histogram(
+    "requiem_stage_seconds", "Latency of request handling stages"
+)
+BACKEND_SECONDS = METRICS.histogram(
+    "requiem_backend_request_seconds", "Latency of model/image backend requests"
+)
+FIRST_TOKEN_SECONDS = METRICS.histogram(
+    "requiem_first_token_seconds", "Time to first streamed token"
+)
+QUEUE_WAIT_SECONDS = METRICS.histogram(
+    "requiem_queue_wait_seconds", "Time spent waiting for a backend slot"
+)
+TOKENS = METRICS.counter(
+    "requiem_tokens_total", "Approximate prompt and completion tokens per backend"
+)
+RETRIES = METRICS.counter("requiem_retries_total", "Regenerations per stage")
+ERRORS = METRICS.counter("requiem_errors_total", "Exceptions per stage")
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record the duration of the ``with`` block, and errors raised in it."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed_stage(stage: str) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """Decorator form of :func:`timed` for coroutine functions."""
+
+    def wrap(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        @functools.wraps(fn)
+        async def inner(*args: Any, **kwargs: Any) -> T:
+            with timed(stage):
+                return await fn(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+__all__ = [
+    "BACKEND_SECONDS",
+    "ERRORS",
+    "FIRST_TOKEN_SECONDS",
+    "METRICS",
+    "QUEUE_WAIT_SECONDS",
+    "RETRIES",
+    "STAGE_SECONDS",
+    "TOKENS",
+    "Counter",
+    "Histogram",
+    "Registry",
+    "timed",
+    "timed_stage",
+]
@@ -1,20 +1,90 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
 import json
 import re
 import time
-from dataclasses import dataclass
-from typing import Any, Dict, List
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
 
 import aiohttp
 
-INTENT_URL = os.getenv("INTENT_URL", "http://127.0.0.1:5002").rstrip("/")
-THOUGHTS_URL = os.getenv("THOUGHTS_URL", "http://127.0.0.1:5003").rstrip("/")
-CORE_URL = os.getenv("KOBOLD_URL", "http://127.0.0.1:5001").rstrip("/")
+from cache import TTLCache
+from context import ContextBuilder, TokenCounter, approx_tokens, trim_tokens
+from degrade import (
+    DEGRADE,
+    DEGRADED_REQUESTS,
+    FULL,
+    LEVELS,
+    NO_EMOTION,
+    NO_PLAN,
+    NO_RETRY,
+    DegradationLadder,
+)
+from fast_intent import CLASSIFIER, FastIntent
+from metrics import (
+    BACKEND_SECONDS,
+    ERRORS,
+    FIRST_TOKEN_SECONDS,
+    METRICS,
+    RETRIES,
+    STAGE_SECONDS,
+    TOKENS,
+    timed_stage,
+)
+from core import INTENT_URLS, KOBOLD_URLS, THOUGHTS_URLS, client_timeout
+from recall import RECALL_BUDGET, RecallIndex, exchanges_in, format_exchange
+from replicas import Replica, ReplicaPool
+from reply_cache import REPLIES, ReplyCache
+from scheduler import CURRENT_USER, SCHEDULER, Scheduler
+
+
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "2048"))
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", "600"))
+INTENT_CACHE_FILE = os.getenv("INTENT_CACHE_FILE", "")
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "stable").strip().lower()
+HISTORY_TURNS = int(os.getenv("HISTORY_TURNS", "0"))
+HISTORY_STEP = int(os.getenv("HISTORY_STEP", "10"))
+CORE_CTX = int(os.getenv("CORE_CTX", "8192"))
+CORE_MAX_LEN = int(os.getenv("CORE_MAX_LEN", "350"))
+CTX_BUDGET = int(os.getenv("CTX_BUDGET", str(CORE_CTX - CORE_MAX_LEN)))
+# Shared memory beyond this many tokens is cut from the prompt, so it can never
+# crowd out the conversation itself.
+MEMORY_BUDGET = int(os.getenv("MEMORY_BUDGET", str(CTX_BUDGET // 2)))
+# The newest turns kept in the prompt however tight the budget is.
+MIN_HISTORY_TURNS = int(os.getenv("MIN_HISTORY_TURNS", "6"))
+TOKEN_COUNT = os.getenv("TOKEN_COUNT", "local").strip().lower()
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "sequential").strip().lower()
+# Collect classify/coherence calls for this long and send them as one prompt
+# (0 disables batching).
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "0"))
+BATCH_MAX = int(os.getenv("BATCH_MAX", "8"))
 
 STOP_CORE = ["<|im_end|>", "<|im_start|>user"]
 
+DEFAULT_PLAN: Dict[str, Any] = {
+    "goal": "answer user",
+    "steps": [],
+    "tool_calls": [],
+    "queries": [],
+    "tone_hint": "neutral",
+    "risks": [],
+    "final_suggestion": "",
+}
+DEFAULT_TONE = "calm & precise"
+
+SPECULATION = METRICS.counter(
+    "requiem_speculative_drafts_total", "Speculative core drafts kept or discarded"
+)
+DEFAULT_INTENT: Dict[str, Any] = {"intent": "other", "confidence": 0.5, "flags": {}}
+
+INTENT_SCHEMA = (
+    "{\"intent\":\"greeting|question|instruction|config|memory|image|moderation|admin|other\","
+    "\"confidence\":0.0,\"flags\":{\"needs_image\":false,\"needs_admin\":false,\"risky\":false}}"
+)
+
 
 @dataclass
 class Intent:
@@ -36,6 +106,10 @@ class Outcome:
     plan: Dict[str, Any]
     emotion: str
     final: str
+    # Degradation level the request was served at (see degrade.LEVELS).
+    level: int = FULL
+    # Answered from the reply cache without any model calls.
+    cached: bool = False
 
 
 def _json_only(text: str) -> Dict[str, Any]:
@@ -49,23 +123,163 @@ def _json_only(text: str) -> Dict[str, Any]:
         return {}
 
 
+def _json_list(text: str) -> List[Any]:
+    if not text:
+        return []
+    m = re.search(r"\[.*\]", text, flags=re.S)
+    try:
+        out = json.loads(m.group(0)) if m else []
+    except Exception:
+        return []
+    return out if isinstance(out, list) else []
+
+
+def _plan_is_material(plan: Dict[str, Any]) -> bool:
+    """Return ``True`` if ``plan`` should change a reply drafted with
+    :data:`DEFAULT_PLAN`.
+
+    Only tool calls, queries and risks count; a different goal wording or
+    tone hint is not worth a second core generation.
+    """
+
+    return any(plan.get(key) for key in ("tool_calls", "queries", "risks"))
+
+
+def _stable_start(start: int, length: int) -> int:
+    """Round a history start index up to a multiple of ``HISTORY_STEP``.
+
+    The window start then only moves every few messages, so the older part
+    of the prompt stays byte-identical instead of shifting every time.
+    """
+
+    step = max(HISTORY_STEP, 1)
+    return min(-(-start // step) * step, length)
+
+
+class _StageGraph:
+    """Run async stages as soon as the stages they depend on have finished."""
+
+    def __init__(self) -> None:
+        self._stages: Dict[str, tuple[tuple[str, ...], Callable[..., Awaitable[Any]]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def add(self, name: str, deps: tuple[str, ...], fn: Callable[..., Awaitable[Any]]) -> None:
+        """Register ``fn``; it is called with the results of ``deps`` in order."""
+
+        self._stages[name] = (deps, fn)
+
+    def task(self, name: str) -> asyncio.Task:
+        return self._tasks[name]
+
+    async def _run(self, name: str) -> Any:
+        deps, fn = self._stages[name]
+        args = [await self._tasks[dep] for dep in deps]
+        return await fn(*args)
+
+    async def run(self, *outputs: str) -> Dict[str, Any]:
+        """Start every stage and return the results of ``outputs``.
+
+        Stages that are still pending afterwards (e.g. a discarded
+        speculative one) are cancelled.
+        """
+
+        self._tasks = {name: asyncio.ensure_future(self._run(name)) for name in self._stages}
+        try:
+            return {name: await self._tasks[name] for name in outputs}
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+
+
+class _MicroBatcher:
+    """Collect calls for ``window`` seconds and hand them to ``run_batch`` at once.
+
+    ``run_batch`` receives the submitted items in order and must return one
+    result per item.
+    """
+
+    def __init__(
+        self,
+        window: float,
+        max_size: int,
+        run_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+    ) -> None:
+        self.window = window
+        self.max_size = max(max_size, 1)
+        self.run_batch = run_batch
+        self._pending: List[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((item, fut))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: List[tuple[Any, asyncio.Future]]) -> None:
+        try:
+            results = await self.run_batch([item for item, _ in batch])
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+
+class _Flight:
+    """One upstream request shared by every caller with the same payload."""
+
+    __slots__ = ("fut", "waiters")
+
+    def __init__(self, fut: asyncio.Future) -> None:
+        self.fut = fut
+        self.waiters = 0
+
+
 class LLMClient:
-    def __init__(self, base: str, session: aiohttp.ClientSession):
-        self.base = base
+    def __init__(
+        self,
+        base: str | List[str],
+        session: aiohttp.ClientSession,
+        role: str = "core",
+        scheduler: Scheduler = SCHEDULER,
+    ):
+        self.pool = ReplicaPool(role, [base] if isinstance(base, str) else base, session)
         self.sess = session
+        self.role = role
+        self.scheduler = scheduler
+        self.inflight = 0
+        self.last_done = 0.0
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+        # Smoothed request latency in seconds (see degrade.DegradationLadder).
+        self.latency = 0.0
 
-    async def gen(
-        self,
+    @staticmethod
+    def _payload(
         prompt: str,
-        *,
-        max_len: int = 256,
-        ctx: int = 4096,
-        temp: float = 0.7,
-        top_p: float = 0.9,
-        stop: List[str] | None = None,
-        timeout: int = 30,
-    ) -> str:
-        payload = {
+        max_len: int,
+        ctx: int,
+        temp: float,
+        top_p: float,
+        stop: List[str] | None,
+    ) -> Dict[str, Any]:
+        return {
             "prompt": prompt,
             "max_context_length": ctx,
             "max_length": max_len,
@@ -77,39 +291,267 @@ class LLMClient:
             "stop_sequence": stop or [],
             "frmttriminc": True,
         }
-        async with self.sess.post(
-            f"{self.base}/api/v1/generate", json=payload, timeout=timeout
-        ) as r:
-            r.raise_for_status()
-            js = await r.json()
-        return (js.get("results", [{}])[0].get("text") or "").strip()
+
+    async def gen(
+        self,
+        prompt: str,
+        *,
+        max_len: int = 256,
+        ctx: int = 4096,
+        temp: float = 0.7,
+        top_p: float = 0.9,
+        stop: List[str] | None = None,
+        timeout: int = 30,
+        background: bool = False,
+    ) -> str:
+        """Generate a completion.
+
+        ``background`` requests (the summarizer's) do not count as traffic
+        for :meth:`idle_for`.
+        """
+
+        payload = self._payload(prompt, max_len, ctx, temp, top_p, stop)
+        # Single flight: concurrent calls with an identical payload share one
+        # upstream request. The shield keeps one caller's cancellation from
+        # cancelling it for the others; once the last caller is cancelled
+        # (a discarded draft, a disconnected client) the request is too, which
+        # frees its scheduler slot and the model.
+        key = hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        flight = self._flights.get(key)
+        if flight is None or flight.fut.done():
+            flight = self._flights[key] = _Flight(
+                asyncio.ensure_future(self._gen_slot(payload, timeout, background))
+            )
+            flight.fut.add_done_callback(lambda _: self._land(key, flight))
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.fut)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.fut.done():
+                flight.fut.cancel()
+
+    def _land(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _gen_slot(self, payload: Dict[str, Any], timeout: int, background: bool) -> str:
+        async with self.scheduler.slot(self.role):
+            return await self._post(payload, timeout, background)
+
+    async def _post(self, payload: Dict[str, Any], timeout: int, background: bool = False) -> str:
+        self.inflight += 1
+        start = time.perf_counter()
+        tried: List[Replica] = []
+        try:
+            while True:
+                try:
+                    async with self.pool.lease(tried) as replica:
+                        tried.append(replica)
+                        async with self.sess.post(
+                            f"{replica.url}/api/v1/generate",
+                            json=payload,
+                            timeout=client_timeout(timeout),
+                        ) as r:
+                            r.raise_for_status()
+                            js = await r.json()
+                    break
+                except Exception as exc:
+                    if not self.pool.failover(exc, tried):
+                        raise
+        except Exception:
+            ERRORS.inc(stage=f"backend_{self.role}")
+            raise
+        finally:
+            self.inflight -= 1
+            if not background:
+                self.last_done = time.monotonic()
+            self._observe(time.perf_counter() - start)
+        text = (js.get("results", [{}])[0].get("text") or "").strip()
+        TOKENS.inc(approx_tokens(payload["prompt"]), backend=self.role, kind="prompt")
+        TOKENS.inc(approx_tokens(text), backend=self.role, kind="completion")
+        return text
+
+    def _observe(self, seconds: float) -> None:
+        BACKEND_SECONDS.observe(seconds, backend=self.role)
+        self.latency = seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+
+    def idle_for(self) -> float:
+        """Seconds since the last request finished, or 0.0 while one is running."""
+
+        return 0.0 if self.inflight else time.monotonic() - self.last_done
+
+    async def stream(
+        self,
+        prompt: str,
+        *,
+        max_len: int = 256,
+        ctx: int = 4096,
+        temp: float = 0.7,
+        top_p: float = 0.9,
+        stop: List[str] | None = None,
+        timeout: int = 30,
+    ) -> AsyncIterator[str]:
+        """Yield tokens from KoboldCPP's SSE endpoint as they are sampled.
+
+        ``timeout`` bounds the wait between two chunks rather than the whole
+        generation, so long replies are not cut off while tokens keep flowing.
+        """
+
+        payload = self._payload(prompt, max_len, ctx, temp, top_p, stop)
+        async with self.scheduler.slot(self.role):
+            async for token in self._post_stream(payload, timeout):
+                yield token
+
+    async def _post_stream(self, payload: Dict[str, Any], timeout: int) -> AsyncIterator[str]:
+        self.inflight += 1
+        start = time.perf_counter()
+        first = True
+        tokens = 0
+        tried: List[Replica] = []
+        try:
+            while True:
+                try:
+                    async with self.pool.lease(tried) as replica:
+                        tried.append(replica)
+                        async with self.sess.post(
+                            f"{replica.url}/api/extra/generate/stream",
+                            json=payload,
+                            timeout=client_timeout(None, sock_read=timeout),
+                        ) as r:
+                            r.raise_for_status()
+                            async for raw in r.content:
+                                line = raw.decode("utf-8", "replace").strip()
+                                if not line.startswith("data:"):
+                                    continue
+                                try:
+                                    js = json.loads(line[5:])
+                                except ValueError:
+                                    continue
+                                token = js.get("token") or ""
+                                if token:
+                                    if first:
+                                        FIRST_TOKEN_SECONDS.observe(
+                                            time.perf_counter() - start, backend=self.role
+                                        )
+                                        first = False
+                                    tokens += 1
+                                    yield token
+                    break
+                except Exception as exc:
+                    # Only fail over before anything has been shown to the user.
+                    if tokens or not self.pool.failover(exc, tried):
+                        raise
+        except Exception:
+            ERRORS.inc(stage=f"backend_{self.role}")
+            raise
+        finally:
+            self.inflight -= 1
+            self.last_done = time.monotonic()
+            self._observe(time.perf_counter() - start)
+            TOKENS.inc(approx_tokens(payload["prompt"]), backend=self.role, kind="prompt")
+            TOKENS.inc(tokens, backend=self.role, kind="completion")
 
 
 class Orchestrator:
-    def __init__(self, system_prompt: str, global_memory: str, session: aiohttp.ClientSession):
+    def __init__(
+        self,
+        system_prompt: str,
+        global_memory: str,
+        session: aiohttp.ClientSession,
+        mode: str = PIPELINE_MODE,
+        layout: str = PROMPT_LAYOUT,
+        fast_intent: FastIntent | None = CLASSIFIER,
+        recall: RecallIndex | None = None,
+        replies: ReplyCache | None = REPLIES,
+    ):
         self.system = system_prompt
-        self.gmem = global_memory
-        self.intent = LLMClient(INTENT_URL, session)
-        self.planner = LLMClient(THOUGHTS_URL, session)
-        self.core = LLMClient(CORE_URL, session)
-        self._intent_cache: Dict[str, tuple[float, Dict[str, Any]]] = {}
+        self.set_memory(global_memory)
+        self.mode = mode
+        self.layout = layout
+        self.fast_intent = fast_intent
+        self.recall = recall
+        self.replies = replies
+        self.intent = LLMClient(INTENT_URLS, session, "intent")
+        self.planner = LLMClient(THOUGHTS_URLS, session, "thoughts")
+        self.core = LLMClient(KOBOLD_URLS, session, "core")
+        # Every core replica serves the same model, so any one can count tokens.
+        self.counter = TokenCounter(session, KOBOLD_URLS[0] if TOKEN_COUNT == "remote" else None)
+        self.context = ContextBuilder(self.counter, CTX_BUDGET)
+        self.intent_cache = TTLCache(
+            INTENT_CACHE_SIZE, INTENT_CACHE_TTL, INTENT_CACHE_FILE or None
+        )
+        METRICS.register_cache("token_count", self.counter._cache)
+        METRICS.register_cache("intent", self.intent_cache)
+        if replies is not None:
+            METRICS.register_cache("reply", replies)
+        self.ladder: DegradationLadder | None = None
+        if DEGRADE:
+            self.ladder = DegradationLadder(SCHEDULER, lambda: self.core.latency)
+        self._intent_batcher: _MicroBatcher | None = None
+        self._coherence_batcher: _MicroBatcher | None = None
+        if BATCH_WINDOW_MS > 0:
+            window = BATCH_WINDOW_MS / 1000
+            self._intent_batcher = _MicroBatcher(window, BATCH_MAX, self._classify_batch)
+            self._coherence_batcher = _MicroBatcher(window, BATCH_MAX, self._coherence_batch)
+
+    def idle_for(self) -> float:
+        """Seconds for which none of the model backends has had a request."""
+
+        return min(c.idle_for() for c in (self.intent, self.planner, self.core))
+
+    async def _classify_one(self, text: str) -> Dict[str, Any]:
+        prompt = (
+            "Return ONLY compact JSON.\n"
+            f"Schema:{INTENT_SCHEMA}\n"
+            f"Message:\"{text}\"\nJSON:"
+        )
+        out = await self.intent.gen(prompt, max_len=160, ctx=1024, temp=0.2, top_p=0.95)
+        return _json_only(out) or dict(DEFAULT_INTENT)
+
+    async def _classify_batch(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Classify several messages with one intent-model call.
+
+        Falls back to one call per message if the model's answer does not
+        contain exactly one object per distinct message.
+        """
 
+        unique = list(dict.fromkeys(texts))
+        if len(unique) == 1:
+            js = await self._classify_one(unique[0])
+            return [js for _ in texts]
+        listing = "\n".join(f"{i}. {json.dumps(t, ensure_ascii=False)}" for i, t in enumerate(unique, 1))
+        prompt = (
+            "Classify each numbered message. Return ONLY a compact JSON array with one "
+            "object per message, in order.\n"
+            f"Schema per item:{INTENT_SCHEMA}\n"
+            f"Messages:\n{listing}\nJSON:"
+        )
+        out = await self.intent.gen(
+            prompt, max_len=100 * len(unique), ctx=1024 + 160 * len(unique), temp=0.2, top_p=0.95
+        )
+        items = _json_list(out)
+        if len(items) != len(unique) or not all(isinstance(i, dict) for i in items):
+            items = list(await asyncio.gather(*(self._classify_one(t) for t in unique)))
+        by_text = dict(zip(unique, items))
+        return [by_text[t] for t in texts]
+
+    @timed_stage("intent")
     async def classify(self, text: str) -> Intent:
         key = text.strip().lower()
-        now = time.time()
-        hit = self._intent_cache.get(key)
-        if hit and hit[0] > now:
-            js = hit[1]
-        else:
-            prompt = (
-                "Return ONLY compact JSON.\n"
-                "Schema:{\"intent\":\"greeting|question|instruction|config|memory|image|moderation|admin|other\","\
-                "\"confidence\":0.0,\"flags\":{\"needs_image\":false,\"needs_admin\":false,\"risky\":false}}\n"
-                f"Message:\"{text}\"\nJSON:"
-            )
-            out = await self.intent.gen(prompt, max_len=160, ctx=1024, temp=0.2, top_p=0.95)
-            js = _json_only(out) or {"intent": "other", "confidence": 0.5, "flags": {}}
-            self._intent_cache[key] = (now + 60, js)
+        js = self.fast_intent.predict(text) if self.fast_intent is not None else None
+        if js is None:
+            js = self.intent_cache.get(key)
+        if js is None:
+            if self._intent_batcher is not None:
+                js = await self._intent_batcher.submit(text)
+            else:
+                js = await self._classify_one(text)
+            self.intent_cache.set(key, js)
+            if self.fast_intent is not None:
+                self.fast_intent.record(text, js)
         js.setdefault("flags", {})
         js["flags"].setdefault("needs_image", False)
         c = float(js.get("confidence", 0))
@@ -118,6 +560,7 @@ class Orchestrator:
             js["confidence"] = 0.55
         return Intent(js["intent"], js["confidence"], js["flags"])
 
+    @timed_stage("plan")
     async def plan(self, message: str, intent: Intent) -> Dict[str, Any]:
         prompt = (
             "Plan the reply. Output ONLY JSON (no prose).\n"
@@ -136,17 +579,10 @@ class Orchestrator:
                 temp=0.2,
                 top_p=0.9,
             )
-            js = _json_only(out) or {
-                "goal": "answer user",
-                "steps": [],
-                "tool_calls": [],
-                "queries": [],
-                "tone_hint": "neutral",
-                "risks": [],
-                "final_suggestion": "",
-            }
+            js = _json_only(out) or dict(DEFAULT_PLAN)
         return js
 
+    @timed_stage("emotion")
     async def emotion(self, message: str, plan: Dict[str, Any]) -> str:
         hint = plan.get("tone_hint") or ""
         prompt = (
@@ -154,7 +590,90 @@ class Orchestrator:
             f"Context tone_hint:{hint}\nMessage:{message}\nHint:"
         )
         out = await self.intent.gen(prompt, max_len=20, ctx=512, temp=0.7, top_p=0.9)
-        return (out.splitlines()[0] if out else "calm & precise")[:48]
+        return (out.splitlines()[0] if out else DEFAULT_TONE)[:48]
+
+    def set_memory(self, global_memory: str) -> None:
+        """Swap in new shared memory; the prompt head is built here, once.
+
+        Memory longer than ``MEMORY_BUDGET`` tokens is cut at a line boundary
+        and a warning is printed.
+        """
+
+        head = self.system
+        if global_memory:
+            text = global_memory.strip()
+            kept = trim_tokens(text, MEMORY_BUDGET)
+            if kept != text:
+                print(
+                    f"Shared memory is ~{approx_tokens(text)} tokens; only the first "
+                    f"~{approx_tokens(kept)} (MEMORY_BUDGET={MEMORY_BUDGET}) go into the prompt"
+                )
+            head += "\n\n# Shared Memory\n" + kept
+        self.gmem, self._head_text = global_memory, head
+        # Part of every reply cache key, so edits never serve stale answers.
+        self.memory_version = hashlib.sha1(head.encode("utf-8")).hexdigest()
+
+    def _head(self) -> str:
+        return self._head_text
+
+    @staticmethod
+    def _internal(intent: Intent, plan: Dict[str, Any], tone: str) -> List[str]:
+        return [
+            f"\n[INTERNAL intent]{json.dumps(intent.__dict__, ensure_ascii=False)}",
+            f"[INTERNAL plan]{json.dumps(plan, ensure_ascii=False)}",
+            f"[INTERNAL tone]{tone}",
+        ]
+
+    async def _core_prompt(
+        self,
+        history: List[Dict[str, str]],
+        user_text: str,
+        intent: Intent,
+        plan: Dict[str, Any],
+        tone: str,
+        kb: str,
+        summary: str,
+    ) -> str:
+        """Build the core prompt from whatever fits in ``CTX_BUDGET`` tokens."""
+
+        fixed = [self._head(), "\n".join(self._internal(intent, plan, tone)), user_text]
+        user = CURRENT_USER.get()
+        reserve = RECALL_BUDGET if self.recall is not None and user is not None else 0
+        min_turns = min(MIN_HISTORY_TURNS, HISTORY_TURNS) if HISTORY_TURNS else MIN_HISTORY_TURNS
+        summary, kb, start = await self.context.fit(
+            fixed, summary, kb, history, reserve, min_turns
+        )
+        if HISTORY_TURNS:
+            start = max(start, len(history) - HISTORY_TURNS)
+        if self.layout != "legacy":
+            start = _stable_start(start, len(history))
+        # Rounding the window start up must not drop the guaranteed turns.
+        start = min(start, max(len(history) - min_turns, 0))
+        recalled = ""
+        if reserve:
+            skip = exchanges_in(len(history) - start)
+            recalled = await self._recall(str(user), user_text, skip, reserve)
+        return self._chatml(
+            history[start:], user_text, intent, plan, tone, kb, summary, recalled
+        )
+
+    @timed_stage("recall")
+    async def _recall(self, user: str, user_text: str, skip: int, budget: int) -> str:
+        """Older exchanges relevant to ``user_text`` that fit in ``budget`` tokens.
+
+        The newest ``skip`` exchanges are already in the prompt's history.
+        """
+
+        hits = await asyncio.to_thread(self.recall.search, user, user_text, skip=skip)
+        kept = []
+        for ex_id, asked, replied in hits:
+            text = format_exchange(asked, replied)
+            n = await self.counter.count(text) + 1
+            if n > budget:
+                continue
+            budget -= n
+            kept.append((ex_id, text))
+        return "\n\n".join(text for _, text in sorted(kept))
 
     def _chatml(
         self,
@@ -165,31 +684,45 @@ class Orchestrator:
         tone: str,
         kb: str,
         summary: str,
+        recalled: str = "",
     ) -> str:
-        sys = [self.system]
-        if self.gmem:
-            sys.append("\n# Shared Memory\n" + self.gmem.strip())
+        sys = [self._head()]
         if summary:
             sys.append("\n# Conversation Summary\n" + summary.strip())
+        volatile = []
+        if recalled:
+            volatile.append("\n# Earlier With This User\n" + recalled)
         if kb:
-            sys.append("\n# Galaxy Online 2\n" + kb)
-        sys.append(f"\n[INTERNAL intent]{json.dumps(intent.__dict__, ensure_ascii=False)}")
-        sys.append(f"[INTERNAL plan]{json.dumps(plan, ensure_ascii=False)}")
-        sys.append(f"[INTERNAL tone]{tone}")
+            volatile.append("\n# Galaxy Online 2\n" + kb)
+        volatile += self._internal(intent, plan, tone)
 
         def block(role: str, content: str) -> str:
             return f"<|im_start|>{role}\n{content}\n<|im_end|>"
 
-        parts = [block("system", "\n".join(sys).strip())]
-        for t in history[-20:]:
-            role = t.get("role", "user")
-            if role not in ("user", "assistant"):
-                role = "user"
-            parts.append(block(role, t.get("content", "")))
-        parts.append(block("user", user_text))
+        def turns(window: List[Dict[str, str]]) -> List[str]:
+            out = []
+            for t in window:
+                role = t.get("role", "user")
+                if role not in ("user", "assistant"):
+                    role = "user"
+                out.append(block(role, t.get("content", "")))
+            return out
+
+        if self.layout == "legacy":
+            parts = [block("system", "\n".join(sys + volatile).strip())]
+            parts += turns(history)
+            parts.append(block("user", user_text))
+        else:
+            # Everything up to and including the user turn is reused by the
+            # next request; per-turn material goes after it.
+            parts = [block("system", "\n".join(sys).strip())]
+            parts += turns(history)
+            parts.append(block("user", user_text))
+            parts.append(block("system", "\n".join(volatile).strip()))
         parts.append("<|im_start|>assistant\n")
         return "\n".join(parts)
 
+    @timed_stage("core")
     async def core_reply(
         self,
         history: List[Dict[str, str]],
@@ -200,18 +733,43 @@ class Orchestrator:
         kb: str,
         summary: str,
     ) -> str:
-        prompt = self._chatml(history, user_text, intent, plan, tone, kb, summary)
+        prompt = await self._core_prompt(history, user_text, intent, plan, tone, kb, summary)
         out = await self.core.gen(
             prompt,
-            max_len=350,
-            ctx=8192,
+            max_len=CORE_MAX_LEN,
+            ctx=CORE_CTX,
             temp=0.75,
             top_p=0.9,
             stop=STOP_CORE,
         )
         return out or "_(no text)_"
 
-    async def coherence(self, message: str, reply: str) -> bool:
+    async def core_stream(
+        self,
+        history: List[Dict[str, str]],
+        user_text: str,
+        intent: Intent,
+        plan: Dict[str, Any],
+        tone: str,
+        kb: str,
+        summary: str,
+    ) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        prompt = await self._core_prompt(history, user_text, intent, plan, tone, kb, summary)
+        try:
+            async for token in self.core.stream(
+                prompt,
+                max_len=CORE_MAX_LEN,
+                ctx=CORE_CTX,
+                temp=0.75,
+                top_p=0.9,
+                stop=STOP_CORE,
+            ):
+                yield token
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="core")
+
+    async def _coherence_one(self, message: str, reply: str) -> bool:
         prompt = (
             "Answer YES if the assistant reply directly addresses the user message, otherwise NO.\n"
             f"Message: {message}\nReply: {reply}\nAnswer:"
@@ -219,6 +777,68 @@ class Orchestrator:
         out = await self.intent.gen(prompt, max_len=6, ctx=512, temp=0.0, top_p=0.5)
         return out.strip().lower().startswith("y")
 
+    async def _coherence_batch(self, pairs: List[tuple[str, str]]) -> List[bool]:
+        if len(pairs) == 1:
+            return [await self._coherence_one(*pairs[0])]
+        listing = "\n".join(
+            f"{i}. Message: {m}\n   Reply: {r}" for i, (m, r) in enumerate(pairs, 1)
+        )
+        prompt = (
+            "For each numbered pair answer YES if the assistant reply directly addresses the "
+            "user message, otherwise NO. Output one line per pair, like \"1: YES\".\n"
+            f"{listing}\nAnswers:\n"
+        )
+        out = await self.intent.gen(
+            prompt, max_len=8 * len(pairs), ctx=512 * len(pairs), temp=0.0, top_p=0.5
+        )
+        found = {
+            int(n): ans.lower() == "yes"
+            for n, ans in re.findall(r"(\d+)\s*[:.)-]\s*(YES|NO)", out, flags=re.I)
+        }
+        if all(i in found for i in range(1, len(pairs) + 1)):
+            return [found[i] for i in range(1, len(pairs) + 1)]
+        return list(await asyncio.gather(*(self._coherence_one(m, r) for m, r in pairs)))
+
+    @timed_stage("coherence")
+    async def coherence(self, message: str, reply: str) -> bool:
+        if self._coherence_batcher is not None:
+            return await self._coherence_batcher.submit((message, reply))
+        return await self._coherence_one(message, reply)
+
+    def _reply_key(self, user_text: str, kb: str, use_cache: bool) -> str | None:
+        if self.replies is None or not use_cache or not self.replies.applies(user_text, kb):
+            return None
+        return self.replies.key(user_text, kb, self.memory_version)
+
+    def _cached_reply(self, key: str | None) -> Outcome | None:
+        hit = self.replies.get(key) if key is not None else None
+        if hit is None:
+            return None
+        return Outcome(
+            Intent(**hit["intent"]), dict(DEFAULT_PLAN), DEFAULT_TONE, hit["reply"], cached=True
+        )
+
+    def _remember_reply(self, key: str | None, out: Outcome) -> None:
+        # Degraded replies skipped the coherence check; do not reuse them.
+        if key is not None and out.level < NO_RETRY and out.final != "_(no text)_":
+            self.replies.store(key, asdict(out.intent), out.final)
+
+    def _level(self) -> int:
+        level = self.ladder.level() if self.ladder is not None else FULL
+        DEGRADED_REQUESTS.inc(level=LEVELS[level])
+        return level
+
+    async def _plan_at(self, level: int, message: str, intent: Intent) -> Dict[str, Any]:
+        if level >= NO_PLAN:
+            return dict(DEFAULT_PLAN)
+        return await self.plan(message, intent)
+
+    async def _emotion_at(self, level: int, message: str, plan: Dict[str, Any]) -> str:
+        if level >= NO_EMOTION:
+            return (plan.get("tone_hint") or DEFAULT_TONE)[:48]
+        return await self.emotion(message, plan)
+
+    @timed_stage("handle")
     async def handle(
         self,
         user_id: int,
@@ -226,12 +846,182 @@ class Orchestrator:
         user_text: str,
         kb: str = "",
         summary: str = "",
+        use_cache: bool = True,
+    ) -> Outcome:
+        """Run the pipeline for one message.
+
+        With ``use_cache`` (and a reply cache configured) a repeated factual
+        question is answered from :mod:`reply_cache` without model calls.
+        """
+
+        CURRENT_USER.set(user_id)
+        key = self._reply_key(user_text, kb, use_cache)
+        out = self._cached_reply(key)
+        if out is not None:
+            return out
+        level = self._level()
+        if self.mode == "concurrent":
+            out = await self._handle_concurrent(history, user_text, kb, summary, level)
+        else:
+            it = await self.classify(user_text)
+            pl = await self._plan_at(level, user_text, it)
+            em = await self._emotion_at(level, user_text, pl)
+            final = await self.core_reply(history, user_text, it, pl, em, kb, summary)
+            if level < NO_RETRY and not await self.coherence(user_text, final):
+                RETRIES.inc(stage="core")
+                final = await self.core_reply(history, user_text, it, pl, em, kb, summary)
+            out = Outcome(it, pl, em, final, level)
+        self._remember_reply(key, out)
+        return out
+
+    async def _handle_concurrent(
+        self,
+        history: List[Dict[str, str]],
+        user_text: str,
+        kb: str,
+        summary: str,
+        level: int = FULL,
     ) -> Outcome:
+        """Run the pipeline as a stage graph instead of strictly in series.
+
+        As soon as the intent is known a draft reply is started with
+        :data:`DEFAULT_PLAN` and :data:`DEFAULT_TONE` while the planner and
+        emotion stages run. The draft is kept unless the real plan is
+        material; then the emotion stage is not waited for and the outcome
+        reports the tone the draft used. Otherwise the draft is cancelled and
+        the reply is regenerated with the real plan and tone.
+        """
+
+        graph = _StageGraph()
+
+        async def draft(it: Intent) -> str:
+            return await self.core_reply(history, user_text, it, DEFAULT_PLAN, DEFAULT_TONE, kb, summary)
+
+        async def reply(it: Intent, pl: Dict[str, Any]) -> tuple[str, str]:
+            if not _plan_is_material(pl):
+                SPECULATION.inc(result="kept")
+                return await graph.task("draft"), DEFAULT_TONE
+            SPECULATION.inc(result="discarded")
+            graph.task("draft").cancel()
+            em = await graph.task("emotion")
+            return await self.core_reply(history, user_text, it, pl, em, kb, summary), em
+
+        async def checked(it: Intent, pl: Dict[str, Any], replied: tuple[str, str]) -> tuple[str, str]:
+            final, em = replied
+            if level >= NO_RETRY or await self.coherence(user_text, final):
+                return final, em
+            RETRIES.inc(stage="core")
+            return await self.core_reply(history, user_text, it, pl, em, kb, summary), em
+
+        graph.add("intent", (), lambda: self.classify(user_text))
+        graph.add("plan", ("intent",), lambda it: self._plan_at(level, user_text, it))
+        graph.add("emotion", ("plan",), lambda pl: self._emotion_at(level, user_text, pl))
+        graph.add("draft", ("intent",), draft)
+        graph.add("reply", ("intent", "plan"), reply)
+        graph.add("final", ("intent", "plan", "reply"), checked)
+        res = await graph.run("intent", "plan", "final")
+        final, em = res["final"]
+        return Outcome(res["intent"], res["plan"], em, final, level)
+
+    async def _stream_concurrent(
+        self,
+        history: List[Dict[str, str]],
+        user_text: str,
+        kb: str,
+        summary: str,
+        level: int,
+        on_token: Callable[[str], Awaitable[None]] | None,
+    ) -> tuple[Intent, Dict[str, Any], str, str]:
+        """Streaming counterpart of :meth:`_handle_concurrent`.
+
+        The draft is streamed from the model while the planner runs, but its
+        tokens are held back until the plan is known: a kept draft is passed
+        to ``on_token`` from the start, a discarded one is never shown and the
+        reply is streamed again with the real plan and tone. Returns the
+        intent, plan, tone used and reply text.
+        """
+
         it = await self.classify(user_text)
-        pl = await self.plan(user_text, it)
-        em = await self.emotion(user_text, pl)
-        for _ in range(2):
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump() -> None:
+            try:
+                async for token in self.core_stream(history, user_text, it, DEFAULT_PLAN, DEFAULT_TONE, kb, summary):
+                    queue.put_nowait(token)
+            finally:
+                queue.put_nowait(None)
+
+        async def drafted() -> AsyncIterator[str]:
+            while (token := await queue.get()) is not None:
+                yield token
+            await draft  # re-raise a failed stream
+
+        draft = asyncio.ensure_future(pump())
+        try:
+            pl = await self._plan_at(level, user_text, it)
+            if _plan_is_material(pl):
+                SPECULATION.inc(result="discarded")
+                draft.cancel()
+                em = await self._emotion_at(level, user_text, pl)
+                stream = self.core_stream(history, user_text, it, pl, em, kb, summary)
+            else:
+                SPECULATION.inc(result="kept")
+                em = DEFAULT_TONE
+                stream = drafted()
+            parts: List[str] = []
+            async for token in stream:
+                parts.append(token)
+                if on_token is not None:
+                    await on_token(token)
+        finally:
+            draft.cancel()
+        return it, pl, em, "".join(parts)
+
+    @timed_stage("handle")
+    async def handle_stream(
+        self,
+        user_id: int,
+        history: List[Dict[str, str]],
+        user_text: str,
+        kb: str = "",
+        summary: str = "",
+        on_token: Callable[[str], Awaitable[None]] | None = None,
+        use_cache: bool = True,
+    ) -> Outcome:
+        """Like :meth:`handle`, but stream the first core attempt.
+
+        Each token is passed to ``on_token`` as soon as it arrives. If the
+        streamed reply fails the coherence check (not run when degraded) it
+        is regenerated once without streaming; callers should always display
+        ``Outcome.final`` once this returns. A cached reply is passed to
+        ``on_token`` in one piece. In concurrent mode see
+        :meth:`_stream_concurrent`.
+        """
+
+        CURRENT_USER.set(user_id)
+        key = self._reply_key(user_text, kb, use_cache)
+        out = self._cached_reply(key)
+        if out is not None:
+            if on_token is not None:
+                await on_token(out.final)
+            return out
+        level = self._level()
+        if self.mode == "concurrent":
+            it, pl, em, text = await self._stream_concurrent(history, user_text, kb, summary, level, on_token)
+        else:
+            it = await self.classify(user_text)
+            pl = await self._plan_at(level, user_text, it)
+            em = await self._emotion_at(level, user_text, pl)
+            parts: List[str] = []
+            async for token in self.core_stream(history, user_text, it, pl, em, kb, summary):
+                parts.append(token)
+                if on_token is not None:
+                    await on_token(token)
+            text = "".join(parts)
+        final = text.strip() or "_(no text)_"
+        if level < NO_RETRY and not await self.coherence(user_text, final):
+            RETRIES.inc(stage="core")
             final = await self.core_reply(history, user_text, it, pl, em, kb, summary)
-            if await self.coherence(user_text, final):
-                break
-        return Outcome(it, pl, em, final)
+        out = Outcome(it, pl, em, final, level)
+        self._remember_reply(key, out)
+        return out
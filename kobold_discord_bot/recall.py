@@ -0,0 +1,186 @@
+"""Per-user retrieval of older exchanges for the core prompt.
+
+Every user/assistant exchange is archived by :meth:`storage.UserStore.append_exchange`.
+For each active user this module keeps a hashed TF-IDF matrix of those
+exchanges in NumPy, so the few most relevant ones that have scrolled out of
+the prompt's history window can be put back in. Users' indexes are built
+from the archive on first use, extended in place by :func:`core.update_memory`,
+caught up with exchanges written by the other process on every search, and
+evicted least-recently-used beyond ``RECALL_USERS``. NumPy is imported on
+first use (or by the startup warm-up, see :mod:`startup`).
+"""
+from __future__ import annotations
+
+import math
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Tuple
+
+from kb_index import tokenize
+from storage import UserStore
+
+if TYPE_CHECKING:
+    import numpy as np
+
+RECALL = os.getenv("RECALL", "1") != "0"
+RECALL_K = int(os.getenv("RECALL_K", "3"))
+RECALL_BUDGET = int(os.getenv("RECALL_BUDGET", "400"))
+RECALL_DIM = int(os.getenv("RECALL_DIM", "2048"))
+RECALL_MAX_DOCS = int(os.getenv("RECALL_MAX_DOCS", "2000"))
+RECALL_USERS = int(os.getenv("RECALL_USERS", "32"))
+RECALL_MIN_SCORE = float(os.getenv("RECALL_MIN_SCORE", "0.3"))
+# Each side of an exchange is cut to this many characters in the prompt.
+RECALL_CHARS = 600
+
+
+def hashed_tf(text: str, dim: int) -> np.ndarray:
+    """Sublinear term frequencies of words and word pairs, hashed into ``dim`` slots."""
+
+    import numpy as np
+
+    words = tokenize(text)
+    vec = np.zeros(dim, dtype=np.float32)
+    for term in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        vec[zlib.crc32(term.encode("utf-8")) % dim] += 1.0
+    nz = vec > 0
+    vec[nz] = 1.0 + np.log(vec[nz])
+    return vec
+
+
+class _UserIndex:
+    def __init__(self, dim: int, max_docs: int) -> None:
+        import numpy as np
+
+        self.dim = dim
+        self.max_docs = max_docs
+        self.n = 0
+        self.last_id = 0
+        self.ids = np.zeros(16, dtype=np.int64)
+        self.vecs = np.zeros((16, dim), dtype=np.float16)
+        self.df = np.zeros(dim, dtype=np.float32)
+        self.texts: List[Tuple[str, str]] = []
+
+    def add(self, ex_id: int, user: str, reply: str) -> None:
+        import numpy as np
+
+        if self.n == self.max_docs:
+            self._compact(self.max_docs * 3 // 4)
+        if self.n == len(self.ids):
+            cap = min(len(self.ids) * 2, self.max_docs)
+            self.ids = np.resize(self.ids, cap)
+            vecs = np.zeros((cap, self.dim), dtype=np.float16)
+            vecs[: self.n] = self.vecs[: self.n]
+            self.vecs = vecs
+        vec = hashed_tf(f"{user}\n{reply}", self.dim)
+        norm = float(np.linalg.norm(vec))
+        self.vecs[self.n] = vec / norm if norm else vec
+        self.ids[self.n] = ex_id
+        self.df += vec > 0
+        self.texts.append((user, reply))
+        self.n += 1
+        self.last_id = max(self.last_id, ex_id)
+
+    def _compact(self, keep: int) -> None:
+        drop = self.n - keep
+        self.df -= (self.vecs[:drop] > 0).sum(axis=0)
+        self.ids[:keep] = self.ids[drop : self.n]
+        self.vecs[:keep] = self.vecs[drop : self.n]
+        self.vecs[keep:] = 0
+        del self.texts[:drop]
+        self.n = keep
+
+    def search(
+        self, query: str, k: int, skip: int, min_score: float
+    ) -> List[Tuple[int, str, str]]:
+        import numpy as np
+
+        n = self.n - skip
+        if n <= 0 or k <= 0:
+            return []
+        idf = np.log((self.n + 1) / (self.df + 1)) + 1.0
+        q = hashed_tf(query, self.dim) * idf
+        norm = float(np.linalg.norm(q))
+        if not norm:
+            return []
+        # Rows are unit-length tf vectors, so scores are cosines in [0, 1].
+        scores = self.vecs[:n].astype(np.float32) @ (q / norm)
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            (int(self.ids[i]), *self.texts[i]) for i in top if scores[i] >= min_score
+        ]
+
+
+class RecallIndex:
+    def __init__(
+        self,
+        store: UserStore,
+        dim: int = RECALL_DIM,
+        max_docs: int = RECALL_MAX_DOCS,
+        max_users: int = RECALL_USERS,
+    ) -> None:
+        self.store = store
+        self.dim = dim
+        self.max_docs = max_docs
+        self.max_users = max_users
+        self._users: OrderedDict[str, _UserIndex] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index(self, uid: str) -> _UserIndex:
+        with self._lock:
+            idx = self._users.get(uid)
+            if idx is None:
+                idx = self._users[uid] = _UserIndex(self.dim, self.max_docs)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(uid)
+            # Pick up exchanges archived since the last look, including
+            # those written by the other process (bot or web UI).
+            for ex_id, user, reply in self.store.exchanges(uid, idx.last_id, self.max_docs):
+                idx.add(ex_id, user, reply)
+            return idx
+
+    def add(self, uid: str, ex_id: int, user: str, reply: str) -> None:
+        """Add a just-archived exchange if ``uid``'s index is loaded."""
+
+        with self._lock:
+            idx = self._users.get(uid)
+            if idx is not None and ex_id > idx.last_id:
+                idx.add(ex_id, user, reply)
+
+    def drop(self, uid: str) -> None:
+        with self._lock:
+            self._users.pop(uid, None)
+
+    def search(
+        self, uid: str, query: str, k: int = RECALL_K, skip: int = 0
+    ) -> List[Tuple[int, str, str]]:
+        """Most relevant ``(id, user, reply)`` exchanges of ``uid``, best first.
+
+        The newest ``skip`` exchanges (those already in the prompt) are
+        excluded.
+        """
+
+        idx = self._index(uid)
+        with self._lock:
+            return idx.search(query, k, skip, RECALL_MIN_SCORE)
+
+
+def format_exchange(user: str, reply: str) -> str:
+    def cut(text: str) -> str:
+        text = " ".join(text.split())
+        return text if len(text) <= RECALL_CHARS else text[: RECALL_CHARS - 1] + "…"
+
+    return f"User: {cut(user)}\nRequiem: {cut(reply)}"
+
+
+def exchanges_in(turns: int) -> int:
+    """Number of exchanges covered by the newest ``turns`` history turns."""
+
+    return math.ceil(turns / 2)
+
+
+__all__ = ["RECALL", "RECALL_BUDGET", "RecallIndex", "exchanges_in", "format_exchange", "hashed_tf"]
@@ -0,0 +1,156 @@
+"""Hot reload of ``memory.md`` and ``go2_data.json``.
+
+:data:`RELOADER` polls the files' mtime and size every ``RELOAD_INTERVAL``
+seconds. When one changes, it is parsed and its derived structures (the
+:class:`kb_index.KBIndex`, the orchestrator's prompt head) are built in a
+worker thread, then swapped in with a single assignment, so requests see
+either the old or the new version and never wait for a rebuild. A file that
+fails to parse (for example half-written) keeps the previous version in
+place until it changes again. The reply cache (see :mod:`reply_cache`) is
+cleared; other caches, such as the intent cache, do not depend on these
+files and are kept.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import core
+from kb_index import KBIndex
+from metrics import METRICS
+from reply_cache import REPLIES
+
+RELOAD = os.getenv("RELOAD", "1") != "0"
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", "2"))
+
+RELOAD_SECONDS = METRICS.histogram(
+    "requiem_reload_seconds", "Time to load and swap in a watched file"
+)
+RELOADS = METRICS.counter("requiem_reloads_total", "File reloads, by file and result")
+
+
+@dataclass
+class Watched:
+    name: str
+    path: Path
+    load: Callable[[Path], Any]
+    listeners: List[Callable[[Any], None]] = field(default_factory=list)
+    sig: Tuple[int, int] | None = None
+    seconds: float = 0.0
+    loaded_at: float = 0.0
+    error: str = ""
+
+
+def _sig(path: Path) -> Tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class Reloader:
+    def __init__(self, interval: float = RELOAD_INTERVAL) -> None:
+        self.interval = interval
+        self.files: Dict[str, Watched] = {}
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    def watch(self, name: str, path: Path, load: Callable[[Path], Any]) -> None:
+        """Watch ``path``; ``load`` turns it into the value listeners receive.
+
+        The file as it is now is taken to be loaded already.
+        """
+
+        self.files[name] = Watched(name, Path(path), load, sig=_sig(Path(path)))
+
+    def subscribe(self, name: str, listener: Callable[[Any], None]) -> None:
+        """Call ``listener`` with each newly loaded value of ``name``.
+
+        Listeners run in the reloader's worker thread and should only swap
+        references.
+        """
+
+        self.files[name].listeners.append(listener)
+
+    def check(self, force: bool = False) -> List[Watched]:
+        """Reload the files that changed (all of them with ``force``)."""
+
+        done = []
+        with self._lock:
+            for w in self.files.values():
+                sig = _sig(w.path)
+                if sig == w.sig and not force:
+                    continue
+                start = time.perf_counter()
+                try:
+                    value = w.load(w.path)
+                    for listener in w.listeners:
+                        listener(value)
+                except Exception as exc:
+                    w.error = f"{type(exc).__name__}: {exc}"
+                    RELOADS.inc(file=w.name, result="error")
+                    print(f"Reload of {w.path.name} failed, keeping the old version: {w.error}")
+                else:
+                    w.seconds = time.perf_counter() - start
+                    w.loaded_at = time.time()
+                    w.error = ""
+                    RELOAD_SECONDS.observe(w.seconds, file=w.name)
+                    RELOADS.inc(file=w.name, result="ok")
+                    print(f"Reloaded {w.path.name} in {w.seconds * 1000:.1f} ms")
+                w.sig = sig
+                done.append(w)
+        return done
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.check)
+            except Exception:  # pragma: no cover - defensive
+                traceback.print_exc()
+
+    def start(self) -> asyncio.Task:
+        """Start polling (once per process; later calls return the same task)."""
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+
+def _load_memory(path: Path) -> str:
+    return path.read_text(encoding="utf-8") if path.exists() else ""
+
+
+def _load_go2(path: Path) -> Tuple[Dict[str, Any], KBIndex]:
+    data = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+    return data, KBIndex(data)
+
+
+def _swap_memory(text: str) -> None:
+    core.GLOBAL_MEMORY = text
+
+
+def _swap_go2(value: Tuple[Dict[str, Any], KBIndex]) -> None:
+    # lookup_go2 only reads GO2_INDEX, so this one assignment is the swap.
+    core.GO2_DATA, core.GO2_INDEX = value
+
+
+RELOADER = Reloader()
+RELOADER.watch("memory", core.MEMORY_FILE, _load_memory)
+RELOADER.subscribe("memory", _swap_memory)
+RELOADER.watch("go2", core.GO2_DATA_FILE, _load_go2)
+RELOADER.subscribe("go2", _swap_go2)
+if REPLIES is not None:
+    # Keys already change with the files; this just frees the stale entries.
+    RELOADER.subscribe("memory", lambda _: REPLIES.clear())
+    RELOADER.subscribe("go2", lambda _: REPLIES.clear())
+
+__all__ = ["RELOAD", "RELOADER", "Reloader", "Watched"]
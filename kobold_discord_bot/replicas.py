@@ -0,0 +1,251 @@
+"""Load balancing and circuit breaking across replicas of one model role.
+
+``INTENT_URL``, ``THOUGHTS_URL`` and ``KOBOLD_URL`` may each list several
+KoboldCPP servers separated by commas. A :class:`ReplicaPool` sends every
+request to the available replica with the fewest outstanding requests and,
+if that replica fails (connection error, timeout or 5xx), retries once on
+each other replica before giving up.
+
+Each replica has a circuit breaker. After ``BREAKER_FAILURES`` consecutive
+failures it opens and the replica gets no traffic for ``BREAKER_COOLDOWN``
+seconds. After that, one trial request is let through, and its result closes
+or re-opens the breaker. A background health check polls every replica's
+``/api/v1/model`` every ``HEALTH_INTERVAL`` seconds, so a replica that goes
+down is taken out before users hit it and one that comes back is used again
+without waiting for a trial. When every breaker is open, requests fail at
+once with :class:`Unavailable` instead of waiting for a timeout.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple
+
+import aiohttp
+
+from core import client_timeout
+from metrics import METRICS
+from scheduler import Overloaded
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "15"))
+HEALTH_INTERVAL = float(os.getenv("HEALTH_INTERVAL", "10"))
+HEALTH_TIMEOUT = float(os.getenv("HEALTH_TIMEOUT", "3"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+FAILOVERS = METRICS.counter(
+    "requiem_replica_failovers_total", "Requests retried on another replica, by backend"
+)
+BREAKER_TRIPS = METRICS.counter(
+    "requiem_breaker_trips_total", "Circuit breakers opened, by backend and replica"
+)
+
+
+class Unavailable(Overloaded):
+    """Raised when every replica of a backend has an open circuit breaker."""
+
+
+def replica_fault(exc: BaseException) -> bool:
+    """Whether ``exc`` says the replica is unwell (rather than the request bad)."""
+
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class Replica:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.state = CLOSED
+        self.outstanding = 0
+        self.failures = 0
+        self.opened_at = 0.0
+        self.requests = 0
+        self.errors = 0
+        self._trial = False
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = HALF_OPEN
+        return self.state == HALF_OPEN and not self._trial
+
+    def begin(self) -> None:
+        self.outstanding += 1
+        self.requests += 1
+        if self.state == HALF_OPEN:
+            self._trial = True
+
+    def end(self) -> None:
+        self.outstanding -= 1
+        self._trial = False
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.state = CLOSED
+
+    def failed(self, role: str) -> None:
+        self.errors += 1
+        self.failures += 1
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= BREAKER_FAILURES
+        ):
+            self.trip(role)
+
+    def trip(self, role: str) -> None:
+        if self.state != OPEN:
+            BREAKER_TRIPS.inc(backend=role, replica=self.url)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+
+class ReplicaPool:
+    def __init__(
+        self,
+        role: str,
+        urls: Sequence[str],
+        session: aiohttp.ClientSession,
+        health_interval: float = HEALTH_INTERVAL,
+    ) -> None:
+        if not urls:
+            raise ValueError(f"no endpoints configured for {role}")
+        self.role = role
+        self.replicas = [Replica(u) for u in urls]
+        self.sess = session
+        self.health_interval = health_interval
+        self._rr = 0
+        self._health: asyncio.Task | None = None
+        self._closed = False
+        _register(self)
+
+    def pick(self, exclude: Sequence[Replica] = ()) -> Replica:
+        """Available replica with the fewest outstanding requests."""
+
+        now = time.monotonic()
+        candidates = [r for r in self.replicas if r not in exclude and r.available(now)]
+        if not candidates:
+            raise Unavailable(f"{self.role} backend is unavailable, try again shortly")
+        least = min(r.outstanding for r in candidates)
+        tied = [r for r in candidates if r.outstanding == least]
+        # Rotate among equally loaded replicas so idle ones share the work.
+        self._rr += 1
+        return tied[self._rr % len(tied)]
+
+    @asynccontextmanager
+    async def lease(self, exclude: Sequence[Replica] = ()) -> AsyncIterator[Replica]:
+        """Hold a replica for one request and record how it went."""
+
+        self._ensure_health()
+        replica = self.pick(exclude)
+        replica.begin()
+        try:
+            yield replica
+        except BaseException as exc:
+            if replica_fault(exc):
+                replica.failed(self.role)
+            elif not isinstance(exc, asyncio.CancelledError):
+                replica.succeeded()
+            raise
+        else:
+            replica.succeeded()
+        finally:
+            replica.end()
+
+    def failover(self, exc: BaseException, tried: Sequence[Replica]) -> bool:
+        """Whether a request that failed with ``exc`` should try another replica."""
+
+        if not replica_fault(exc):
+            return False
+        now = time.monotonic()
+        if any(r not in tried and r.available(now) for r in self.replicas):
+            FAILOVERS.inc(backend=self.role)
+            return True
+        return False
+
+    def _ensure_health(self) -> None:
+        if self._closed or self.health_interval <= 0:
+            return
+        if self._health is None or self._health.done():
+            self._health = asyncio.ensure_future(self._health_loop())
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self.probe(r) for r in self.replicas))
+
+    async def probe(self, replica: Replica) -> bool:
+        """Check one replica; any HTTP answer below 500 counts as up."""
+
+        try:
+            async with self.sess.get(
+                f"{replica.url}/api/v1/model", timeout=client_timeout(HEALTH_TIMEOUT)
+            ) as r:
+                up = r.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            up = False
+        if up and replica.state != CLOSED:
+            replica.succeeded()
+        elif not up:
+            replica.trip(self.role)
+        return up
+
+    def close(self) -> None:
+        """Stop health checks (requests are still served)."""
+
+        self._closed = True
+        if self._health is not None:
+            self._health.cancel()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "url": r.url,
+                "state": r.state,
+                "outstanding": r.outstanding,
+                "requests": r.requests,
+                "errors": r.errors,
+            }
+            for r in self.replicas
+        ]
+
+
+# The newest pool per role; the metrics collector and !stats report these.
+POOLS: Dict[str, ReplicaPool] = {}
+
+
+def _register(pool: ReplicaPool) -> None:
+    old = POOLS.get(pool.role)
+    if old is not None and old is not pool:
+        old.close()
+    POOLS[pool.role] = pool
+
+
+def _samples() -> List[Tuple[str, str, str, Dict[str, Any], float]]:
+    out = []
+    for role, pool in POOLS.items():
+        for r in pool.replicas:
+            labels = {"backend": role, "replica": r.url}
+            out += [
+                ("requiem_replica_outstanding", "gauge", "Requests in flight per replica", labels, r.outstanding),
+                ("requiem_replica_up", "gauge", "1 unless the replica's breaker is open", labels, float(r.state != OPEN)),
+                ("requiem_replica_requests_total", "counter", "Requests sent per replica", labels, r.requests),
+            ]
+    return out
+
+
+METRICS.register_collector(_samples)
+
+__all__ = [
+    "CLOSED",
+    "HALF_OPEN",
+    "OPEN",
+    "POOLS",
+    "Replica",
+    "ReplicaPool",
+    "Unavailable",
+    "replica_fault",
+]
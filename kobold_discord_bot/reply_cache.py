@@ -0,0 +1,99 @@
+"""Cache of final replies to repeated factual questions.
+
+GO2 questions ("what does X do", "best ship for Y") come up again and again,
+and each would otherwise cost the full intent → plan → emotion → core →
+coherence pipeline. With ``REPLY_CACHE=1`` the orchestrator looks the message
+up before doing any model work and answers from here on a hit.
+
+An entry's key covers the inputs that all users share: the normalized
+English message, the GO2 facts that :func:`core.lookup_go2` found for it,
+and the version of the system prompt and shared memory. Editing
+``go2_data.json`` or ``memory.md`` therefore cannot serve a stale answer, and
+:mod:`reloader` also clears the cache when either changes.
+
+A reply is shared between users, so the cache only applies to answers
+grounded in GO2 facts. Messages for which :func:`core.lookup_go2` found
+nothing are neither looked up nor stored. The same goes for messages that
+refer to the user or the conversation ("my", "we", "remember", ...). Their
+replies come from that user's history, summary and recalled exchanges. Only
+replies to messages classified as plain questions with at least
+``REPLY_CACHE_MIN_CONFIDENCE`` confidence, produced with the coherence check
+on (see :mod:`degrade`), are stored. Users who want fresh answers can opt
+out with ``!fresh on``.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import Any, Dict
+
+from cache import TTLCache
+from kb_index import tokenize
+
+REPLY_CACHE = os.getenv("REPLY_CACHE", "0") == "1"
+REPLY_CACHE_SIZE = int(os.getenv("REPLY_CACHE_SIZE", "1024"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", "3600"))
+REPLY_CACHE_FILE = os.getenv("REPLY_CACHE_FILE", "")
+REPLY_CACHE_MIN_CONFIDENCE = float(os.getenv("REPLY_CACHE_MIN_CONFIDENCE", "0.8"))
+
+# Per-user preference (see storage.UserStore.set_pref) that bypasses the cache.
+FRESH_PREF = "fresh_replies"
+
+# Words that make a reply depend on who is asking.
+PERSONAL_WORDS = frozenset(
+    """
+    i me my mine myself we us our ours ourselves remember remind recall
+    earlier yesterday before last previous told said again
+    """.split()
+)
+
+
+def normalize(text: str) -> str:
+    """Case, punctuation and spacing insensitive form of ``text``."""
+
+    return " ".join(tokenize(text))
+
+
+class ReplyCache(TTLCache):
+    @staticmethod
+    def applies(message: str, kb: str) -> bool:
+        """Whether ``message`` may be answered from (and stored in) the cache."""
+
+        return bool(kb.strip()) and not PERSONAL_WORDS.intersection(tokenize(message))
+
+    def key(self, message: str, kb: str, version: str) -> str:
+        data = "\x00".join((normalize(message), kb.strip(), version))
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def cacheable(intent: Dict[str, Any]) -> bool:
+        flags = intent.get("flags") or {}
+        return (
+            intent.get("intent") == "question"
+            and float(intent.get("confidence") or 0.0) >= REPLY_CACHE_MIN_CONFIDENCE
+            and not any(flags.get(f) for f in ("needs_image", "needs_admin", "risky"))
+        )
+
+    def store(self, key: str, intent: Dict[str, Any], reply: str) -> bool:
+        """Remember ``reply`` if ``intent`` makes it reusable."""
+
+        if not reply or not self.cacheable(intent):
+            return False
+        self.set(key, {"intent": intent, "reply": reply})
+        return True
+
+
+REPLIES = (
+    ReplyCache(REPLY_CACHE_SIZE, REPLY_CACHE_TTL, REPLY_CACHE_FILE or None)
+    if REPLY_CACHE
+    else None
+)
+
+__all__ = [
+    "FRESH_PREF",
+    "PERSONAL_WORDS",
+    "REPLIES",
+    "REPLY_CACHE",
+    "ReplyCache",
+    "normalize",
+]
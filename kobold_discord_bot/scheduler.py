@@ -0,0 +1,157 @@
+"""Per-backend admission control with round-robin fairness across users.
+
+Each model backend (intent, thoughts, core, Stable Diffusion) has its own
+number of concurrent slots and a bounded wait queue. Waiting requests are
+grouped per user and served round-robin, so one chatty user cannot occupy
+every slot, and a request that would overflow the queue is rejected with
+:class:`Overloaded` immediately instead of timing out later.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, List, Tuple
+
+from core import INTENT_URLS, KOBOLD_URLS, MAX_WORKERS, THOUGHTS_URLS
+from metrics import METRICS, QUEUE_WAIT_SECONDS
+
+BACKENDS = ("intent", "thoughts", "core", "sd")
+REPLICAS = {"intent": len(INTENT_URLS), "thoughts": len(THOUGHTS_URLS), "core": len(KOBOLD_URLS)}
+
+# The user on whose behalf model requests are made; set by the orchestrator.
+CURRENT_USER: ContextVar[Hashable] = ContextVar("CURRENT_USER", default=None)
+
+
+class Overloaded(RuntimeError):
+    """Raised when a backend's wait queue is full."""
+
+
+class BackendQueue:
+    def __init__(self, name: str, capacity: int, max_queue: int) -> None:
+        self.name = name
+        self.capacity = max(capacity, 1)
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self._waiting: OrderedDict[Hashable, Deque[asyncio.Future]] = OrderedDict()
+
+    async def acquire(self, user: Hashable = None) -> None:
+        if self.active < self.capacity and not self.queued:
+            self.active += 1
+            QUEUE_WAIT_SECONDS.observe(0.0, backend=self.name)
+            return
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(f"{self.name} backend is overloaded, try again shortly")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user, deque()).append(fut)
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over just as we were cancelled.
+                self.release()
+            else:
+                self._forget(user, fut)
+            raise
+        finally:
+            waited = time.monotonic() - start
+            self.wait_seconds += waited
+            QUEUE_WAIT_SECONDS.observe(waited, backend=self.name)
+
+    def _forget(self, user: Hashable, fut: asyncio.Future) -> None:
+        waiters = self._waiting.get(user)
+        if waiters and fut in waiters:
+            waiters.remove(fut)
+            self.queued -= 1
+            if not waiters:
+                del self._waiting[user]
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.active < self.capacity and self._waiting:
+            user, waiters = next(iter(self._waiting.items()))
+            fut = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                # Round robin: this user goes to the back of the line.
+                self._waiting.move_to_end(user)
+            else:
+                del self._waiting[user]
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user: Hashable = None) -> AsyncIterator[None]:
+        await self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "users_waiting": len(self._waiting),
+        }
+
+
+class Scheduler:
+    """One :class:`BackendQueue` per backend."""
+
+    def __init__(self, limits: Dict[str, tuple[int, int]]) -> None:
+        self.queues = {name: BackendQueue(name, cap, q) for name, (cap, q) in limits.items()}
+
+    @classmethod
+    def from_env(cls) -> "Scheduler":
+        limits = {}
+        for name in BACKENDS:
+            # MAX_WORKERS slots per replica of each model role.
+            default = 1 if name == "sd" else MAX_WORKERS * REPLICAS[name]
+            cap = int(os.getenv(f"SCHED_{name.upper()}_CAPACITY", str(default)))
+            limits[name] = (cap, int(os.getenv(f"SCHED_{name.upper()}_QUEUE", str(8 * cap))))
+        return cls(limits)
+
+    def slot(self, backend: str, user: Hashable = None):
+        """Async context manager holding one ``backend`` slot.
+
+        ``user`` defaults to :data:`CURRENT_USER`.
+        """
+
+        return self.queues[backend].slot(CURRENT_USER.get() if user is None else user)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: q.stats() for name, q in self.queues.items()}
+
+    def samples(self) -> List[Tuple[str, str, str, Dict[str, Any], float]]:
+        """Queue gauges and counters for :meth:`metrics.Registry.render`."""
+
+        out = []
+        for name, q in self.queues.items():
+            labels = {"backend": name}
+            out += [
+                ("requiem_backend_active", "gauge", "Requests holding a backend slot", labels, q.active),
+                ("requiem_backend_queued", "gauge", "Requests waiting for a backend slot", labels, q.queued),
+                ("requiem_backend_capacity", "gauge", "Concurrent slots per backend", labels, q.capacity),
+                ("requiem_backend_rejected_total", "counter", "Requests rejected as overloaded", labels, q.rejected),
+            ]
+        return out
+
+
+SCHEDULER = Scheduler.from_env()
+METRICS.register_collector(SCHEDULER.samples)
+
+__all__ = ["CURRENT_USER", "SCHEDULER", "BackendQueue", "Overloaded", "Scheduler"]
@@ -0,0 +1,127 @@
+"""Startup timing and background warm-up.
+
+Importing the bot is kept cheap: ``core`` imports ``langdetect`` and
+``deep_translator`` only when they are first used, :mod:`recall` imports
+NumPy on its first search, ``go2_data.json`` is parsed and indexed on the
+first GO2 lookup, and user data is read from SQLite one user at a time.
+Paying for all of that in the first reply would only move the delay, so
+once the bot has logged in (or the web UI has started) :func:`warm_up` loads
+them in a worker thread while the bot is already online.
+
+:data:`STARTUP` records when each phase finished, counted from the moment
+this module was imported, which the entry points do first. The breakdown is
+printed after the warm-up, shown by ``!stats`` and exported as
+``requiem_startup_seconds``. For a per-module view of the import phase run
+``python -X importtime bot.py``.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Tuple
+
+from metrics import METRICS
+
+T0 = time.perf_counter()
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+
+
+class Startup:
+    def __init__(self, t0: float = T0) -> None:
+        self.t0 = t0
+        # Phase -> seconds since t0 (marks) or seconds taken (warm-up steps).
+        self.phases: Dict[str, float] = {}
+        self.warm: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> float:
+        """Record that ``phase`` finished now; returns seconds since start."""
+
+        elapsed = time.perf_counter() - self.t0
+        self.phases[phase] = elapsed
+        return elapsed
+
+    def mark_once(self, phase: str) -> None:
+        if phase not in self.phases:
+            self.mark(phase)
+
+    def report(self) -> str:
+        parts = [f"{name} {sec:.2f}s" for name, sec in self.phases.items()]
+        line = "Startup: " + ", ".join(parts) if parts else "Startup: -"
+        if self.warm:
+            warm = ", ".join(f"{name} {sec * 1000:.0f} ms" for name, sec in self.warm.items())
+            line += f"\nWarm-up: {warm}"
+        return line
+
+    def _samples(self) -> List[Tuple[str, str, str, Dict[str, Any], float]]:
+        out = [
+            ("requiem_startup_seconds", "gauge", "Seconds from start until each startup phase finished", {"phase": p}, s)
+            for p, s in self.phases.items()
+        ]
+        out += [
+            ("requiem_warmup_seconds", "gauge", "Seconds taken by each background warm-up step", {"step": p}, s)
+            for p, s in self.warm.items()
+        ]
+        return out
+
+
+STARTUP = Startup()
+METRICS.register_collector(STARTUP._samples)
+
+
+def _detector() -> None:
+    import core
+
+    # The first detection loads langdetect's language profiles.
+    core.detect_language("Warming up the language detector.")
+
+
+def _translator() -> None:
+    import deep_translator  # noqa: F401
+
+
+def _go2() -> None:
+    import core
+
+    core.go2_index()
+
+
+def _recall() -> None:
+    import core
+
+    if core.USER_RECALL is not None:
+        import numpy  # noqa: F401
+
+
+WARM_STEPS: List[Tuple[str, Callable[[], None]]] = [
+    ("language_detector", _detector),
+    ("translator", _translator),
+    ("go2_index", _go2),
+    ("recall", _recall),
+]
+
+
+def _warm_all() -> None:
+    for name, step in WARM_STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            # Whatever failed here is loaded (or fails) again on first use.
+            traceback.print_exc()
+            continue
+        STARTUP.warm[name] = time.perf_counter() - start
+
+
+async def warm_up() -> None:
+    """Load the lazily imported pieces in a worker thread, then print timings."""
+
+    if STARTUP_WARMUP:
+        await asyncio.to_thread(_warm_all)
+        STARTUP.mark("warm")
+    print(STARTUP.report())
+
+
+__all__ = ["STARTUP", "STARTUP_WARMUP", "Startup", "T0", "warm_up"]
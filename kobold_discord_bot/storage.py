@@ -0,0 +1,303 @@
+"""Per-user conversation store shared by the Discord bot and the web UI.
+
+Data lives in a SQLite database in WAL mode, so both processes can read while
+one of them writes, and every update only touches the rows of the user that
+changed instead of rewriting the whole file.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    emotion TEXT NOT NULL DEFAULT 'neutral',
+    summary TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_uid ON turns (uid, id);
+CREATE TABLE IF NOT EXISTS exchanges (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT NOT NULL,
+    user TEXT NOT NULL,
+    reply TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exchanges_uid ON exchanges (uid, id);
+CREATE TABLE IF NOT EXISTS prefs (
+    uid TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (uid, key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _pairs(turns: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """``(user, reply)`` for each user turn directly followed by a reply."""
+
+    return [
+        (a[1], b[1])
+        for a, b in zip(turns, turns[1:])
+        if a[0] == "user" and b[0] == "assistant"
+    ]
+
+
+class UserStore:
+    """Transactional store for per-user history, emotion, summary and prefs."""
+
+    def __init__(self, path: Path, max_turns: int = 200, max_exchanges: int = 5000) -> None:
+        self.path = Path(path)
+        self.max_turns = max_turns
+        self.max_exchanges = max_exchanges
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+        self._backfill_exchanges()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, and the bot
+        # runs some helpers in worker threads.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        # IMMEDIATE takes the write lock up front, so two processes updating
+        # the same user wait for each other instead of failing mid-transaction.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, uid: str) -> Dict[str, Any]:
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT emotion, summary FROM users WHERE uid = ?", (uid,)
+        ).fetchone()
+        emotion, summary = row if row else ("neutral", "")
+        history = [
+            {"role": role, "content": content}
+            for role, content in conn.execute(
+                "SELECT role, content FROM turns WHERE uid = ? ORDER BY id", (uid,)
+            )
+        ]
+        prefs = dict(conn.execute("SELECT key, value FROM prefs WHERE uid = ?", (uid,)))
+        return {"history": history, "emotion": emotion, "summary": summary, "prefs": prefs}
+
+    def _ensure_user(self, conn: sqlite3.Connection, uid: str) -> None:
+        conn.execute("INSERT OR IGNORE INTO users (uid) VALUES (?)", (uid,))
+
+    def _archive(self, conn: sqlite3.Connection, uid: str, pairs: List[Tuple[str, str]]) -> None:
+        conn.executemany(
+            "INSERT INTO exchanges (uid, user, reply) VALUES (?, ?, ?)",
+            [(uid, user, reply) for user, reply in pairs],
+        )
+        conn.execute(
+            "DELETE FROM exchanges WHERE uid = ? AND id <= ("
+            "SELECT id FROM exchanges WHERE uid = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (uid, uid, self.max_exchanges),
+        )
+
+    def _backfill_exchanges(self) -> None:
+        """Archive the stored turns of databases created before ``exchanges``.
+
+        Runs once per database (recorded in ``meta``). Users that already
+        have archived exchanges were written by :meth:`append_exchange`,
+        which archives as it goes, and are left alone.
+        """
+
+        with self._write() as conn:
+            if conn.execute(
+                "SELECT value FROM meta WHERE key = 'exchanges_backfilled'"
+            ).fetchone():
+                return
+            uids = [
+                uid
+                for (uid,) in conn.execute(
+                    "SELECT DISTINCT uid FROM turns WHERE uid NOT IN (SELECT uid FROM exchanges)"
+                )
+            ]
+            for uid in uids:
+                turns = conn.execute(
+                    "SELECT role, content FROM turns WHERE uid = ? ORDER BY id", (uid,)
+                ).fetchall()
+                self._archive(conn, uid, _pairs(turns))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('exchanges_backfilled', '1')")
+
+    def _append_turns(self, conn: sqlite3.Connection, uid: str, turns: List[Dict[str, str]]) -> None:
+        self._ensure_user(conn, uid)
+        conn.executemany(
+            "INSERT INTO turns (uid, role, content) VALUES (?, ?, ?)",
+            [(uid, t.get("role", "user"), t.get("content", "")) for t in turns],
+        )
+        conn.execute(
+            "DELETE FROM turns WHERE uid = ? AND id <= ("
+            "SELECT id FROM turns WHERE uid = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (uid, uid, self.max_turns),
+        )
+
+    def append_turns(self, uid: str, turns: List[Dict[str, str]]) -> None:
+        """Append ``turns`` and drop the oldest ones beyond ``max_turns``."""
+
+        with self._write() as conn:
+            self._append_turns(conn, uid, turns)
+
+    def append_exchange(self, uid: str, user: str, reply: str) -> int:
+        """Append a user/assistant turn pair and archive it; return its id.
+
+        The archive (``exchanges``) is not trimmed with the turns or folded
+        by the summarizer, so older conversation stays searchable; it keeps
+        the newest ``max_exchanges`` per user.
+        """
+
+        with self._write() as conn:
+            self._append_turns(
+                conn,
+                uid,
+                [{"role": "user", "content": user}, {"role": "assistant", "content": reply}],
+            )
+            self._archive(conn, uid, [(user, reply)])
+            (ex_id,) = conn.execute(
+                "SELECT MAX(id) FROM exchanges WHERE uid = ?", (uid,)
+            ).fetchone()
+        return int(ex_id)
+
+    def exchanges(self, uid: str, after_id: int = 0, limit: int = -1) -> List[Tuple[int, str, str]]:
+        """Archived exchanges of ``uid`` newer than ``after_id``, oldest first.
+
+        With ``limit`` only the newest ``limit`` of them are returned.
+        """
+
+        rows = self._conn().execute(
+            "SELECT id, user, reply FROM exchanges WHERE uid = ? AND id > ? "
+            "ORDER BY id DESC LIMIT ?",
+            (uid, after_id, limit),
+        ).fetchall()
+        rows.reverse()
+        return rows
+
+    def set_emotion(self, uid: str, emotion: str) -> None:
+        with self._write() as conn:
+            self._ensure_user(conn, uid)
+            conn.execute("UPDATE users SET emotion = ? WHERE uid = ?", (emotion, uid))
+
+    def set_summary(self, uid: str, summary: str) -> None:
+        with self._write() as conn:
+            self._ensure_user(conn, uid)
+            conn.execute("UPDATE users SET summary = ? WHERE uid = ?", (summary, uid))
+
+    def set_pref(self, uid: str, key: str, value: str | None) -> None:
+        """Set a per-user preference; ``None`` removes it."""
+
+        with self._write() as conn:
+            if value is None:
+                conn.execute("DELETE FROM prefs WHERE uid = ? AND key = ?", (uid, key))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO prefs (uid, key, value) VALUES (?, ?, ?)",
+                    (uid, key, value),
+                )
+
+    def users_over(self, turns: int) -> List[str]:
+        """Return the users with more than ``turns`` stored turns."""
+
+        rows = self._conn().execute(
+            "SELECT uid FROM turns GROUP BY uid HAVING COUNT(*) > ?", (turns,)
+        )
+        return [uid for (uid,) in rows]
+
+    def oldest_turns(self, uid: str, n: int) -> List[Tuple[int, str, str]]:
+        """Return the ``n`` oldest turns of ``uid`` as ``(id, role, content)``."""
+
+        return self._conn().execute(
+            "SELECT id, role, content FROM turns WHERE uid = ? ORDER BY id LIMIT ?",
+            (uid, n),
+        ).fetchall()
+
+    def fold(self, uid: str, summary: str, upto_id: int) -> bool:
+        """Replace the summary and drop turns up to ``upto_id`` atomically.
+
+        Returns ``False`` without changing anything if those turns are already
+        gone (the user was forgotten or another process folded them first).
+        """
+
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM turns WHERE uid = ? AND id <= ?", (uid, upto_id)
+            ).fetchone()
+            if not row[0]:
+                return False
+            conn.execute("DELETE FROM turns WHERE uid = ? AND id <= ?", (uid, upto_id))
+            self._ensure_user(conn, uid)
+            conn.execute("UPDATE users SET summary = ? WHERE uid = ?", (summary, uid))
+        return True
+
+    def delete(self, uid: str) -> None:
+        with self._write() as conn:
+            conn.execute("DELETE FROM turns WHERE uid = ?", (uid,))
+            conn.execute("DELETE FROM exchanges WHERE uid = ?", (uid,))
+            conn.execute("DELETE FROM prefs WHERE uid = ?", (uid,))
+            conn.execute("DELETE FROM users WHERE uid = ?", (uid,))
+
+    def migrate_json(self, path: Path) -> int:
+        """Import a legacy ``user_memory.json`` once; return the user count.
+
+        The import runs in a single transaction and is recorded in the
+        ``meta`` table, so later calls (from either process) are no-ops. The
+        whole history is archived as exchanges; the newest ``max_turns`` of
+        it are also kept as turns.
+        """
+
+        path = Path(path)
+        with self._write() as conn:
+            done = conn.execute(
+                "SELECT value FROM meta WHERE key = 'json_migrated'"
+            ).fetchone()
+            if done or not path.exists():
+                return 0
+            data = json.loads(path.read_text(encoding="utf-8") or "{}")
+            for uid, entry in data.items():
+                if isinstance(entry, list):
+                    entry = {"history": entry}
+                uid = str(uid)
+                conn.execute(
+                    "INSERT OR REPLACE INTO users (uid, emotion, summary) VALUES (?, ?, ?)",
+                    (uid, entry.get("emotion", "neutral"), entry.get("summary", "")),
+                )
+                turns = [
+                    (t.get("role", "user"), t.get("content", "")) for t in entry.get("history", [])
+                ]
+                conn.executemany(
+                    "INSERT INTO turns (uid, role, content) VALUES (?, ?, ?)",
+                    [(uid, role, content) for role, content in turns[-self.max_turns :]],
+                )
+                self._archive(conn, uid, _pairs(turns))
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(path),)
+            )
+        return len(data)
+
+
+__all__ = ["UserStore"]
@@ -0,0 +1,133 @@
+"""Background worker that folds old dialogue into each user's summary.
+
+When a user's stored history grows past ``SUMMARY_TRIGGER`` turns, the oldest
+turns (all but the newest ``SUMMARY_KEEP``) are merged into the ``summary``
+field by the thoughts model and then removed, so they are condensed before
+the store's turn limit would drop them. The worker only runs while every
+model backend has been idle for ``SUMMARY_IDLE`` seconds (its own requests do
+not count) and stops as soon as chat traffic resumes, so it never competes
+with live replies. Each prompt is kept within ``SUMMARY_CTX`` tokens: a long
+backlog is folded a chunk of turns at a time, oldest first.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import traceback
+from typing import List, Tuple
+
+from context import approx_tokens
+from orchestrator import Orchestrator
+from storage import UserStore
+
+SUMMARIZER = os.getenv("SUMMARIZER", "1") != "0"
+SUMMARY_TRIGGER = int(os.getenv("SUMMARY_TRIGGER", "120"))
+SUMMARY_KEEP = int(os.getenv("SUMMARY_KEEP", "80"))
+SUMMARY_IDLE = float(os.getenv("SUMMARY_IDLE", "5"))
+SUMMARY_INTERVAL = float(os.getenv("SUMMARY_INTERVAL", "30"))
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "250"))
+SUMMARY_CTX = int(os.getenv("SUMMARY_CTX", "4096"))
+# Characters of each turn shown to the model.
+TURN_CHARS = 600
+
+
+def _summary_prompt(summary: str, turns: List[Tuple[int, str, str]]) -> str:
+    lines = "\n".join(_line(role, content) for _, role, content in turns)
+    return (
+        f"Update the conversation summary with the dialogue below. Keep facts about the user, "
+        f"their goals, preferences and open questions. At most {SUMMARY_MAX_WORDS} words, "
+        "plain prose, no preamble.\n"
+        f"Current summary:\n{summary or '(none)'}\n"
+        f"Dialogue:\n{lines}\nUpdated summary:"
+    )
+
+
+def _line(role: str, content: str) -> str:
+    return f"{role}: {content[:TURN_CHARS]}"
+
+
+def fitting_turns(
+    summary: str, turns: List[Tuple[int, str, str]], max_len: int, ctx: int = SUMMARY_CTX
+) -> List[Tuple[int, str, str]]:
+    """The oldest ``turns`` whose summary prompt fits in ``ctx`` with ``max_len`` to spare.
+
+    KoboldCPP would otherwise cut the start of the prompt, which holds the
+    instruction and the current summary. At least one turn is always
+    returned so a backlog cannot stall.
+    """
+
+    budget = ctx - max_len - approx_tokens(_summary_prompt(summary, []))
+    out = []
+    for turn in turns:
+        budget -= approx_tokens(_line(turn[1], turn[2])) + 1
+        if budget < 0 and out:
+            break
+        out.append(turn)
+    return out
+
+
+class Summarizer:
+    def __init__(self, store: UserStore, orch: Orchestrator) -> None:
+        self.store = store
+        self.orch = orch
+        self.folded = 0
+        self._task: asyncio.Task | None = None
+
+    def _idle(self) -> bool:
+        return self.orch.idle_for() >= SUMMARY_IDLE
+
+    async def fold_user(self, uid: str) -> bool:
+        entry = await asyncio.to_thread(self.store.get, uid)
+        extra = len(entry["history"]) - SUMMARY_KEEP
+        if extra <= 0:
+            return False
+        max_len = SUMMARY_MAX_WORDS * 2
+        turns = await asyncio.to_thread(self.store.oldest_turns, uid, extra)
+        turns = fitting_turns(entry["summary"], turns, max_len)
+        if not turns:
+            return False
+        out = await self.orch.planner.gen(
+            _summary_prompt(entry["summary"], turns),
+            max_len=max_len,
+            ctx=SUMMARY_CTX,
+            temp=0.3,
+            top_p=0.9,
+            timeout=120,
+            background=True,
+        )
+        if not out:
+            return False
+        return await asyncio.to_thread(self.store.fold, uid, out, turns[-1][0])
+
+    async def run_once(self) -> int:
+        """Fold every user over the trigger while the backends stay idle."""
+
+        done = 0
+        for uid in await asyncio.to_thread(self.store.users_over, SUMMARY_TRIGGER):
+            # One chunk per call; keep going until the user is under SUMMARY_KEEP.
+            while self._idle() and await self.fold_user(uid):
+                done += 1
+            if not self._idle():
+                break
+        self.folded += done
+        return done
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(SUMMARY_INTERVAL)
+            if not self._idle():
+                continue
+            try:
+                await self.run_once()
+            except Exception:  # pragma: no cover - network errors
+                traceback.print_exc()
+
+    def start(self) -> asyncio.Task:
+        """Start the worker (once; later calls return the same task)."""
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+
+__all__ = ["SUMMARIZER", "Summarizer", "fitting_turns"]
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The bot's modules import each other by bare name (``import core``).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,12 @@
+from cache import TTLCache, _save_all
+
+
+def test_replaced_cache_does_not_overwrite_file(tmp_path):
+    path = tmp_path / "cache.json"
+    old = TTLCache(10, 60, path)
+    new = TTLCache(10, 60, path)
+    new.set("a", 1)
+    old.set("b", 2)
+    _save_all()
+    assert TTLCache(10, 60, path).get("a") == 1
+    assert TTLCache(10, 60, path).get("b") is None
@@ -0,0 +1,43 @@
+import pytest
+
+import fast_intent
+from fast_intent import FastIntent, load_log
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "draw up a plan for my fleet",
+        "sketch out a strategy for wave 30",
+        "Draw conclusions from this",
+        "paint the town red tonight?",
+        "draw the line somewhere",
+    ],
+)
+def test_idioms_are_not_image_requests(text):
+    js = FastIntent.rule(text)
+    assert js is None or js["intent"] != "image"
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "draw me a cat",
+        "please paint a sunset over the sea",
+        "can you sketch the mothership",
+        "generate an image of a frigate",
+    ],
+)
+def test_image_requests(text):
+    js = FastIntent.rule(text)
+    assert js["intent"] == "image" and js["flags"]["needs_image"]
+
+
+def test_rule_hits_are_logged_but_not_trained_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(fast_intent, "FAST_INTENT_AUDIT", 0.0)
+    log = tmp_path / "intent_log.jsonl"
+    fi = FastIntent(None, 0.95, log)
+    fi.predict("hello there")
+    fi.record("what is a frigate", {"intent": "question", "confidence": 0.9})
+    assert '"source": "rule"' in log.read_text(encoding="utf-8")
+    assert load_log(log) == [("what is a frigate", "question")]
@@ -0,0 +1,9 @@
+from images import ImageStore
+
+
+def test_prune_counts_evictions(tmp_path):
+    store = ImageStore(tmp_path, max_files=2)
+    for i in range(5):
+        store.put(f"k{i}", f"png{i}".encode())
+    assert len(list(tmp_path.glob("*.png"))) == 2
+    assert store.evictions == 3
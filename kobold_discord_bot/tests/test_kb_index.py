@@ -0,0 +1,38 @@
+import pytest
+
+from kb_index import KBIndex
+
+DATA = {
+    "resources": {
+        "metal": "Primary construction material for ships and buildings.",
+        "energy": "Fuel that powers ship systems and advanced research.",
+    },
+    "ships": {
+        "frigate": "Light, fast ship for scouting and hit-and-run attacks.",
+        "dreadnought": "Heavy battleship with massive defense and firepower.",
+    },
+    "commanders": {
+        "terra": "Commander focused on armor and defensive tactics.",
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "message",
+    ["thanks for that", "I like pizza and beer", "ok, see you later", "hi! how are you?"],
+)
+def test_small_talk_finds_nothing(message):
+    assert KBIndex(DATA).search(message) == []
+
+
+def test_questions_find_facts():
+    kb = KBIndex(DATA)
+    assert kb.search("what is a dreadnought")[0].startswith("Dreadnought")
+    assert kb.search("how do I get more metal")[0].startswith("Metal")
+    assert kb.search("frigates?")[0].startswith("Frigate")
+
+
+def test_min_score_cuts_weak_matches():
+    kb = KBIndex(DATA)
+    assert len(kb.search("ship", min_score=0.0)) == 3
+    assert kb.search("ship", min_score=100.0) == []
@@ -0,0 +1,77 @@
+import asyncio
+
+from orchestrator import DEFAULT_PLAN, DEFAULT_TONE, Intent, Orchestrator
+
+
+def _orch(plan, emotion_delay=5.0):
+    orch = Orchestrator("system", "", None, mode="concurrent", fast_intent=None, replies=None)
+    calls = []
+
+    async def classify(text):
+        return Intent("chat", 1.0, [])
+
+    async def plan_(message, intent):
+        await asyncio.sleep(0.01)
+        return plan
+
+    async def emotion(message, pl):
+        calls.append("emotion")
+        await asyncio.sleep(emotion_delay)
+        return "grim"
+
+    async def core_reply(history, text, it, pl, em, kb, summary):
+        calls.append(("reply", em))
+        return f"reply in {em}"
+
+    async def core_stream(history, text, it, pl, em, kb, summary):
+        calls.append(("stream", em))
+        for word in ("reply ", "in ", em):
+            await asyncio.sleep(0)
+            yield word
+
+    async def coherence(message, reply):
+        return True
+
+    orch.classify, orch.plan, orch.emotion = classify, plan_, emotion
+    orch.core_reply, orch.core_stream, orch.coherence = core_reply, core_stream, coherence
+    return orch, calls
+
+
+MATERIAL = dict(DEFAULT_PLAN, tool_calls=[{"name": "search"}])
+
+
+def _run(coro, limit=1.0):
+    return asyncio.run(asyncio.wait_for(coro, limit))
+
+
+def test_kept_draft_does_not_wait_for_emotion():
+    orch, _ = _orch(dict(DEFAULT_PLAN))
+    out = _run(orch.handle(1, [], "hi", use_cache=False))
+    assert out.emotion == DEFAULT_TONE
+    assert out.final == f"reply in {DEFAULT_TONE}"
+
+
+def test_streamed_draft_is_kept():
+    orch, calls = _orch(dict(DEFAULT_PLAN))
+    shown = []
+
+    async def on_token(token):
+        shown.append(token)
+
+    out = _run(orch.handle_stream(1, [], "hi", on_token=on_token, use_cache=False))
+    assert "".join(shown) == out.final == f"reply in {DEFAULT_TONE}"
+    assert out.emotion == DEFAULT_TONE
+    assert calls == [("stream", DEFAULT_TONE)]
+
+
+def test_streamed_draft_is_discarded_for_material_plan():
+    orch, calls = _orch(MATERIAL, emotion_delay=0.0)
+    shown = []
+
+    async def on_token(token):
+        shown.append(token)
+
+    out = _run(orch.handle_stream(1, [], "hi", on_token=on_token, use_cache=False))
+    assert "".join(shown) == out.final == "reply in grim"
+    assert out.emotion == "grim"
+    assert calls[-1] == ("stream", "grim")
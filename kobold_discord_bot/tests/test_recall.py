@@ -0,0 +1,43 @@
+from recall import RECALL_MIN_SCORE, RecallIndex, _UserIndex
+from storage import UserStore
+
+EXCHANGES = [
+    ("my cat is called Whiskers", "Whiskers is a lovely name for a cat"),
+    ("how do I fit a frigate", "Bring scouts and light armor"),
+    ("what is the weather like", "I cannot check the weather"),
+    ("tell me a joke", "Why did the ship cross the nebula"),
+    ("ok thanks", "You're welcome"),
+]
+
+
+def _index() -> _UserIndex:
+    idx = _UserIndex(2048, 100)
+    for i, (user, reply) in enumerate(EXCHANGES, 1):
+        idx.add(i, user, reply)
+    return idx
+
+
+def test_relevant_exchange_ranks_first():
+    hits = _index().search("what is my cat called", 5, 0, 0.0)
+    assert hits[0][0] == 1
+    assert [h[0] for h in _index().search("what is my cat called", 5, 0, RECALL_MIN_SCORE)] == [1]
+
+
+def test_scores_are_cosines():
+    # An exchange asked again word for word scores (close to) 1, not more.
+    user, reply = EXCHANGES[1]
+    assert _index().search(f"{user}\n{reply}", 1, 0, 0.99)[0][0] == 2
+    assert _index().search(f"{user}\n{reply}", 5, 0, 1.01) == []
+
+
+def test_filler_sharing_one_word_is_not_recalled():
+    assert _index().search("thanks for the help with the weather", 5, 0, RECALL_MIN_SCORE) == []
+
+
+def test_skip_leaves_out_newest(tmp_path):
+    store = UserStore(tmp_path / "users.db")
+    for user, reply in EXCHANGES:
+        store.append_exchange("u", user, reply)
+    recall = RecallIndex(store)
+    assert [h[0] for h in recall.search("u", "my cat Whiskers", k=3)][:1] == [1]
+    assert recall.search("u", "ok thanks welcome", k=3, skip=1) == []
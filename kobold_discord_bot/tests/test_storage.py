@@ -0,0 +1,39 @@
+import json
+import sqlite3
+
+from storage import UserStore
+
+
+def test_existing_turns_are_archived(tmp_path):
+    path = tmp_path / "users.db"
+    conn = sqlite3.connect(path)
+    # A database from before the exchanges table existed.
+    conn.executescript(
+        "CREATE TABLE turns (id INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT NOT NULL,"
+        " role TEXT NOT NULL, content TEXT NOT NULL);"
+    )
+    conn.executemany(
+        "INSERT INTO turns (uid, role, content) VALUES (?, ?, ?)",
+        [("1", "user", "hi"), ("1", "assistant", "hello"), ("1", "user", "bye"),
+         ("1", "assistant", "see you"), ("2", "assistant", "orphan")],
+    )
+    conn.commit()
+    conn.close()
+    store = UserStore(path)
+    assert [ex[1:] for ex in store.exchanges("1")] == [("hi", "hello"), ("bye", "see you")]
+    assert store.exchanges("2") == []
+    store.append_exchange("1", "again", "sure")
+    # Opening the database again does not archive the turns twice.
+    assert len(UserStore(path).exchanges("1")) == 3
+
+
+def test_migrated_history_is_archived(tmp_path):
+    legacy = tmp_path / "user_memory.json"
+    history = []
+    for i in range(6):
+        history += [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}]
+    legacy.write_text(json.dumps({"7": {"history": history, "summary": "s"}}))
+    store = UserStore(tmp_path / "users.db", max_turns=4)
+    assert store.migrate_json(legacy) == 1
+    assert len(store.get("7")["history"]) == 4
+    assert [ex[1] for ex in store.exchanges("7")] == [f"q{i}" for i in range(6)]
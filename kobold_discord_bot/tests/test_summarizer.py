@@ -0,0 +1,21 @@
+from context import approx_tokens
+from summarizer import _summary_prompt, fitting_turns
+
+
+def _turns(n, size=600):
+    return [(i, "user" if i % 2 else "assistant", "x" * size) for i in range(n)]
+
+
+def test_fitting_turns_stays_in_context():
+    turns = fitting_turns("old summary", _turns(200), max_len=500, ctx=4096)
+    assert 0 < len(turns) < 200
+    assert approx_tokens(_summary_prompt("old summary", turns)) <= 4096 - 500
+    assert [t[0] for t in turns] == list(range(len(turns)))
+
+
+def test_fitting_turns_keeps_short_backlog():
+    assert len(fitting_turns("", _turns(10, 50), max_len=500)) == 10
+
+
+def test_fitting_turns_never_empty():
+    assert len(fitting_turns("", _turns(3), max_len=500, ctx=100)) == 1
@@ -0,0 +1,27 @@
+import pytest
+
+from translation import looks_english
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["thanks", "hello there", "what do you think about that?", "can you help me with this", "12 + 30 = 42"],
+)
+def test_obvious_english(text):
+    assert looks_english(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Was ist das?",
+        "Ich will das haben",
+        "no me gusta",
+        "Het is in orde",
+        "Was kostet das Schiff?",
+        "Je suis là",
+        "Wie geht es dir?",
+    ],
+)
+def test_other_languages_are_detected(text):
+    assert not looks_english(text)
@@ -0,0 +1,159 @@
+"""Asynchronous, cached translation for the bot and the web UI.
+
+Detection and translation run in worker threads so a slow translation
+service never stalls the event loop. Results are cached per
+``(text, src, dest)``, obvious English skips both steps, and backends are
+tried in order (``TRANSLATE_BACKENDS``), so with no network the bot falls
+back to an offline backend or, failing that, to the untranslated text.
+"""
+from __future__ import annotations
+
+import abc
+import asyncio
+import os
+import re
+import time
+from typing import Dict, List
+
+from cache import TTLCache
+from core import detect_language
+from metrics import METRICS, timed
+
+TRANSLATE_BACKENDS = os.getenv("TRANSLATE_BACKENDS", "google,argos")
+TRANSLATE_CACHE_SIZE = int(os.getenv("TRANSLATE_CACHE_SIZE", "4096"))
+TRANSLATE_CACHE_TTL = float(os.getenv("TRANSLATE_CACHE_TTL", "86400"))
+# A backend that fails is skipped for this many seconds.
+TRANSLATE_RETRY_AFTER = float(os.getenv("TRANSLATE_RETRY_AFTER", "60"))
+
+_WORD_RE = re.compile(r"[A-Za-z']+")
+# Only words that are not also everyday words in other languages written in
+# ASCII ("was", "will", "is", "no", "me", "in", "to" ... are left out).
+_COMMON_EN = frozenset(
+    """
+    about and are be been but can could did does don't from has have hello hey
+    hi how i'm if it it's just know like not please should that the their there
+    they thank thanks think this want were what when where which who why with
+    would yes you your
+    """.split()
+)
+
+
+def looks_english(text: str) -> bool:
+    """Cheap check for text that clearly needs no detection or translation.
+
+    True for ASCII text in which most words are common English ones (and at
+    least two are, unless the text is a single word), and for text without
+    any letters at all (emoji, numbers, code), which translation would not
+    change anyway.
+    """
+
+    if not text.isascii():
+        return False
+    words = [w.lower() for w in _WORD_RE.findall(text)]
+    if not words:
+        return True
+    common = sum(1 for w in words if w in _COMMON_EN)
+    return common >= min(2, len(words)) and common * 2 > len(words)
+
+
+class Backend(abc.ABC):
+    """A synchronous translation backend; run in a worker thread."""
+
+    name = "none"
+
+    def available(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def translate(self, text: str, src: str, dest: str) -> str:
+        """Return ``text`` translated from ``src`` to ``dest``."""
+
+
+class GoogleBackend(Backend):
+    name = "google"
+
+    def translate(self, text: str, src: str, dest: str) -> str:
+        from deep_translator import GoogleTranslator
+
+        return GoogleTranslator(source=src, target=dest).translate(text)
+
+
+class ArgosBackend(Backend):
+    """Offline translation with Argos Translate, if it is installed."""
+
+    name = "argos"
+
+    def available(self) -> bool:
+        try:
+            import argostranslate.translate  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def translate(self, text: str, src: str, dest: str) -> str:
+        import argostranslate.translate
+
+        return argostranslate.translate.translate(text, src, dest)
+
+
+BACKENDS: Dict[str, type[Backend]] = {"google": GoogleBackend, "argos": ArgosBackend}
+
+
+class Translator:
+    """Detect and translate off the event loop, with an LRU result cache."""
+
+    def __init__(self, backends: List[Backend]) -> None:
+        self.backends = [b for b in backends if b.available()]
+        self.cache = TTLCache(TRANSLATE_CACHE_SIZE, TRANSLATE_CACHE_TTL)
+        self._down_until: Dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "Translator":
+        names = [n.strip() for n in TRANSLATE_BACKENDS.split(",") if n.strip()]
+        return cls([BACKENDS[n]() for n in names if n in BACKENDS])
+
+    async def detect(self, text: str) -> str:
+        if looks_english(text):
+            return "en"
+        key = ("detect", text)
+        lang = self.cache.get(key)
+        if lang is None:
+            with timed("detect"):
+                lang = await asyncio.to_thread(detect_language, text)
+            self.cache.set(key, lang)
+        return lang
+
+    def _translate(self, text: str, src: str, dest: str) -> str | None:
+        for backend in self.backends:
+            if self._down_until.get(backend.name, 0.0) > time.monotonic():
+                continue
+            try:
+                out = backend.translate(text, src, dest)
+            except Exception:
+                self._down_until[backend.name] = time.monotonic() + TRANSLATE_RETRY_AFTER
+                continue
+            if out:
+                return out
+        return None
+
+    async def translate(self, text: str, src: str, dest: str) -> str:
+        """Return ``text`` in ``dest``, or unchanged if no backend can help."""
+
+        if src == dest or not text.strip() or (dest == "en" and looks_english(text)):
+            return text
+        key = (text, src, dest)
+        out = self.cache.get(key)
+        if out is None:
+            with timed("translate"):
+                out = await asyncio.to_thread(self._translate, text, src, dest)
+            if out is None:
+                # Not cached, so the next message retries once a backend is back.
+                return text
+            self.cache.set(key, out)
+        return out
+
+
+TRANSLATOR = Translator.from_env()
+METRICS.register_cache("translation", TRANSLATOR.cache)
+
+__all__ = ["TRANSLATOR", "Backend", "Translator", "looks_english"]
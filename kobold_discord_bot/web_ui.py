@@ -1,37 +1,48 @@
-"""Minimal web UI to chat with Requiem via a browser."""
+"""Minimal web UI to chat with Requiem via a browser.
+
+Runs on aiohttp, so every chat is a coroutine on one event loop sharing a
+single ``aiohttp.ClientSession`` and :class:`Orchestrator`. Model capacity
+is shared with fair per-user queuing by :data:`scheduler.SCHEDULER`,
+translation runs in worker threads and images are rendered as background
+jobs (:mod:`images`) that the page polls.
+"""
 
 from __future__ import annotations
 
+# Imported first so the startup timings cover the other imports.
+from startup import STARTUP, warm_up  # isort: skip
 
 import asyncio
-from base64 import b64encode
-from typing import Any, Dict
-
-from flask import Flask, jsonify, render_template_string, request
+import json
+from typing import Any, Dict, Tuple
 
 import aiohttp
+from aiohttp import web
 
+import core
 from core import (
-    GLOBAL_MEMORY,
     SYSTEM_PROMPT,
-    detect_language,
     get_user_entry,
     lookup_go2,
-    translate_text,
-    txt2img,
     update_memory,
 )
+from images import ImageQueue
+from launch_kobold import wait_ready
+from metrics import METRICS
 from orchestrator import Orchestrator
+from reloader import RELOAD, RELOADER
+from reply_cache import FRESH_PREF
+from scheduler import Overloaded
+from translation import TRANSLATOR
 
+STARTUP.mark("imports")
 
+routes = web.RouteTableDef()
 
-app = Flask(__name__)
-
-
-_LOOP = asyncio.new_event_loop()
-asyncio.set_event_loop(_LOOP)
-_SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
-_ORCH = Orchestrator(SYSTEM_PROMPT, GLOBAL_MEMORY, _SESSION)
+_SESSION: aiohttp.ClientSession | None = None
+_ORCH: Orchestrator | None = None
+_IMAGES: ImageQueue | None = None
+_WARM_UP: asyncio.Task | None = None
 
 INDEX_HTML = """
 <!doctype html>
@@ -49,85 +60,259 @@ INDEX_HTML = """
 async function send(){
   const user=document.getElementById('user').value;
   const message=document.getElementById('msg').value;
-  const res=await fetch('/chat',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({user,message})});
-  const data=await res.json();
   const log=document.getElementById('log');
   log.innerHTML+=`<p><b>${user}:</b> ${message}</p>`;
-  log.innerHTML+=`<p><b>AI:</b> ${data.reply}</p>`;
-  log.scrollTop=log.scrollHeight;
+  const p=document.createElement('p');
+  p.innerHTML='<b>AI:</b> ';
+  const span=document.createElement('span');
+  p.appendChild(span);
+  log.appendChild(p);
   document.getElementById('msg').value='';
+  const res=await fetch('/chat/stream',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({user,message})});
+  const reader=res.body.getReader();
+  const dec=new TextDecoder();
+  let buf='';
+  for(;;){
+    const {value,done}=await reader.read();
+    if(done) break;
+    buf+=dec.decode(value,{stream:true});
+    let i;
+    while((i=buf.indexOf('\n\n'))>=0){
+      const ev=buf.slice(0,i); buf=buf.slice(i+2);
+      const line=ev.split('\n').find(l=>l.startsWith('data:'));
+      if(!line) continue;
+      const data=JSON.parse(line.slice(5));
+      if(data.token!==undefined) span.textContent+=data.token;
+      if(data.reply!==undefined) span.textContent=data.reply;
+      if(data.image_job) showImage(data.image_job,p);
+      if(data.error) p.innerHTML+=`<br><b>ERROR:</b> ${data.error}`;
+      log.scrollTop=log.scrollHeight;
+    }
+  }
 }
 
-async function img(){
-  const prompt=document.getElementById('imgprompt').value;
-  const res=await fetch('/img',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({prompt})});
-  const data=await res.json();
+async function showImage(job,el){
   const log=document.getElementById('log');
-  if(data.image){
-    log.innerHTML+=`<p><b>Image:</b><br><img src="data:image/png;base64,${data.image}" width="256"/></p>`;
+  const status=document.createElement('span');
+  el.appendChild(status);
+  while(job.status==='queued'||job.status==='running'){
+    status.textContent=` rendering ${Math.round(job.progress*100)}%`;
+    await new Promise(r=>setTimeout(r,1000));
+    job=await (await fetch(`/img/jobs/${job.id}`)).json();
+  }
+  if(job.url){
+    status.innerHTML=`<br><img src="${job.url}" width="256"/>`;
   }else{
-    log.innerHTML+=`<p><b>IMG ERROR:</b> ${data.error}</p>`;
+    status.innerHTML=`<br><b>IMG ERROR:</b> ${job.error}`;
   }
   log.scrollTop=log.scrollHeight;
+}
+
+async function img(){
+  const prompt=document.getElementById('imgprompt').value;
+  const user=document.getElementById('user').value;
+  const log=document.getElementById('log');
+  const p=document.createElement('p');
+  p.innerHTML='<b>Image:</b>';
+  log.appendChild(p);
   document.getElementById('imgprompt').value='';
+  const res=await fetch('/img',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({prompt,user})});
+  await showImage(await res.json(),p);
 }
 
 </script>
 """
 
 
-@app.get("/")
-def index():
-    return render_template_string(INDEX_HTML)
+@routes.get("/")
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text=INDEX_HTML, content_type="text/html")
+
 
+async def _read_chat(request: web.Request) -> Tuple[str, str, bool]:
+    """``user``, ``message`` and whether ``fresh`` asks to bypass the reply cache."""
 
-@app.post("/chat")
-def chat():
-    data = request.get_json(force=True)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
     user = data.get("user")
     message = data.get("message")
     if not user or not message:
-        return jsonify({"error": "user and message required"}), 400
+        raise web.HTTPBadRequest(
+            text=json.dumps({"error": "user and message required"}),
+            content_type="application/json",
+        )
+    return str(user), message, bool(data.get("fresh"))
 
 
+def _use_cache(entry: Dict[str, Any], fresh: bool) -> bool:
+    return not fresh and entry["prefs"].get(FRESH_PREF) != "1"
+
+
+@routes.post("/chat")
+async def chat(request: web.Request) -> web.Response:
+    user, message, fresh = await _read_chat(request)
     entry = get_user_entry(user)
-    lang = detect_language(message)
-    msg_en = translate_text(message, lang, "en")
+    lang = await TRANSLATOR.detect(message)
+    msg_en = await TRANSLATOR.translate(message, lang, "en")
     kb = lookup_go2(msg_en)
     try:
-        result = _LOOP.run_until_complete(
-            _ORCH.handle(user, entry["history"], msg_en, kb, entry.get("summary", ""))
+        result = await _ORCH.handle(
+            user,
+            entry["history"],
+            msg_en,
+            kb,
+            entry.get("summary", ""),
+            use_cache=_use_cache(entry, fresh),
         )
+    except Overloaded as exc:
+        return web.json_response({"error": str(exc)}, status=503)
     except Exception as exc:  # pragma: no cover - network errors
-        return jsonify({"error": str(exc)}), 500
+        return web.json_response({"error": str(exc)}, status=500)
 
     reply_en = result.final
-    reply = translate_text(reply_en, "en", lang)
+    reply = await TRANSLATOR.translate(reply_en, "en", lang)
     update_memory(user, msg_en, reply_en)
+    STARTUP.mark_once("first_reply")
     resp: Dict[str, Any] = {"reply": reply}
     if result.intent.flags.get("needs_image"):
-        try:
-            png = txt2img(message)
-            resp["image"] = b64encode(png).decode("ascii")
-        except Exception as exc:  # pragma: no cover - network errors
-            resp["error"] = str(exc)
-    return jsonify(resp)
+        # The reply does not wait for the render; poll the job instead.
+        resp["image_job"] = _IMAGES.submit(message, user).to_dict()
+    return web.json_response(resp)
 
 
-@app.post("/img")
-def img():
-    data = request.get_json(force=True)
-    prompt = data.get("prompt")
-    if not prompt:
-        return jsonify({"error": "prompt required"}), 400
+def _sse(data: Dict[str, Any], event: str = "message") -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+@routes.post("/chat/stream")
+async def chat_stream(request: web.Request) -> web.StreamResponse:
+    user, message, fresh = await _read_chat(request)
+    entry = get_user_entry(user)
+    lang = await TRANSLATOR.detect(message)
+    msg_en = await TRANSLATOR.translate(message, lang, "en")
+    kb = lookup_go2(msg_en)
+
+    resp = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await resp.prepare(request)
+
+    async def on_token(token: str) -> None:
+        await resp.write(_sse({"token": token}))
+
     try:
-        png = txt2img(prompt)
+        result = await _ORCH.handle_stream(
+            user,
+            entry["history"],
+            msg_en,
+            kb,
+            entry.get("summary", ""),
+            # Tokens are English; other languages only get the translated reply.
+            on_token=on_token if lang == "en" else None,
+            use_cache=_use_cache(entry, fresh),
+        )
     except Exception as exc:  # pragma: no cover - network errors
-        return jsonify({"error": str(exc)}), 500
-    return jsonify({"image": b64encode(png).decode("ascii")})
+        await resp.write(_sse({"error": str(exc)}, event="error"))
+        await resp.write_eof()
+        return resp
 
+    reply_en = result.final
+    reply = await TRANSLATOR.translate(reply_en, "en", lang)
+    update_memory(user, msg_en, reply_en)
+    STARTUP.mark_once("first_reply")
+    done: Dict[str, Any] = {"reply": reply}
+    if result.intent.flags.get("needs_image"):
+        done["image_job"] = _IMAGES.submit(message, user).to_dict()
+    await resp.write(_sse(done, event="done"))
+    await resp.write_eof()
+    return resp
 
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+@routes.post("/img")
+async def img(request: web.Request) -> web.Response:
+    """Start an image job; poll ``/img/jobs/{id}`` until it has a ``url``."""
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    prompt = data.get("prompt")
+    if not prompt:
+        return web.json_response({"error": "prompt required"}, status=400)
+    job = _IMAGES.submit(prompt, str(data.get("user") or request.remote))
+    return web.json_response(job.to_dict(), status=200 if job.status == "done" else 202)
+
+
+@routes.get("/img/jobs/{job_id}")
+async def img_job(request: web.Request) -> web.Response:
+    job = _IMAGES.get(request.match_info["job_id"])
+    if job is None:
+        return web.json_response({"error": "unknown job"}, status=404)
+    return web.json_response(job.to_dict())
+
+
+@routes.get(r"/img/{digest:[0-9a-f]{64}}.png")
+async def img_file(request: web.Request) -> web.StreamResponse:
+    path = _IMAGES.store.path(request.match_info["digest"])
+    if not path.exists():
+        raise web.HTTPNotFound()
+    # The URL names the content, so it never changes; FileResponse adds an
+    # ETag and answers If-None-Match with 304.
+    return web.FileResponse(
+        path, headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
 
+
+@routes.get("/metrics")
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        text=METRICS.render(), content_type="text/plain", charset="utf-8",
+        headers={"X-Content-Type-Options": "nosniff"},
+    )
+
+
+def _memory_reloaded(text: str) -> None:
+    if _ORCH is not None:
+        _ORCH.set_memory(text)
+
+
+RELOADER.subscribe("memory", _memory_reloaded)
+
+
+async def _on_startup(app: web.Application) -> None:
+    global _SESSION, _ORCH, _IMAGES, _WARM_UP
+    await wait_ready()
+    STARTUP.mark("models")
+    _SESSION = core.http_session()
+    _ORCH = Orchestrator(SYSTEM_PROMPT, core.GLOBAL_MEMORY, _SESSION, recall=core.USER_RECALL)
+    _IMAGES = ImageQueue(_SESSION)
+    METRICS.register_cache("image", _IMAGES)
+    if RELOAD:
+        RELOADER.start()
+    STARTUP.mark("ready")
+    _WARM_UP = asyncio.ensure_future(warm_up())
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    if _WARM_UP is not None:
+        _WARM_UP.cancel()
+    if _SESSION is not None:
+        await _SESSION.close()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=8080)